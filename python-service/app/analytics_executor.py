@@ -0,0 +1,127 @@
+"""
+Process-pool executor for CPU-bound analytics
+Keeps large pandas computations off the event loop: small inputs run
+inline, large ones are shipped to worker processes as plain arrays
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Worker processes for offloaded analytics
+ANALYTICS_PROCESSES = int(os.getenv("ANALYTICS_PROCESSES", str(min(4, os.cpu_count() or 1))))
+
+# Inputs with fewer rows than this run inline; pickling the payload and
+# the process hop cost more than the computation for small portfolios
+OFFLOAD_MIN_ROWS = int(os.getenv("ANALYTICS_OFFLOAD_MIN_ROWS", "50000"))
+
+# Columns the analytics need; everything else (e.g. trade ids) stays behind
+PAYLOAD_COLUMNS = ("symbol", "side", "qty", "price", "executed_at")
+
+# fn(columns, *args) -> result; must be a module-level function so it pickles
+AnalyticsTask = Callable[..., Any]
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+stats = {
+    "inline": 0,
+    "offloaded": 0,
+    "queue_wait_ms_total": 0.0,
+    "compute_ms_total": 0.0,
+}
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Create the process pool on first use"""
+    global _executor
+    if _executor is None:
+        # spawn: children must not inherit the event loop or open DB sockets
+        _executor = ProcessPoolExecutor(
+            max_workers=ANALYTICS_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def compact_payload(columns: Dict) -> Dict:
+    """
+    Reduce fetched trade columns to the arrays the analytics read
+
+    NumPy arrays and categoricals pickle as contiguous buffers plus a small
+    category list, so the payload size is roughly 8 bytes per value.
+    """
+    return {name: columns[name] for name in PAYLOAD_COLUMNS}
+
+
+def _run_in_worker(fn: AnalyticsTask, payload: Dict, args: Tuple, submitted_at: float):
+    """Worker-side entry point: time the queue wait and the computation"""
+    started_at = time.time()
+    compute_start = time.perf_counter()
+    result = fn(payload, *args)
+    compute_ms = (time.perf_counter() - compute_start) * 1000
+    return result, (started_at - submitted_at) * 1000, compute_ms
+
+
+async def run(
+    fn: AnalyticsTask,
+    columns: Dict,
+    *args,
+    min_rows: Optional[int] = None
+) -> Tuple[Any, Dict]:
+    """
+    Run fn(columns, *args) inline or in the process pool
+
+    Inputs with fewer than min_rows rows (default OFFLOAD_MIN_ROWS) run
+    inline. Returns (result, timing) where timing reports the execution
+    mode, row count, time spent waiting for a worker and time spent
+    computing.
+    """
+    rows = len(columns["qty"])
+    if min_rows is None:
+        min_rows = OFFLOAD_MIN_ROWS
+
+    if rows < min_rows or ANALYTICS_PROCESSES <= 0:
+        compute_start = time.perf_counter()
+        result = fn(columns, *args)
+        mode, queue_wait_ms = "inline", 0.0
+        compute_ms = (time.perf_counter() - compute_start) * 1000
+    else:
+        loop = asyncio.get_running_loop()
+        result, queue_wait_ms, compute_ms = await loop.run_in_executor(
+            get_executor(), _run_in_worker, fn, compact_payload(columns), args, time.time()
+        )
+        mode = "process"
+        # Wall clocks of different processes; clamp small negative skew
+        queue_wait_ms = max(queue_wait_ms, 0.0)
+
+    stats["offloaded" if mode == "process" else "inline"] += 1
+    stats["queue_wait_ms_total"] += queue_wait_ms
+    stats["compute_ms_total"] += compute_ms
+
+    timing = {
+        "mode": mode,
+        "rows": rows,
+        "queue_wait_ms": round(queue_wait_ms, 2),
+        "compute_ms": round(compute_ms, 2),
+    }
+    return result, timing
+
+
+def get_stats() -> Dict:
+    return {
+        **stats,
+        "queue_wait_ms_total": round(stats["queue_wait_ms_total"], 2),
+        "compute_ms_total": round(stats["compute_ms_total"], 2),
+        "processes": ANALYTICS_PROCESSES,
+        "offload_min_rows": OFFLOAD_MIN_ROWS,
+    }
@@ -0,0 +1,183 @@
+"""
+Write-behind compliance audit writer
+Buffers audit rows in memory and flushes them to the database in bulk
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional
+from . import db
+
+# Flush when this many rows are buffered...
+MAX_BATCH_SIZE = 500
+# ...or when the oldest buffered row has waited this long
+FLUSH_INTERVAL_SECONDS = 0.5
+# Writers block once this many rows are waiting (backpressure)
+MAX_QUEUE_SIZE = 10000
+# A failed flush is retried with backoff: FLUSH_RETRY_BASE_SECONDS * 2^(attempt - 1), capped
+FLUSH_RETRY_BASE_SECONDS = 0.5
+FLUSH_RETRY_MAX_SECONDS = 30
+# Attempts per batch once stopping; stop() raises if they all fail
+STOP_FLUSH_ATTEMPTS = 3
+
+_STOP = object()
+
+
+class AuditWriteError(Exception):
+    """Buffered audit rows could not be written before the writer stopped"""
+
+
+class AuditWriter:
+    """
+    Batches compliance audit rows and writes them with COPY
+
+    enqueue() returns as soon as the row is buffered; it only waits when the
+    queue is full, which slows producers down instead of growing memory.
+    A batch that fails to write is retried until it succeeds, holding back
+    the rows behind it; during stop() it is retried a few times and then
+    AuditWriteError is raised instead of dropping rows silently.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL_SECONDS,
+        max_queue_size: int = MAX_QUEUE_SIZE
+    ):
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats = {"enqueued": 0, "written": 0, "failed": 0, "flushes": 0, "retries": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Start the background flush loop"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything still buffered and stop the flush loop"""
+        if not self.running:
+            return
+        self._stopping = True
+        await self._queue.put(_STOP)
+        try:
+            await self._task
+        finally:
+            self._task = None
+
+    async def enqueue(self, audit_data: Dict):
+        """Buffer one audit row, waiting only if the queue is full"""
+        row = {**audit_data, "created_at": audit_data.get("created_at") or datetime.utcnow()}
+        await self._queue.put(row)
+        self.stats["enqueued"] += 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            first = await self._queue.get()
+            if first is _STOP:
+                break
+
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    def _drain(self) -> int:
+        """Discard everything still queued; returns the number of rows"""
+        rows = 0
+        while not self._queue.empty():
+            if self._queue.get_nowait() is not _STOP:
+                rows += 1
+        return rows
+
+    async def _flush(self, batch: List[Dict]):
+        attempt = 0
+        while True:
+            try:
+                await db.create_compliance_audits_bulk(batch)
+                break
+            except Exception as e:
+                attempt += 1
+                if self._stopping and attempt >= STOP_FLUSH_ATTEMPTS:
+                    lost = len(batch) + self._drain()
+                    self.stats["failed"] += lost
+                    raise AuditWriteError(f"Audit writer could not write {lost} rows on stop: {e}") from e
+                delay = min(FLUSH_RETRY_MAX_SECONDS, FLUSH_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+                print(f"Audit writer failed to flush {len(batch)} rows (attempt {attempt}), retrying in {delay}s: {e}")
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+        self.stats["written"] += len(batch)
+        self.stats["flushes"] += 1
+
+
+_writer = AuditWriter()
+
+
+def get_writer() -> AuditWriter:
+    """Get the process-wide audit writer"""
+    return _writer
+
+
+async def start():
+    await _writer.start()
+
+
+async def stop():
+    await _writer.stop()
+
+
+async def enqueue(audit_data: Dict):
+    """
+    Record a compliance audit row
+
+    Buffered by the write-behind writer when it is running (the API
+    process); written directly otherwise, e.g. from scripts.
+    """
+    if _writer.running:
+        await _writer.enqueue(audit_data)
+    else:
+        await db.create_compliance_audit(audit_data)
+
+
+async def enqueue_many(audits: List[Dict]):
+    """
+    Record many compliance audit rows
+
+    Falls back to a single bulk write when the writer is not running.
+    """
+    if not audits:
+        return
+    if _writer.running:
+        for audit_data in audits:
+            await _writer.enqueue(audit_data)
+    else:
+        await db.create_compliance_audits_bulk(audits)
@@ -0,0 +1,156 @@
+"""
+In-process benchmark price series cache
+Keeps each symbol's daily closes as sorted arrays and answers range
+lookups with bisect, so comparative requests skip the database once warm
+"""
+
+import asyncio
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from . import db
+
+# Maximum number of symbols held in memory (least recently used evicted)
+MAX_SYMBOLS = 64
+
+# Safety net for bars written by other processes, which cannot invalidate us
+SERIES_TTL_SECONDS = 3600
+
+
+class BenchmarkSeries:
+    """Sorted daily closes for one benchmark symbol"""
+
+    def __init__(self, symbol: str, dates: List[date], closes: List[float]):
+        self.symbol = symbol
+        self.dates = dates
+        self.closes = closes
+        # The same bars as arrays, for vectorized as-of lookups
+        self.date_array = np.array(dates, dtype="datetime64[D]")
+        self.close_array = np.array(closes, dtype=np.float64)
+        self.loaded_at = time.monotonic()
+
+    def range_bounds(self, start_date: date, end_date: date) -> Tuple[int, int]:
+        """Index of the first and last bar within [start_date, end_date]"""
+        return bisect_left(self.dates, start_date), bisect_right(self.dates, end_date) - 1
+
+
+_series: "OrderedDict[str, BenchmarkSeries]" = OrderedDict()
+_locks: Dict[str, asyncio.Lock] = {}
+
+# Bumped by invalidate(); a load that started under an older generation is
+# returned to its caller but not cached, so it cannot outlive the
+# invalidation. _epoch covers invalidate() of every symbol.
+_generations: Dict[str, int] = {}
+_epoch = 0
+
+
+def _generation(symbol: str) -> Tuple[int, int]:
+    return (_epoch, _generations.get(symbol, 0))
+
+
+def _fresh(symbol: str) -> Optional[BenchmarkSeries]:
+    """A symbol's cached series if present and within the TTL"""
+    series = _series.get(symbol)
+    if series is not None and time.monotonic() - series.loaded_at < SERIES_TTL_SECONDS:
+        _series.move_to_end(symbol)
+        return series
+    return None
+
+
+def _store(symbol: str, rows: List[Dict], generation: Tuple[int, int]) -> BenchmarkSeries:
+    """
+    Build a series from (date, close) rows and cache it
+
+    Not cached if the symbol was invalidated since generation was taken,
+    i.e. while the rows were being loaded.
+    """
+    series = BenchmarkSeries(
+        symbol,
+        [r["date"] for r in rows],
+        [float(r["close"]) for r in rows]
+    )
+    if _generation(symbol) != generation:
+        return series
+    _series[symbol] = series
+    _series.move_to_end(symbol)
+    while len(_series) > MAX_SYMBOLS:
+        evicted, _ = _series.popitem(last=False)
+        _locks.pop(evicted, None)
+    return series
+
+
+async def get_series(symbol: str) -> BenchmarkSeries:
+    """
+    Get a symbol's cached series, loading it from the database on a miss
+    """
+    series = _fresh(symbol)
+    if series is not None:
+        return series
+
+    lock = _locks.setdefault(symbol, asyncio.Lock())
+    async with lock:
+        # Another request may have loaded it while we waited
+        series = _fresh(symbol)
+        if series is not None:
+            return series
+
+        generation = _generation(symbol)
+        return _store(symbol, await db.get_benchmark_series(symbol), generation)
+
+
+async def get_many(symbols: List[str]) -> Dict[str, BenchmarkSeries]:
+    """
+    Get several symbols' cached series, loading every miss in one query
+
+    Concurrent misses are not coalesced per symbol as in get_series(); at
+    worst a series is loaded twice.
+    """
+    found = {symbol: _fresh(symbol) for symbol in symbols}
+    missing = [symbol for symbol, series in found.items() if series is None]
+    if missing:
+        generations = {symbol: _generation(symbol) for symbol in missing}
+        rows = await db.get_benchmark_series_many(missing)
+        for symbol in missing:
+            found[symbol] = _store(symbol, rows[symbol], generations[symbol])
+    return found
+
+
+async def price_range(symbol: str, start_date: date, end_date: date) -> Optional[Dict]:
+    """
+    First and last close within a date range
+
+    Returns None if fewer than two bars fall inside the range.
+    """
+    return series_price_range(await get_series(symbol), start_date, end_date)
+
+
+def series_price_range(series: BenchmarkSeries, start_date: date, end_date: date) -> Optional[Dict]:
+    """price_range() for an already loaded series"""
+    first, last = series.range_bounds(start_date, end_date)
+
+    if last - first < 1:
+        return None
+
+    return {
+        "symbol": series.symbol,
+        "start_date": series.dates[first],
+        "end_date": series.dates[last],
+        "start_price": series.closes[first],
+        "end_price": series.closes[last],
+        "points": last - first + 1
+    }
+
+
+def invalidate(symbol: Optional[str] = None):
+    """Drop one symbol's cached series, or all of them"""
+    global _epoch
+    if symbol is None:
+        _epoch += 1
+        _series.clear()
+    else:
+        _generations[symbol] = _generations.get(symbol, 0) + 1
+        _series.pop(symbol, None)
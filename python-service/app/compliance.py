@@ -4,9 +4,10 @@ Implements various trading compliance rules and regulations
 """
 
 import asyncio
-from typing import Dict, List
-from datetime import datetime, timedelta
-from . import db
+from typing import Dict, List, Optional, Tuple
+from datetime import date, datetime, timedelta
+from . import analytics_executor, audit_writer, db, lots, profit, wash_sale
+from .wash_sale import WashSaleIndex
 
 # Compliance check rules
 class ComplianceRules:
@@ -27,105 +28,242 @@ class ComplianceRules:
     # Concentration limits
     MAX_SECTOR_CONCENTRATION = 40  # Max 40% in single sector
 
-async def run_checks_for_trade(trade: Dict):
+class TradeWindow:
     """
-    Run all compliance checks for a trade
+    In-memory snapshot of a user's compliance inputs for a batch of trades
+
+    Loaded once per compliance run and shared by every check, so a trade
+    costs no queries of its own. Holds the buys of the sold symbols around
+    the batch's sells (indexed per symbol for wash sale lookups), the
+    user's day trade count per date and their equity snapshot
+    (lots.summarize_equity).
+    """
+
+    def __init__(
+        self,
+        buys: List[Dict],
+        start_date: date,
+        end_date: date,
+        day_trades: Optional[Dict[date, int]] = None,
+        equity: Optional[Dict] = None
+    ):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.buys = buys
+        self.day_trades = day_trades or {}
+        self.equity = equity or lots.summarize_equity(None)
+        self.wash_sales = WashSaleIndex(ComplianceRules.WASH_SALE_DAYS)
+        for t in buys:
+            self.wash_sales.add(t)
+
+def _pdt_window(trade_date: date) -> Tuple[date, date]:
+    """
+    The PDT_DAYS business days (Mon-Fri) ending on trade_date
+
+    A weekend trade_date counts with the business days before it.
+    """
+    start_date = trade_date
+    while start_date.weekday() >= 5:
+        start_date -= timedelta(days=1)
+    remaining = ComplianceRules.PDT_DAYS - 1
+    while remaining:
+        start_date -= timedelta(days=1)
+        if start_date.weekday() < 5:
+            remaining -= 1
+    return start_date, trade_date
+
+def _count_day_trades(day_trades: Dict[date, int], start_date: date, end_date: date) -> int:
+    return sum(
+        day_trades.get(start_date + timedelta(days=offset), 0)
+        for offset in range((end_date - start_date).days + 1)
+    )
+
+def _wash_sale_range(trade: Dict) -> Tuple[date, date]:
+    trade_date = trade["executed_at"].date()
+    return (
+        trade_date - timedelta(days=ComplianceRules.WASH_SALE_DAYS),
+        trade_date + timedelta(days=ComplianceRules.WASH_SALE_DAYS)
+    )
+
+async def load_trade_window(user_id: str, trades: List[Dict]) -> TradeWindow:
+    """
+    Load everything the checks need for the given trades
+
+    Day trade counts cover the PDT window of every trade, and buys of the
+    sold symbols cover the wash sale window around each sell; at most one
+    query each, plus one primary key read for the equity snapshot.
+    """
+    pdt_start = min(_pdt_window(t["executed_at"].date())[0] for t in trades)
+    pdt_end = max(t["executed_at"].date() for t in trades)
+    day_trades = await db.get_day_trade_counts(user_id, pdt_start, pdt_end)
+    equity = await profit.load_user_equity(user_id)
+
+    sells = [t for t in trades if t["side"].lower() == "sell"]
+    if not sells:
+        return TradeWindow([], pdt_start, pdt_end, day_trades, equity)
+
+    start_date = min(_wash_sale_range(t)[0] for t in sells)
+    end_date = max(_wash_sale_range(t)[1] for t in sells)
+    symbols = sorted({t["symbol"] for t in sells})
+    buys = await db.get_user_buys(user_id, symbols, start_date, end_date)
+    return TradeWindow(buys, start_date, end_date, day_trades, equity)
+
+async def restore_trade_days():
+    """
+    Backfill the PDT day trade counts from trade history if they are empty
+
+    Counts are kept durably and updated on ingest; this seeds them on
+    first deploy (or after the table was cleared). Only the lookback the
+    PDT check can reach is rebuilt.
+    """
+    if await db.has_trade_days():
+        return
+    since = _pdt_window(datetime.utcnow().date())[0] - timedelta(days=7)
+    rows = await db.rebuild_trade_days(since=since)
+    print(f"Rebuilt {rows} PDT day trade rows since {since}")
+
+async def evaluate_trade(trade: Dict, window: Optional[TradeWindow] = None) -> List[Dict]:
+    """
+    Run all compliance checks for a trade and return its audit rows
+
+    Args:
+        window: Preloaded trade window covering this trade; loaded if omitted
     """
     user_id = str(trade.get("user_id"))
     trade_id = str(trade.get("id"))
 
+    if window is None:
+        window = await load_trade_window(user_id, [trade])
+
     checks = [
-        check_pattern_day_trading(user_id, trade),
-        check_position_size_limit(user_id, trade),
-        check_wash_sale(user_id, trade),
-        check_leverage_limit(user_id, trade),
+        check_pattern_day_trading(user_id, trade, window),
+        check_position_size_limit(user_id, trade, window),
+        check_wash_sale(user_id, trade, window),
+        check_leverage_limit(user_id, trade, window),
     ]
 
     results = await asyncio.gather(*checks, return_exceptions=True)
 
-    # Store all audit results
+    audits = []
     for check_result in results:
         if isinstance(check_result, Exception):
             print(f"Compliance check error: {check_result}")
             continue
 
         if check_result:
-            audit_data = {
+            audits.append({
                 "user_id": user_id,
                 "trade_id": trade_id,
                 **check_result
-            }
-            await db.create_compliance_audit(audit_data)
+            })
+    return audits
 
-async def check_pattern_day_trading(user_id: str, trade: Dict) -> Dict:
+async def run_checks_for_trade(trade: Dict, window: Optional[TradeWindow] = None):
     """
-    Check for Pattern Day Trading violations (PDT Rule)
+    Run all compliance checks for a trade and record the audit results
 
-    A pattern day trader is someone who executes 4 or more day trades
-    within 5 business days.
+    Args:
+        window: Preloaded trade window covering this trade; loaded if omitted
     """
-    # Get recent trades
-    end_date = datetime.now().date()
-    start_date = end_date - timedelta(days=ComplianceRules.PDT_DAYS)
+    await audit_writer.enqueue_many(await evaluate_trade(trade, window))
 
-    trades = await db.get_user_trades(user_id, start_date, end_date)
-
-    # Count day trades (buy and sell of same symbol on same day)
-    day_trades = 0
-    trade_dates = {}
+async def run_checks_for_trades(trades: List[Dict]) -> List[Dict]:
+    """
+    Run compliance checks for a batch of one user's trades
 
-    for t in trades:
-        symbol = t["symbol"]
-        trade_date = t["executed_at"].date()
-        key = f"{symbol}_{trade_date}"
+    Used by the compliance job so a burst of fills is checked once per
+    user instead of once per trade. The trade window is loaded once for
+    the whole batch. Returns the audit rows without writing them; the
+    job stores them in the transaction that completes it, so they are
+    not lost if the process stops first.
+    """
+    if not trades:
+        return []
+
+    window = await load_trade_window(str(trades[0]["user_id"]), trades)
+    audits = []
+    for trade in sorted(trades, key=lambda t: t["executed_at"]):
+        try:
+            audits.extend(await evaluate_trade(trade, window))
+        except Exception as e:
+            print(f"Compliance check error for trade {trade.get('id')}: {e}")
+    return audits
+
+async def check_pattern_day_trading(
+    user_id: str,
+    trade: Dict,
+    window: Optional[TradeWindow] = None
+) -> Dict:
+    """
+    Check for Pattern Day Trading violations (PDT Rule)
 
-        if key not in trade_dates:
-            trade_dates[key] = {"buy": False, "sell": False}
+    A pattern day trader is someone who executes 4 or more day trades
+    within 5 business days. Each symbol-day counts min(buys, sells) day
+    trades, read from the counts maintained on ingest.
+    """
+    # Day trades in the business-day window ending on this trade's date
+    start_date, end_date = _pdt_window(trade["executed_at"].date())
 
-        if t["side"].lower() == "buy":
-            trade_dates[key]["buy"] = True
-        elif t["side"].lower() == "sell":
-            trade_dates[key]["sell"] = True
+    if window is None:
+        day_trade_counts = await db.get_day_trade_counts(user_id, start_date, end_date)
+    else:
+        day_trade_counts = window.day_trades
 
-        # If both buy and sell on same day, it's a day trade
-        if trade_dates[key]["buy"] and trade_dates[key]["sell"]:
-            day_trades += 1
+    day_trades = _count_day_trades(day_trade_counts, start_date, end_date)
 
     # Check if threshold exceeded
     if day_trades >= ComplianceRules.PDT_TRADE_THRESHOLD:
         return {
             "check_name": "pattern_day_trading",
             "status": "flag",
-            "reason": f"Pattern Day Trading detected: {day_trades} day trades in {ComplianceRules.PDT_DAYS} days. Minimum equity of ${ComplianceRules.PDT_MIN_EQUITY:,} required.",
+            "reason": f"Pattern Day Trading detected: {day_trades} day trades in {ComplianceRules.PDT_DAYS} business days. Minimum equity of ${ComplianceRules.PDT_MIN_EQUITY:,} required.",
             "metadata": {
                 "day_trades_count": day_trades,
                 "threshold": ComplianceRules.PDT_TRADE_THRESHOLD,
-                "period_days": ComplianceRules.PDT_DAYS
+                "period_days": ComplianceRules.PDT_DAYS,
+                "window_start": start_date.isoformat(),
+                "window_end": end_date.isoformat()
             }
         }
 
     return {
         "check_name": "pattern_day_trading",
         "status": "pass",
-        "reason": f"{day_trades} day trades in {ComplianceRules.PDT_DAYS} days (threshold: {ComplianceRules.PDT_TRADE_THRESHOLD})",
+        "reason": f"{day_trades} day trades in {ComplianceRules.PDT_DAYS} business days (threshold: {ComplianceRules.PDT_TRADE_THRESHOLD})",
         "metadata": {
             "day_trades_count": day_trades,
             "threshold": ComplianceRules.PDT_TRADE_THRESHOLD
         }
     }
 
-async def check_position_size_limit(user_id: str, trade: Dict) -> Dict:
+async def check_position_size_limit(
+    user_id: str,
+    trade: Dict,
+    window: Optional[TradeWindow] = None
+) -> Dict:
     """
     Check if position size exceeds portfolio percentage limit
+
+    The portfolio value is the account equity from the user's materialized
+    snapshot (starting equity plus realized and marked unrealized PnL).
     """
-    # This would require portfolio value data
-    # For now, implement basic check
+    if window is None:
+        window = await load_trade_window(user_id, [trade])
 
-    position_value = trade["qty"] * trade["price"]
+    position_value = float(trade["qty"]) * float(trade["price"])
+    portfolio_value = window.equity["equity"]
 
-    # TODO: Get actual portfolio value from database
-    # For demonstration, using a placeholder
-    portfolio_value = 100000  # $100,000 placeholder
+    if portfolio_value <= 0:
+        return {
+            "check_name": "position_size_limit",
+            "status": "flag",
+            "reason": f"Account equity ${portfolio_value:,.2f} is not positive",
+            "metadata": {
+                "position_value": position_value,
+                "portfolio_value": portfolio_value,
+                "limit_percent": ComplianceRules.MAX_POSITION_SIZE_PERCENT
+            }
+        }
 
     position_percent = (position_value / portfolio_value) * 100
 
@@ -152,7 +290,11 @@ async def check_position_size_limit(user_id: str, trade: Dict) -> Dict:
         }
     }
 
-async def check_wash_sale(user_id: str, trade: Dict) -> Dict:
+async def check_wash_sale(
+    user_id: str,
+    trade: Dict,
+    window: Optional[TradeWindow] = None
+) -> Dict:
     """
     Check for potential wash sale violations
 
@@ -171,27 +313,22 @@ async def check_wash_sale(user_id: str, trade: Dict) -> Dict:
     symbol = trade["symbol"]
     trade_date = trade["executed_at"].date()
 
-    # Get trades 30 days before and after
-    start_date = trade_date - timedelta(days=ComplianceRules.WASH_SALE_DAYS)
-    end_date = trade_date + timedelta(days=ComplianceRules.WASH_SALE_DAYS)
+    if window is None:
+        # Get buys of the symbol 30 days before and after
+        start_date, end_date = _wash_sale_range(trade)
+        buys = await db.get_user_buys(user_id, [symbol], start_date, end_date)
+        window = TradeWindow(buys, start_date, end_date)
 
-    trades = await db.get_user_trades(user_id, start_date, end_date)
-
-    # Look for buy transactions of the same symbol within wash sale period
+    # Buys of the same symbol within the wash sale period (bisect per symbol)
     wash_sale_buys = []
-    for t in trades:
-        if (t["symbol"] == symbol and
-            t["side"].lower() == "buy" and
-            t["id"] != trade["id"]):
-
-            days_diff = abs((t["executed_at"].date() - trade_date).days)
-            if days_diff <= ComplianceRules.WASH_SALE_DAYS:
-                wash_sale_buys.append({
-                    "date": t["executed_at"].date().isoformat(),
-                    "qty": t["qty"],
-                    "price": t["price"],
-                    "days_from_sale": days_diff
-                })
+    for t in window.wash_sales.related_buys(trade):
+        days_diff = abs((t["executed_at"].date() - trade_date).days)
+        wash_sale_buys.append({
+            "date": t["executed_at"].date().isoformat(),
+            "qty": t["qty"],
+            "price": t["price"],
+            "days_from_sale": days_diff
+        })
 
     if wash_sale_buys:
         return {
@@ -212,19 +349,86 @@ async def check_wash_sale(user_id: str, trade: Dict) -> Dict:
         "metadata": {"symbol": symbol}
     }
 
-async def check_leverage_limit(user_id: str, trade: Dict) -> Dict:
+async def screen_wash_sales_for_year(user_id: str, year: int) -> Dict:
+    """
+    Screen every sell in a calendar year for potential wash sales
+
+    Loads the year plus the wash sale period either side as columns and
+    matches all sells in one vectorized pass (in the analytics process
+    pool for large histories), for tax reporting.
+    """
+    start_date = date(year, 1, 1)
+    end_date = date(year, 12, 31)
+    period = timedelta(days=ComplianceRules.WASH_SALE_DAYS)
+
+    columns = await db.fetch_user_trades_columns(user_id, start_date - period, end_date + period)
+    screen, timing = await analytics_executor.run(
+        wash_sale.screen_wash_sales,
+        columns,
+        start_date,
+        end_date,
+        ComplianceRules.WASH_SALE_DAYS
+    )
+
+    sale_dates = columns["executed_at"][screen["index"]].astype("datetime64[D]")
+    wash_sales = [
+        {
+            "trade_id": str(columns["id"][i]),
+            "symbol": columns["symbol"][i],
+            "date": sale_date.item().isoformat(),
+            "qty": float(columns["qty"][i]),
+            "price": float(columns["price"][i]),
+            "related_buys": int(buys),
+            "first_buy_date": first_buy.item().isoformat(),
+            "last_buy_date": last_buy.item().isoformat()
+        }
+        for i, sale_date, buys, first_buy, last_buy in zip(
+            screen["index"], sale_dates, screen["buys"], screen["first_buy"], screen["last_buy"]
+        )
+    ]
+
+    return {
+        "user_id": user_id,
+        "year": year,
+        "wash_sale_period_days": ComplianceRules.WASH_SALE_DAYS,
+        "sells_screened": screen["sells_screened"],
+        "flagged": len(wash_sales),
+        "wash_sales": wash_sales,
+        "execution": timing
+    }
+
+async def check_leverage_limit(
+    user_id: str,
+    trade: Dict,
+    window: Optional[TradeWindow] = None
+) -> Dict:
     """
     Check if leverage exceeds regulatory limits
+
+    Leverage is the gross market value of open positions over account
+    equity, both from the user's materialized snapshot. The trade itself
+    is a floor on exposure in case the snapshot predates it.
     """
-    # This would require margin account data
-    # For now, basic implementation
+    if window is None:
+        window = await load_trade_window(user_id, [trade])
+
+    account_value = window.equity["equity"]
+    position_value = float(trade["qty"]) * float(trade["price"])
+    gross_exposure = max(window.equity["gross_exposure"], position_value)
 
-    # TODO: Get actual account value and margin used
-    account_value = 100000  # Placeholder
-    position_value = trade["qty"] * trade["price"]
+    if account_value <= 0:
+        return {
+            "check_name": "leverage_limit",
+            "status": "fail",
+            "reason": f"Account equity ${account_value:,.2f} is not positive",
+            "metadata": {
+                "max_leverage": ComplianceRules.MAX_LEVERAGE,
+                "gross_exposure": gross_exposure,
+                "account_value": account_value
+            }
+        }
 
-    # Simplified leverage calculation
-    leverage = position_value / account_value
+    leverage = gross_exposure / account_value
 
     if leverage > ComplianceRules.MAX_LEVERAGE:
         return {
@@ -235,6 +439,7 @@ async def check_leverage_limit(user_id: str, trade: Dict) -> Dict:
                 "leverage": round(leverage, 2),
                 "max_leverage": ComplianceRules.MAX_LEVERAGE,
                 "position_value": position_value,
+                "gross_exposure": gross_exposure,
                 "account_value": account_value
             }
         }
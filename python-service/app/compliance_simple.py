@@ -5,7 +5,7 @@ Based on user's cleaner implementation pattern
 """
 
 from typing import Dict, List, Tuple
-from . import db
+from . import audit_writer, db, rule_engine
 
 
 class SimpleComplianceRules:
@@ -60,16 +60,16 @@ async def run_checks_for_trade(trade_row: Dict) -> List[Tuple[str, str, str]]:
     if not wash_trade_detected:
         checks.append(("wash_trade_check", "pass", None))
 
-    # Persist audits
+    # Persist audits (buffered by the write-behind audit writer)
     for name, status, reason in checks:
-        await db.insert_compliance_audit(
-            user_id,
-            trade_id,
-            name,
-            status,
-            reason,
-            metadata={}
-        )
+        await audit_writer.enqueue({
+            "user_id": user_id,
+            "trade_id": trade_id,
+            "check_name": name,
+            "status": status,
+            "reason": reason,
+            "metadata": {}
+        })
 
     return checks
 
@@ -91,74 +91,51 @@ async def add_custom_check(
     }
     """
     check_name = rule_config.get("name", "custom_check")
-    check_type = rule_config.get("check_type")
-    threshold = rule_config.get("threshold", 0)
     symbols = rule_config.get("symbols", [])
-    message = rule_config.get("message", "Custom check failed")
 
     # Symbol filter
     if symbols and trade_row["symbol"] not in symbols:
         return (check_name, "pass", "Symbol not in scope")
 
-    # Check type: max_value
-    if check_type == "max_value":
-        trade_value = float(trade_row["qty"]) * float(trade_row["price"])
-        if trade_value > threshold:
-            return (check_name, "flag", message)
-        return (check_name, "pass", None)
+    try:
+        rule = rule_engine.CompiledRule(0, rule_config)
+    except ValueError:
+        # Unknown check type
+        return (check_name, "pass", "Check type not implemented")
 
-    # Check type: max_quantity
-    elif check_type == "max_quantity":
-        if float(trade_row["qty"]) > threshold:
-            return (check_name, "flag", message)
-        return (check_name, "pass", None)
+    return rule.evaluate(float(trade_row["qty"]), float(trade_row["price"]))
 
-    # Unknown check type
-    return (check_name, "pass", "Check type not implemented")
 
-
-# Example: JSON rule storage (can be loaded from database or file)
-CUSTOM_RULES = [
-    {
-        "name": "crypto_size_limit",
-        "check_type": "max_value",
-        "threshold": 50000,
-        "symbols": ["BTC", "ETH", "DOGE"],
-        "message": "Crypto trade exceeds $50k limit"
-    },
-    {
-        "name": "penny_stock_quantity_limit",
-        "check_type": "max_quantity",
-        "threshold": 100000,
-        "symbols": [],  # Apply to all
-        "message": "Excessive quantity for single trade"
-    }
-]
+# Example: JSON rule storage. Live rules come from the compliance_rules table
+# or COMPLIANCE_RULES_FILE; these apply when neither defines any.
+CUSTOM_RULES = rule_engine.DEFAULT_RULES
 
 
 async def run_all_checks(trade_row: Dict) -> List[Tuple[str, str, str]]:
     """
     Run both standard and custom checks
+
+    Custom rules come from the compiled rule set, so only the rules in
+    scope for the trade's symbol are evaluated.
     """
     # Run standard checks
     checks = await run_checks_for_trade(trade_row)
 
     # Run custom checks from JSON rules
-    for rule in CUSTOM_RULES:
-        try:
-            custom_check = await add_custom_check(trade_row, rule)
-            checks.append(custom_check)
-
-            # Persist custom check
-            await db.insert_compliance_audit(
-                trade_row["user_id"],
-                trade_row["id"],
-                custom_check[0],
-                custom_check[1],
-                custom_check[2],
-                metadata=rule
-            )
-        except Exception as e:
-            print(f"Error running custom check {rule.get('name')}: {e}")
+    rule_set = await rule_engine.get_rule_set()
+    audits = []
+    for rule, custom_check in rule_set.evaluate(trade_row):
+        checks.append(custom_check)
+        audits.append({
+            "user_id": trade_row["user_id"],
+            "trade_id": trade_row["id"],
+            "check_name": custom_check[0],
+            "status": custom_check[1],
+            "reason": custom_check[2],
+            "metadata": rule.config
+        })
+
+    # Persist custom checks
+    await audit_writer.enqueue_many(audits)
 
     return checks
@@ -4,11 +4,16 @@ Handles PostgreSQL connections and CRUD operations
 """
 
 import asyncpg
+import io
 import os
 import json
-from datetime import datetime, date
-from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+from datetime import datetime, date, time, timedelta, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
 from uuid import uuid4
+from . import lots
+from .schema import SCHEMA_STATEMENTS
 
 # Database connection pool
 _pool = None
@@ -24,6 +29,13 @@ async def get_pool():
         _pool = await asyncpg.create_pool(database_url, min_size=2, max_size=10)
     return _pool
 
+async def ensure_schema():
+    """Create the service's tables if they do not exist yet"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        for statement in SCHEMA_STATEMENTS:
+            await conn.execute(statement)
+
 async def check_connection() -> bool:
     """Check if database connection is healthy"""
     try:
@@ -35,9 +47,12 @@ async def check_connection() -> bool:
         print(f"Database connection check failed: {e}")
         return False
 
-async def create_trade(trade_data: Dict) -> Dict:
+async def create_trade(trade_data: Dict, jobs: Sequence[str] = ()) -> Dict:
     """
     Create a new trade record
+
+    Args:
+        jobs: Job kinds to enqueue for the trade in the same transaction
     """
     pool = await get_pool()
     async with pool.acquire() as conn:
@@ -52,8 +67,48 @@ async def create_trade(trade_data: Dict) -> Dict:
             RETURNING id, user_id, symbol, side, qty, price, executed_at
         """
 
-        row = await conn.fetchrow(
-            query,
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                query,
+                trade_id,
+                trade_data["user_id"],
+                trade_data["symbol"],
+                trade_data["side"],
+                trade_data["qty"],
+                trade_data["price"],
+                trade_data["executed_at"],
+                trade_data.get("external_id"),
+                json.dumps(trade_data.get("raw", {})),
+                datetime.utcnow()
+            )
+            await _apply_user_metrics_deltas(conn, [trade_data])
+            await _apply_position_updates(conn, [trade_data])
+            await _apply_trade_day_counts(conn, [trade_data])
+            for kind in jobs:
+                await _enqueue_job(conn, kind, trade_data["user_id"], [trade_id])
+
+        return dict(row)
+
+async def create_trades_bulk(trades: List[Dict], jobs: Sequence[str] = ()) -> List[Dict]:
+    """
+    Create many trade records in a single transaction
+
+    Rows are streamed with COPY instead of one INSERT per trade, so a
+    burst of broker fills costs one pool acquire and one round trip.
+    Returns the created trades in input order, shaped like create_trade().
+
+    Args:
+        jobs: Job kinds to enqueue, once per affected user, in the same transaction
+    """
+    if not trades:
+        return []
+
+    now = datetime.utcnow()
+    records = []
+    created = []
+    for trade_data in trades:
+        trade_id = uuid4()
+        records.append((
             trade_id,
             trade_data["user_id"],
             trade_data["symbol"],
@@ -63,10 +118,580 @@ async def create_trade(trade_data: Dict) -> Dict:
             trade_data["executed_at"],
             trade_data.get("external_id"),
             json.dumps(trade_data.get("raw", {})),
-            datetime.utcnow()
+            now
+        ))
+        created.append({
+            "id": trade_id,
+            "user_id": trade_data["user_id"],
+            "symbol": trade_data["symbol"],
+            "side": trade_data["side"],
+            "qty": trade_data["qty"],
+            "price": trade_data["price"],
+            "executed_at": trade_data["executed_at"]
+        })
+
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.copy_records_to_table(
+                "trades",
+                records=records,
+                columns=[
+                    "id", "user_id", "symbol", "side", "qty", "price",
+                    "executed_at", "external_id", "raw", "created_at"
+                ]
+            )
+            await _apply_user_metrics_deltas(conn, trades)
+            await _apply_position_updates(conn, trades)
+            await _apply_trade_day_counts(conn, trades)
+
+            if jobs:
+                trade_ids_by_user: Dict[str, List] = {}
+                for t in created:
+                    trade_ids_by_user.setdefault(str(t["user_id"]), []).append(t["id"])
+                for kind in jobs:
+                    for user_id in sorted(trade_ids_by_user):
+                        await _enqueue_job(conn, kind, user_id, trade_ids_by_user[user_id])
+
+    return created
+
+def _user_metrics_deltas(trades: List[Dict]) -> Dict[str, Dict]:
+    """Aggregate trades into per-user user_metrics increments"""
+    deltas = {}
+    for t in trades:
+        user_id = str(t["user_id"])
+        delta = deltas.get(user_id)
+        if delta is None:
+            delta = deltas[user_id] = {
+                "total_trades": 0,
+                "buy_count": 0,
+                "sell_count": 0,
+                "buy_value": 0.0,
+                "sell_value": 0.0,
+                "first_trade_at": t["executed_at"],
+                "last_trade_at": t["executed_at"]
+            }
+
+        value = float(t["qty"]) * float(t["price"])
+        delta["total_trades"] += 1
+        if t["side"].lower() == "buy":
+            delta["buy_count"] += 1
+            delta["buy_value"] += value
+        elif t["side"].lower() == "sell":
+            delta["sell_count"] += 1
+            delta["sell_value"] += value
+        delta["first_trade_at"] = min(delta["first_trade_at"], t["executed_at"])
+        delta["last_trade_at"] = max(delta["last_trade_at"], t["executed_at"])
+    return deltas
+
+async def _apply_user_metrics_deltas(conn, trades: List[Dict]):
+    """
+    Add newly inserted trades to user_metrics inside the caller's transaction
+
+    Users without a metrics row yet are seeded from their full history
+    (which already includes the new trades) so pre-existing trades are
+    not lost.
+    """
+    query = """
+        UPDATE user_metrics SET
+            total_trades = total_trades + $2,
+            buy_count = buy_count + $3,
+            sell_count = sell_count + $4,
+            buy_value = buy_value + $5,
+            sell_value = sell_value + $6,
+            first_trade_at = LEAST(first_trade_at, $7),
+            last_trade_at = GREATEST(last_trade_at, $8),
+            leaderboard_stale = true,
+            updated_at = now()
+        WHERE user_id = $1
+    """
+
+    # Lock users' rows in a fixed order so concurrent batches cannot deadlock
+    deltas = _user_metrics_deltas(trades)
+    for user_id in sorted(deltas):
+        delta = deltas[user_id]
+        status = await conn.execute(
+            query,
+            user_id,
+            delta["total_trades"],
+            delta["buy_count"],
+            delta["sell_count"],
+            delta["buy_value"],
+            delta["sell_value"],
+            delta["first_trade_at"],
+            delta["last_trade_at"]
         )
+        if status == "UPDATE 0":
+            await _rebuild_user_metrics(conn, user_id)
 
-        return dict(row)
+async def _rebuild_user_metrics(conn, user_id: str) -> Optional[Dict]:
+    """Recompute a user's metrics row from the trades table"""
+    # Serialize first-time seeding per user so concurrent ingests agree
+    await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", str(user_id))
+
+    query = """
+        INSERT INTO user_metrics (
+            user_id, total_trades, buy_count, sell_count,
+            buy_value, sell_value, first_trade_at, last_trade_at, updated_at
+        )
+        SELECT user_id,
+               COUNT(*),
+               COUNT(*) FILTER (WHERE LOWER(side) = 'buy'),
+               COUNT(*) FILTER (WHERE LOWER(side) = 'sell'),
+               COALESCE(SUM(qty * price) FILTER (WHERE LOWER(side) = 'buy'), 0),
+               COALESCE(SUM(qty * price) FILTER (WHERE LOWER(side) = 'sell'), 0),
+               MIN(executed_at),
+               MAX(executed_at),
+               now()
+        FROM trades
+        WHERE user_id = $1
+        GROUP BY user_id
+        ON CONFLICT (user_id)
+        DO UPDATE SET
+            total_trades = EXCLUDED.total_trades,
+            buy_count = EXCLUDED.buy_count,
+            sell_count = EXCLUDED.sell_count,
+            buy_value = EXCLUDED.buy_value,
+            sell_value = EXCLUDED.sell_value,
+            first_trade_at = EXCLUDED.first_trade_at,
+            last_trade_at = EXCLUDED.last_trade_at,
+            leaderboard_stale = true,
+            updated_at = EXCLUDED.updated_at
+        RETURNING user_id, total_trades, buy_count, sell_count,
+                  buy_value, sell_value, first_trade_at, last_trade_at, updated_at
+    """
+
+    row = await conn.fetchrow(query, user_id)
+    return dict(row) if row else None
+
+async def rebuild_user_metrics(user_id: str) -> Optional[Dict]:
+    """
+    Rebuild a user's aggregate metrics from their full trade history
+
+    Used to backfill users who traded before user_metrics existed and to
+    repair drift. Returns None if the user has no trades.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            return await _rebuild_user_metrics(conn, user_id)
+
+async def get_user_metrics_row(user_id: str) -> Optional[Dict]:
+    """
+    Get a user's aggregate metrics row
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            SELECT user_id, total_trades, buy_count, sell_count,
+                   buy_value, sell_value, first_trade_at, last_trade_at, updated_at
+            FROM user_metrics
+            WHERE user_id = $1
+        """
+
+        row = await conn.fetchrow(query, user_id)
+        return dict(row) if row else None
+
+async def get_trade_watermark(user_id: str) -> Optional[str]:
+    """
+    A marker that changes whenever a user's trades (or derived rows) change
+
+    Built from the user_metrics row, which ingest updates in the same
+    transaction as the trades, and the latest user_equity mark, which
+    moves when positions are marked to market; None for users without
+    a metrics row.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT m.total_trades, m.updated_at,
+                   (SELECT MAX(e.marked_at) FROM user_equity e WHERE e.user_id = m.user_id) AS marked_at
+            FROM user_metrics m
+            WHERE m.user_id = $1
+            """,
+            user_id
+        )
+    if row is None:
+        return None
+    updated_at = row["updated_at"].isoformat() if row["updated_at"] else ""
+    marked_at = row["marked_at"].isoformat() if row["marked_at"] else ""
+    return f"{row['total_trades']}@{updated_at}/{marked_at}"
+
+POSITION_COLUMNS = [
+    "user_id", "symbol", "cost_method", "quantity", "cost_basis", "lots",
+    "realized_pnl", "winning_closes", "losing_closes", "gross_profit",
+    "gross_loss", "trade_count", "buy_value", "sell_value", "last_price",
+    "last_trade_at"
+]
+
+def _as_utc(value: datetime) -> datetime:
+    """Treat naive timestamps as UTC, as asyncpg does when writing timestamptz"""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+async def _lock_positions(conn, user_id: str):
+    """Serialize position updates for one user within the transaction"""
+    await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", f"positions:{user_id}")
+
+async def _upsert_positions(conn, user_id: str, positions: List[lots.Position]):
+    if not positions:
+        return
+
+    assignments = ",\n            ".join(
+        f"{column} = EXCLUDED.{column}" for column in POSITION_COLUMNS[3:]
+    )
+    placeholders = ", ".join(f"${n}" for n in range(1, len(POSITION_COLUMNS) + 1))
+    query = f"""
+        INSERT INTO user_positions ({", ".join(POSITION_COLUMNS)}, updated_at)
+        VALUES ({placeholders}, now())
+        ON CONFLICT (user_id, cost_method, symbol)
+        DO UPDATE SET
+            {assignments},
+            updated_at = now()
+    """
+
+    records = []
+    for position in positions:
+        record = {"user_id": user_id, **position.to_record()}
+        records.append([record[column] for column in POSITION_COLUMNS])
+    await conn.executemany(query, records)
+
+async def _rebuild_positions(conn, user_id: str, symbol: Optional[str] = None) -> List[lots.Position]:
+    """
+    Replay a user's trade history (optionally one symbol) into user_positions
+
+    The caller holds the user's position lock.
+    """
+    method = lots.COST_BASIS_METHOD
+    params = [user_id]
+    symbol_clause = ""
+    if symbol is not None:
+        params.append(symbol)
+        symbol_clause = " AND symbol = $2"
+
+    rows = await conn.fetch(f"""
+        SELECT symbol, side, qty, price, executed_at
+        FROM trades
+        WHERE user_id = $1{symbol_clause}
+        ORDER BY executed_at, created_at, id
+    """, *params)
+
+    if symbol is None:
+        await conn.execute(
+            "DELETE FROM user_positions WHERE user_id = $1 AND cost_method = $2",
+            user_id, method
+        )
+
+    positions = list(lots.build_positions(rows, method).values())
+    await _upsert_positions(conn, user_id, positions)
+    return positions
+
+async def _apply_position_updates(conn, trades: List[Dict]):
+    """
+    Match newly inserted trades against stored lots inside the caller's transaction
+
+    Trades at or after a position's last trade are applied incrementally.
+    A trade that arrives out of order replays that symbol's history, and a
+    user with no stored positions yet (first trade, or trades that predate
+    the table) is replayed in full. The users' equity snapshots are then
+    refreshed from their positions.
+    """
+    method = lots.COST_BASIS_METHOD
+    trades_by_user: Dict[str, Dict[str, List[Dict]]] = {}
+    for t in trades:
+        trades_by_user.setdefault(str(t["user_id"]), {}).setdefault(t["symbol"], []).append(t)
+
+    for user_id in sorted(trades_by_user):
+        await _lock_positions(conn, user_id)
+        rows = await conn.fetch(f"""
+            SELECT {", ".join(POSITION_COLUMNS)}
+            FROM user_positions
+            WHERE user_id = $1 AND cost_method = $2
+        """, user_id, method)
+        if not rows:
+            await _rebuild_positions(conn, user_id)
+            continue
+
+        stored = {row["symbol"]: row for row in rows}
+        updated = []
+        for symbol, new_trades in trades_by_user[user_id].items():
+            new_trades = sorted(new_trades, key=lambda t: _as_utc(t["executed_at"]))
+            row = stored.get(symbol)
+            if row is None or (
+                row["last_trade_at"] is not None
+                and _as_utc(new_trades[0]["executed_at"]) < row["last_trade_at"]
+            ):
+                await _rebuild_positions(conn, user_id, symbol)
+                continue
+
+            position = lots.Position.from_row(row)
+            for t in new_trades:
+                position.apply(t["side"], t["qty"], t["price"], t["executed_at"])
+            updated.append(position)
+
+        await _upsert_positions(conn, user_id, updated)
+
+    await _refresh_equity(conn, sorted(trades_by_user))
+
+async def rebuild_user_positions(user_id: str) -> List[Dict]:
+    """
+    Rebuild a user's positions from their full trade history
+
+    Used to backfill users who traded before user_positions existed, after
+    changing COST_BASIS_METHOD, and to repair drift.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await _lock_positions(conn, user_id)
+            positions = await _rebuild_positions(conn, user_id)
+            await _refresh_equity(conn, [user_id])
+    return [{"user_id": user_id, **position.to_record()} for position in positions]
+
+async def get_user_positions(user_id: str) -> List[Dict]:
+    """
+    Get a user's stored positions for the configured cost basis method
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(f"""
+            SELECT {", ".join(POSITION_COLUMNS)}, updated_at
+            FROM user_positions
+            WHERE user_id = $1 AND cost_method = $2
+            ORDER BY symbol
+        """, user_id, lots.COST_BASIS_METHOD)
+        return [dict(row) for row in rows]
+
+# Aggregates user_positions into user_equity for the users matched by
+# {where}. Open positions are marked at the newest cached close on or after
+# their last trade day, falling back to the last traded price. A snapshot
+# computed from positions older than the stored one is discarded, so a
+# mark-to-market pass racing an ingest cannot overwrite the newer totals.
+EQUITY_UPSERT = """
+    INSERT INTO user_equity (
+        user_id, cost_method, realized_pnl, cost_basis, long_value,
+        short_value, open_positions, positions_updated_at, marked_at
+    )
+    SELECT p.user_id, p.cost_method,
+           SUM(p.realized_pnl),
+           SUM(p.cost_basis),
+           SUM(GREATEST(p.quantity, 0) * mark.price),
+           SUM(LEAST(p.quantity, 0) * mark.price),
+           COUNT(*) FILTER (WHERE p.quantity <> 0),
+           MAX(p.updated_at),
+           now()
+    FROM user_positions p
+    CROSS JOIN LATERAL (
+        SELECT COALESCE((
+            SELECT b.close
+            FROM benchmarks b
+            WHERE p.quantity <> 0
+              AND b.symbol = p.symbol
+              AND b.date >= (p.last_trade_at AT TIME ZONE 'UTC')::date
+              AND b.close IS NOT NULL
+            ORDER BY b.date DESC
+            LIMIT 1
+        ), p.last_price, 0) AS price
+    ) mark
+    WHERE p.cost_method = $1 AND {where}
+    GROUP BY p.user_id, p.cost_method
+    ON CONFLICT (user_id, cost_method)
+    DO UPDATE SET
+        realized_pnl = EXCLUDED.realized_pnl,
+        cost_basis = EXCLUDED.cost_basis,
+        long_value = EXCLUDED.long_value,
+        short_value = EXCLUDED.short_value,
+        open_positions = EXCLUDED.open_positions,
+        positions_updated_at = EXCLUDED.positions_updated_at,
+        marked_at = EXCLUDED.marked_at
+    WHERE user_equity.positions_updated_at IS NULL
+       OR EXCLUDED.positions_updated_at >= user_equity.positions_updated_at
+"""
+
+async def _refresh_equity(conn, user_ids: List[str]):
+    """Recompute the equity snapshots of the given users from their positions"""
+    await conn.execute(
+        EQUITY_UPSERT.format(where="p.user_id = ANY($2::uuid[])"),
+        lots.COST_BASIS_METHOD, user_ids
+    )
+
+async def refresh_user_equity(user_id: str) -> Optional[Dict]:
+    """
+    Recompute one user's equity snapshot from their stored positions
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await _refresh_equity(conn, [user_id])
+    return await get_user_equity(user_id)
+
+async def mark_equity_to_market(symbols: Optional[List[str]] = None) -> int:
+    """
+    Re-mark the equity snapshots of users holding any of symbols
+
+    Called after cached prices change; None re-marks every user. The
+    users' leaderboard rows are flagged stale too, since their PnL is
+    marked at the same prices. Returns the number of snapshots written.
+    """
+    if symbols is None:
+        where, params = "TRUE", []
+    else:
+        where = """p.user_id IN (
+            SELECT user_id FROM user_positions
+            WHERE cost_method = $1 AND quantity <> 0 AND symbol = ANY($2)
+        )"""
+        params = [symbols]
+
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        status = await conn.execute(
+            EQUITY_UPSERT.format(where=where), lots.COST_BASIS_METHOD, *params
+        )
+        await conn.execute(
+            f"""
+            UPDATE user_metrics SET leaderboard_stale = true
+            WHERE NOT leaderboard_stale AND user_id IN (
+                SELECT p.user_id FROM user_positions p WHERE p.cost_method = $1 AND {where}
+            )
+            """,
+            lots.COST_BASIS_METHOD, *params
+        )
+    return int(status.split()[-1])
+
+async def get_user_equity(user_id: str) -> Optional[Dict]:
+    """
+    Get a user's equity snapshot for the configured cost basis method
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT user_id, cost_method, realized_pnl, cost_basis, long_value,
+                   short_value, open_positions, positions_updated_at, marked_at
+            FROM user_equity
+            WHERE user_id = $1 AND cost_method = $2
+        """, user_id, lots.COST_BASIS_METHOD)
+        return dict(row) if row else None
+
+def _trade_day_deltas(trades: List[Dict]) -> Dict[tuple, List[int]]:
+    """Aggregate trades into (user_id, UTC date, symbol) buy/sell increments"""
+    deltas: Dict[tuple, List[int]] = {}
+    for t in trades:
+        key = (str(t["user_id"]), _as_utc(t["executed_at"]).date(), t["symbol"])
+        delta = deltas.setdefault(key, [0, 0])
+        side = t["side"].lower()
+        if side == "buy":
+            delta[0] += 1
+        elif side == "sell":
+            delta[1] += 1
+    return deltas
+
+async def _apply_trade_day_counts(conn, trades: List[Dict]):
+    """
+    Add newly inserted trades to user_trade_days inside the caller's transaction
+
+    Counts are plain increments, so trades may arrive in any order.
+    """
+    query = """
+        INSERT INTO user_trade_days (user_id, trade_date, symbol, buy_count, sell_count)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (user_id, trade_date, symbol)
+        DO UPDATE SET
+            buy_count = user_trade_days.buy_count + EXCLUDED.buy_count,
+            sell_count = user_trade_days.sell_count + EXCLUDED.sell_count
+    """
+    records = [
+        (user_id, trade_date, symbol, buys, sells)
+        for (user_id, trade_date, symbol), (buys, sells) in sorted(_trade_day_deltas(trades).items())
+    ]
+    if records:
+        await conn.executemany(query, records)
+
+async def get_day_trade_counts(user_id: str, start_date: date, end_date: date) -> Dict[date, int]:
+    """
+    Get a user's day trade count per date between two dates (inclusive)
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            SELECT trade_date, SUM(LEAST(buy_count, sell_count)) AS day_trades
+            FROM user_trade_days
+            WHERE user_id = $1 AND trade_date BETWEEN $2 AND $3
+            GROUP BY trade_date
+        """
+
+        rows = await conn.fetch(query, user_id, start_date, end_date)
+        return {row["trade_date"]: int(row["day_trades"]) for row in rows}
+
+async def rebuild_trade_days(user_id: Optional[str] = None, since: Optional[date] = None) -> int:
+    """
+    Rebuild user_trade_days from the trades table
+
+    Optionally limited to one user and/or to dates on or after since.
+    Ingest is blocked from updating counts while the rebuild runs so no
+    increment is lost or applied twice. Returns the number of rows written.
+    """
+    delete_filters, delete_params = [], []
+    trade_filters, trade_params = [], []
+    if user_id is not None:
+        delete_params.append(user_id)
+        delete_filters.append(f"user_id = ${len(delete_params)}")
+        trade_params.append(user_id)
+        trade_filters.append(f"user_id = ${len(trade_params)}")
+    if since is not None:
+        delete_params.append(since)
+        delete_filters.append(f"trade_date >= ${len(delete_params)}")
+        trade_params.append(datetime.combine(since, time.min, tzinfo=timezone.utc))
+        trade_filters.append(f"executed_at >= ${len(trade_params)}")
+
+    delete_where = f"WHERE {' AND '.join(delete_filters)}" if delete_filters else ""
+    trade_where = f"WHERE {' AND '.join(trade_filters)}" if trade_filters else ""
+
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("LOCK TABLE user_trade_days IN EXCLUSIVE MODE")
+            await conn.execute(f"DELETE FROM user_trade_days {delete_where}", *delete_params)
+            status = await conn.execute(f"""
+                INSERT INTO user_trade_days (user_id, trade_date, symbol, buy_count, sell_count)
+                SELECT user_id,
+                       (executed_at AT TIME ZONE 'UTC')::date AS trade_date,
+                       symbol,
+                       COUNT(*) FILTER (WHERE LOWER(side) = 'buy'),
+                       COUNT(*) FILTER (WHERE LOWER(side) = 'sell')
+                FROM trades
+                {trade_where}
+                GROUP BY 1, 2, 3
+            """, *trade_params)
+            return int(status.split()[-1])
+
+async def has_trade_days() -> bool:
+    """Whether user_trade_days holds any rows"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT EXISTS (SELECT 1 FROM user_trade_days)")
+
+def _executed_at_range(
+    params: List,
+    start_date: Optional[date],
+    end_date: Optional[date]
+) -> str:
+    """
+    Build an index-friendly executed_at filter for an inclusive date range
+
+    Dates become a half-open UTC timestamp range
+    (executed_at >= start 00:00, executed_at < day after end 00:00) rather
+    than DATE(executed_at) comparisons, so Postgres can use the
+    (user_id, executed_at) index. Appends the bound values to params.
+    """
+    clause = ""
+    if start_date:
+        params.append(datetime.combine(start_date, time.min, tzinfo=timezone.utc))
+        clause += f" AND executed_at >= ${len(params)}"
+
+    if end_date:
+        params.append(datetime.combine(end_date + timedelta(days=1), time.min, tzinfo=timezone.utc))
+        clause += f" AND executed_at < ${len(params)}"
+
+    return clause
 
 async def get_user_trades(
     user_id: str,
@@ -86,13 +711,119 @@ async def get_user_trades(
         """
         params = [user_id]
 
-        if start_date:
-            query += " AND DATE(executed_at) >= $2"
-            params.append(start_date)
+        query += _executed_at_range(params, start_date, end_date)
 
-        if end_date:
-            query += f" AND DATE(executed_at) <= ${len(params) + 1}"
-            params.append(end_date)
+        query += " ORDER BY executed_at ASC"
+
+        rows = await conn.fetch(query, *params)
+        return [dict(row) for row in rows]
+
+# Column names and dtypes produced by fetch_user_trades_columns()
+TRADE_COLUMN_DTYPES = {
+    "id": str,
+    "symbol": "category",
+    "side": "category",
+    "qty": np.float64,
+    "price": np.float64,
+    "executed_at": np.int64
+}
+
+async def fetch_user_trades_columns(
+    user_id: str,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
+) -> Dict[str, object]:
+    """
+    Get a user's trades as typed columns instead of per-row dicts
+
+    Rows are streamed with COPY ... TO STDOUT and parsed in one pass, so no
+    Record or dict is built per trade. Returns, in execution order:
+        id: object array of str
+        symbol, side: pandas Categorical (side lowercased)
+        qty, price: float64 arrays
+        executed_at: datetime64[us] array (UTC)
+    """
+    query = """
+        SELECT id, symbol, LOWER(side), qty::float8, price::float8,
+               (EXTRACT(EPOCH FROM executed_at) * 1000000)::bigint
+        FROM trades
+        WHERE user_id = $1
+    """
+    params = [user_id]
+
+    query += _executed_at_range(params, start_date, end_date)
+
+    query += " ORDER BY executed_at ASC"
+
+    buf = io.BytesIO()
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await conn.copy_from_query(query, *params, output=buf, format="csv")
+
+    buf.seek(0)
+    if buf.getbuffer().nbytes:
+        frame = pd.read_csv(
+            buf,
+            header=None,
+            names=list(TRADE_COLUMN_DTYPES),
+            dtype=TRADE_COLUMN_DTYPES
+        )
+    else:
+        frame = pd.DataFrame({
+            name: pd.Series(dtype=dtype) for name, dtype in TRADE_COLUMN_DTYPES.items()
+        })
+
+    return {
+        "id": frame["id"].to_numpy(dtype=object),
+        "symbol": frame["symbol"].array,
+        "side": frame["side"].array,
+        "qty": frame["qty"].to_numpy(),
+        "price": frame["price"].to_numpy(),
+        "executed_at": frame["executed_at"].to_numpy().astype("datetime64[us]")
+    }
+
+async def get_trades_by_ids(user_id: str, trade_ids: List[str]) -> List[Dict]:
+    """
+    Get specific trades of a user by id, in execution order
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            SELECT id, user_id, symbol, side, qty, price, executed_at
+            FROM trades
+            WHERE user_id = $1
+              AND id = ANY($2::uuid[])
+            ORDER BY executed_at ASC
+        """
+
+        rows = await conn.fetch(query, user_id, list(trade_ids))
+        return [dict(row) for row in rows]
+
+async def get_user_buys(
+    user_id: str,
+    symbols: List[str],
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
+) -> List[Dict]:
+    """
+    Get a user's buys of the given symbols within a date range
+
+    Served by the (user_id, symbol, executed_at) index; used for wash sale
+    lookups, which only need repurchases of the symbols being sold.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            SELECT id, user_id, symbol, side, qty, price,
+                   (qty * price) as value, executed_at, created_at
+            FROM trades
+            WHERE user_id = $1
+              AND symbol = ANY($2::text[])
+              AND LOWER(side) = 'buy'
+        """
+        params = [user_id, list(symbols)]
+
+        query += _executed_at_range(params, start_date, end_date)
 
         query += " ORDER BY executed_at ASC"
 
@@ -116,11 +847,11 @@ async def get_recent_trades(
             FROM trades
             WHERE user_id = $1
               AND symbol = $2
-              AND executed_at >= NOW() - INTERVAL '%s minutes'
+              AND executed_at >= NOW() - make_interval(mins => $3)
             ORDER BY executed_at DESC
-        """ % minutes
+        """
 
-        rows = await conn.fetch(query, user_id, symbol)
+        rows = await conn.fetch(query, user_id, symbol, minutes)
         return [dict(row) for row in rows]
 
 async def fetch_trades_for_user(user_id: str) -> List[Dict]:
@@ -161,16 +892,6 @@ async def insert_compliance_audit(
     }
     return await create_compliance_audit(audit_data)
 
-async def cache_user_metrics(user_id: str, metrics: Dict):
-    """
-    Cache computed user metrics for fast retrieval
-    TODO: Implement Redis caching or database table
-    """
-    # For now, just log the metrics
-    # In production, store in Redis or a metrics table
-    print(f"Caching metrics for user {user_id}: {metrics}")
-    return metrics
-
 async def create_compliance_audit(audit_data: Dict) -> Dict:
     """
     Create a compliance audit record
@@ -202,6 +923,43 @@ async def create_compliance_audit(audit_data: Dict) -> Dict:
 
         return dict(row)
 
+async def create_compliance_audits_bulk(audits: List[Dict]) -> int:
+    """
+    Create many compliance audit records with a single COPY
+    """
+    if not audits:
+        return 0
+
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await _copy_compliance_audits(conn, audits)
+
+async def _copy_compliance_audits(conn, audits: List[Dict]) -> int:
+    records = [
+        (
+            uuid4(),
+            audit_data.get("user_id"),
+            audit_data.get("trade_id"),
+            audit_data["check_name"],
+            audit_data["status"],
+            audit_data.get("reason"),
+            json.dumps(audit_data.get("metadata", {})),
+            audit_data.get("created_at") or datetime.utcnow()
+        )
+        for audit_data in audits
+    ]
+
+    await conn.copy_records_to_table(
+        "compliance_audit",
+        records=records,
+        columns=[
+            "id", "user_id", "trade_id", "check_name", "status",
+            "reason", "metadata", "created_at"
+        ]
+    )
+
+    return len(records)
+
 async def get_compliance_audits(
     user_id: str,
     limit: int = 100
@@ -223,6 +981,39 @@ async def get_compliance_audits(
         rows = await conn.fetch(query, user_id, limit)
         return [dict(row) for row in rows]
 
+async def get_compliance_rules() -> List[Dict]:
+    """
+    Get enabled custom compliance rules in definition order
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            SELECT name, check_type, threshold, symbols, message
+            FROM compliance_rules
+            WHERE enabled
+            ORDER BY id
+        """
+
+        rows = await conn.fetch(query)
+        return [
+            {**dict(row), "threshold": float(row["threshold"]), "symbols": list(row["symbols"])}
+            for row in rows
+        ]
+
+async def get_compliance_rules_version() -> tuple:
+    """
+    Change marker for compliance_rules: row count and latest update
+
+    updated_at is maintained by the compliance_rules_touch trigger, so
+    edits change the marker as well as inserts and deletes.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT COUNT(*) AS rules, MAX(updated_at) AS updated_at FROM compliance_rules"
+        )
+        return (row["rules"], row["updated_at"])
+
 async def get_or_create_benchmark(symbol: str, date: date) -> Optional[Dict]:
     """
     Get benchmark data for a symbol on a specific date
@@ -271,7 +1062,81 @@ async def upsert_benchmark(benchmark_data: Dict) -> Dict:
             datetime.utcnow()
         )
 
-        return dict(row)
+    # Imported here because benchmark_cache depends on this module
+    from . import benchmark_cache
+    benchmark_cache.invalidate(benchmark_data["symbol"])
+
+    return dict(row)
+
+async def upsert_benchmarks_bulk(bars: List[Dict]) -> int:
+    """
+    Insert or update many benchmark bars in one transaction
+
+    Bars are loaded with COPY into a temporary table and merged with a
+    single INSERT ... ON CONFLICT, instead of one round trip per bar.
+    Duplicate (symbol, date) bars within the batch keep the last one.
+    Returns the number of bars written.
+    """
+    if not bars:
+        return 0
+
+    now = datetime.utcnow()
+    records = [
+        (
+            uuid4(),
+            index,
+            bar["symbol"],
+            bar["date"],
+            bar.get("open"),
+            bar.get("high"),
+            bar.get("low"),
+            bar["close"],
+            bar.get("volume"),
+            now
+        )
+        for index, bar in enumerate(bars)
+    ]
+
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                CREATE TEMP TABLE benchmarks_staging (
+                    id UUID,
+                    seq INTEGER,
+                    symbol TEXT,
+                    date DATE,
+                    open NUMERIC,
+                    high NUMERIC,
+                    low NUMERIC,
+                    close NUMERIC,
+                    volume NUMERIC,
+                    created_at TIMESTAMPTZ
+                ) ON COMMIT DROP
+            """)
+            await conn.copy_records_to_table("benchmarks_staging", records=records)
+
+            status = await conn.execute("""
+                INSERT INTO benchmarks (id, symbol, date, open, high, low, close, volume, created_at)
+                SELECT DISTINCT ON (symbol, date)
+                       id, symbol, date, open, high, low, close, volume, created_at
+                FROM benchmarks_staging
+                ORDER BY symbol, date, seq DESC
+                ON CONFLICT (symbol, date)
+                DO UPDATE SET
+                    open = EXCLUDED.open,
+                    high = EXCLUDED.high,
+                    low = EXCLUDED.low,
+                    close = EXCLUDED.close,
+                    volume = EXCLUDED.volume
+            """)
+
+    # Imported here because benchmark_cache depends on this module
+    from . import benchmark_cache
+    for symbol in {bar["symbol"] for bar in bars}:
+        benchmark_cache.invalidate(symbol)
+
+    return int(status.split()[-1])
 
 async def get_benchmark_range(
     symbol: str,
@@ -295,6 +1160,91 @@ async def get_benchmark_range(
         rows = await conn.fetch(query, symbol, start_date, end_date)
         return [dict(row) for row in rows]
 
+async def get_benchmark_series(symbol: str) -> List[Dict]:
+    """
+    Get every cached daily close for a benchmark symbol, oldest first
+
+    Bars without a close are skipped.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            SELECT date, close
+            FROM benchmarks
+            WHERE symbol = $1 AND close IS NOT NULL
+            ORDER BY date ASC
+        """
+
+        rows = await conn.fetch(query, symbol)
+        return [dict(row) for row in rows]
+
+async def get_benchmark_series_many(symbols: List[str]) -> Dict[str, List[Dict]]:
+    """
+    Get every cached daily close for several symbols in one query, oldest first
+
+    Bars without a close are skipped; symbols without bars map to an
+    empty list.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            SELECT symbol, date, close
+            FROM benchmarks
+            WHERE symbol = ANY($1) AND close IS NOT NULL
+            ORDER BY symbol, date ASC
+        """
+
+        rows = await conn.fetch(query, symbols)
+
+    series = {symbol: [] for symbol in symbols}
+    for row in rows:
+        series[row["symbol"]].append({"date": row["date"], "close": row["close"]})
+    return series
+
+async def get_closes(symbols: List[str], start_date: date, end_date: date) -> Dict[str, np.ndarray]:
+    """
+    Get cached daily closes for many symbols in one query
+
+    Returns parallel arrays ordered by symbol and date:
+        symbol: pandas Categorical
+        date: datetime64[D] array
+        close: float64 array
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT symbol, date, close::float8 AS close
+            FROM benchmarks
+            WHERE symbol = ANY($1)
+              AND date >= $2
+              AND date <= $3
+              AND close IS NOT NULL
+            ORDER BY symbol, date
+        """, symbols, start_date, end_date)
+
+    return {
+        "symbol": pd.Categorical([r["symbol"] for r in rows]),
+        "date": np.array([r["date"] for r in rows], dtype="datetime64[D]"),
+        "close": np.array([r["close"] for r in rows], dtype=np.float64)
+    }
+
+async def get_benchmark_coverage(symbols: List[str]) -> Dict[str, Dict]:
+    """
+    Get the first and last cached bar date for each symbol
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            SELECT symbol, MIN(date) AS first_date, MAX(date) AS last_date,
+                   COUNT(*) AS bars
+            FROM benchmarks
+            WHERE symbol = ANY($1)
+            GROUP BY symbol
+        """
+
+        rows = await conn.fetch(query, symbols)
+        return {row["symbol"]: dict(row) for row in rows}
+
 async def update_user_subscription(user_id: str, subscription_data: Dict):
     """
     Update or create user subscription record
@@ -371,6 +1321,536 @@ async def handle_stripe_event(payload: Dict) -> Dict:
         "event_type": event_type
     }
 
+async def _enqueue_job(
+    conn,
+    kind: str,
+    user_id: str,
+    trade_ids: Optional[List] = None,
+    delay_seconds: float = 0,
+    attempts: int = 0,
+    last_error: Optional[str] = None
+):
+    """
+    Enqueue a job, merging into the user's pending job of the same kind
+
+    Pending jobs are unique per (kind, user_id), so a burst of trades for
+    one user accumulates trade_ids on a single job.
+    """
+    query = """
+        INSERT INTO analytics_jobs (kind, user_id, payload, attempts, run_after, last_error)
+        VALUES ($1, $2, $3, $4, now() + make_interval(secs => $5), $6)
+        ON CONFLICT (kind, user_id) WHERE status = 'pending'
+        DO UPDATE SET
+            payload = jsonb_build_object(
+                'trade_ids',
+                COALESCE(analytics_jobs.payload->'trade_ids', '[]'::jsonb)
+                    || COALESCE(EXCLUDED.payload->'trade_ids', '[]'::jsonb)
+            ),
+            attempts = GREATEST(analytics_jobs.attempts, EXCLUDED.attempts),
+            last_error = COALESCE(EXCLUDED.last_error, analytics_jobs.last_error),
+            updated_at = now()
+    """
+
+    payload = {"trade_ids": [str(trade_id) for trade_id in trade_ids or []]}
+    await conn.execute(
+        query, kind, user_id, json.dumps(payload), attempts, float(delay_seconds), last_error
+    )
+
+async def enqueue_job(kind: str, user_id: str, trade_ids: Optional[List] = None):
+    """
+    Enqueue a job for a user (coalesced with any pending job of that kind)
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await _enqueue_job(conn, kind, user_id, trade_ids)
+
+async def claim_jobs(limit: int, visibility_timeout: float) -> List[Dict]:
+    """
+    Claim due jobs for this worker with FOR UPDATE SKIP LOCKED
+
+    Also reclaims running jobs whose visibility timeout expired (their
+    worker died or stalled). Claimed jobs are hidden from other workers
+    until the timeout passes.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        query = """
+            UPDATE analytics_jobs SET
+                status = 'running',
+                attempts = attempts + 1,
+                locked_until = now() + make_interval(secs => $2),
+                updated_at = now()
+            WHERE id IN (
+                SELECT id
+                FROM analytics_jobs
+                WHERE (status = 'pending' AND run_after <= now())
+                   OR (status = 'running' AND locked_until < now())
+                ORDER BY run_after
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, user_id, payload, attempts, max_attempts
+        """
+
+        rows = await conn.fetch(query, limit, float(visibility_timeout))
+        return [{**dict(row), "payload": json.loads(row["payload"])} for row in rows]
+
+# A claim is identified by the job id and its attempt number: reclaiming
+# a job after its visibility timeout increments attempts, so the previous
+# worker's lease no longer matches
+JOB_LEASE = "id = $1 AND status = 'running' AND attempts = $2"
+
+async def extend_job_lease(job: Dict, visibility_timeout: float) -> bool:
+    """
+    Push back a claimed job's visibility timeout while it is still running
+
+    Returns False if the claim was lost (the job was reclaimed).
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        status = await conn.execute(f"""
+            UPDATE analytics_jobs SET
+                locked_until = now() + make_interval(secs => $3),
+                updated_at = now()
+            WHERE {JOB_LEASE}
+        """, job["id"], job["attempts"], float(visibility_timeout))
+        return status != "UPDATE 0"
+
+async def complete_job(job: Dict, audits: Optional[List[Dict]] = None) -> bool:
+    """
+    Remove a successfully processed job
+
+    The job's compliance audit rows are copied in the same transaction, so
+    they are stored exactly when the job is no longer retried. Nothing is
+    written if the claim was lost to another worker, which stores the
+    audits of its own run; returns False in that case.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            status = await conn.execute(
+                f"DELETE FROM analytics_jobs WHERE {JOB_LEASE}", job["id"], job["attempts"]
+            )
+            if status == "DELETE 0":
+                return False
+            if audits:
+                await _copy_compliance_audits(conn, audits)
+            return True
+
+async def fail_job(job: Dict, error: str, retry_delay: float):
+    """
+    Record a failed attempt
+
+    The job is rescheduled after retry_delay (merging into any pending job
+    for the same user) until max_attempts is reached, then marked failed.
+    Ignored if the claim was lost to another worker.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if job["attempts"] >= job["max_attempts"]:
+                await conn.execute(f"""
+                    UPDATE analytics_jobs SET
+                        status = 'failed',
+                        locked_until = NULL,
+                        last_error = $3,
+                        updated_at = now()
+                    WHERE {JOB_LEASE}
+                """, job["id"], job["attempts"], error)
+                return
+
+            status = await conn.execute(
+                f"DELETE FROM analytics_jobs WHERE {JOB_LEASE}", job["id"], job["attempts"]
+            )
+            if status == "DELETE 0":
+                return
+            await _enqueue_job(
+                conn,
+                job["kind"],
+                job["user_id"],
+                job["payload"].get("trade_ids"),
+                delay_seconds=retry_delay,
+                attempts=job["attempts"],
+                last_error=error
+            )
+
+RESCREEN_COLUMNS = """
+    id, status, params, include_passes, cursor_user_id, total_users,
+    users_done, trades_screened, audits_written, flagged, last_error,
+    started_at, updated_at, finished_at
+"""
+
+def _rescreen_row(row) -> Optional[Dict]:
+    if row is None:
+        return None
+    run = dict(row)
+    run["params"] = json.loads(run["params"])
+    return run
+
+async def count_trade_users() -> int:
+    """Number of distinct users with trades"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT COUNT(DISTINCT user_id) FROM trades")
+
+async def get_trade_user_ids_after(after_user_id: Optional[str], limit: int) -> List[str]:
+    """
+    Next users with trades in user_id order, after the given one
+
+    Walks the (user_id, executed_at) index with one index probe per user
+    (a recursive "skip scan") instead of a DISTINCT over every trade.
+    """
+    params = [limit]
+    first_filter = ""
+    if after_user_id is not None:
+        params.append(after_user_id)
+        first_filter = "WHERE user_id > $2"
+
+    query = f"""
+        WITH RECURSIVE users AS (
+            (SELECT user_id FROM trades {first_filter} ORDER BY user_id LIMIT 1)
+            UNION ALL
+            SELECT (SELECT t.user_id FROM trades t
+                    WHERE t.user_id > users.user_id
+                    ORDER BY t.user_id LIMIT 1)
+            FROM users
+            WHERE users.user_id IS NOT NULL
+        )
+        SELECT user_id FROM users WHERE user_id IS NOT NULL LIMIT $1
+    """
+
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(query, *params)
+        return [str(row["user_id"]) for row in rows]
+
+async def create_rescreen(params: Dict, include_passes: bool, total_users: int) -> Dict:
+    """Record a new re-screening run"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(f"""
+            INSERT INTO compliance_rescreens (params, include_passes, total_users)
+            VALUES ($1, $2, $3)
+            RETURNING {RESCREEN_COLUMNS}
+        """, json.dumps(params), include_passes, total_users)
+        return _rescreen_row(row)
+
+async def get_rescreen(run_id: int) -> Optional[Dict]:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            f"SELECT {RESCREEN_COLUMNS} FROM compliance_rescreens WHERE id = $1", run_id
+        )
+        return _rescreen_row(row)
+
+async def save_rescreen_page(
+    run_id: int,
+    audits: List[Dict],
+    cursor_user_id: str,
+    users: int,
+    trades: int,
+    flagged: int
+) -> Dict:
+    """
+    Write a page of re-screening audits and advance the run's cursor atomically
+
+    A run interrupted mid-page therefore resumes by redoing that page,
+    without duplicating audit rows.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            written = await _copy_compliance_audits(conn, audits) if audits else 0
+            row = await conn.fetchrow(f"""
+                UPDATE compliance_rescreens SET
+                    status = 'running',
+                    cursor_user_id = $2,
+                    users_done = users_done + $3,
+                    trades_screened = trades_screened + $4,
+                    audits_written = audits_written + $5,
+                    flagged = flagged + $6,
+                    updated_at = now()
+                WHERE id = $1
+                RETURNING {RESCREEN_COLUMNS}
+            """, run_id, cursor_user_id, users, trades, written, flagged)
+            return _rescreen_row(row)
+
+async def finish_rescreen(run_id: int, status: str, error: Optional[str] = None) -> Optional[Dict]:
+    """Mark a run completed, failed or paused"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(f"""
+            UPDATE compliance_rescreens SET
+                status = $2,
+                last_error = $3,
+                updated_at = now(),
+                finished_at = CASE WHEN $2 = 'completed' THEN now() END
+            WHERE id = $1
+            RETURNING {RESCREEN_COLUMNS}
+        """, run_id, status, error)
+        return _rescreen_row(row)
+
+async def try_session_lock(key: str):
+    """
+    Take a session-level advisory lock without waiting
+
+    Returns the connection holding the lock (release it with
+    release_session_lock), or None if another session holds it.
+    """
+    pool = await get_pool()
+    conn = await pool.acquire()
+    try:
+        locked = await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", key)
+    except Exception:
+        await pool.release(conn)
+        raise
+    if not locked:
+        await pool.release(conn)
+        return None
+    return conn
+
+async def release_session_lock(conn, key: str):
+    try:
+        await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", key)
+    finally:
+        await (await get_pool()).release(conn)
+
+async def try_lock_rescreen(run_id: int):
+    """
+    Take the session lock that marks a run as executing
+
+    Returns the connection holding the lock (release it with
+    unlock_rescreen), or None if another process is executing the run.
+    """
+    return await try_session_lock(f"rescreen:{run_id}")
+
+async def unlock_rescreen(conn, run_id: int):
+    await release_session_lock(conn, f"rescreen:{run_id}")
+
+LEADERBOARD_COLUMNS = "user_id, trade_count, buy_value, sell_value, profit, return_percent, last_trade_at"
+
+# Per-user mark-to-market PnL over the window: window cash flows plus the
+# change in market value of each stored position, whose quantity at the
+# window start is today's minus the window's net buys. Open quantities are
+# marked like EQUITY_UPSERT; holdings at the window start at the last close
+# before it (unchanged if none is cached). The return is that PnL over the
+# account equity at the window start (lots.STARTING_EQUITY plus earlier PnL).
+# The window's trades are read in one scan grouped by user and symbol;
+# {window} holds the executed_at bounds and {users} optionally narrows both
+# sides to a user list.
+LEADERBOARD_INSERT = """
+    INSERT INTO leaderboard ({columns}, refreshed_at)
+    SELECT user_id, trade_count, buy_value, sell_value, profit,
+           profit / (starting_equity + total_pnl - profit) * 100,
+           last_trade_at, now()
+    FROM (
+        SELECT p.user_id,
+               $3::numeric AS starting_equity,
+               COALESCE(SUM(w.trade_count), 0) AS trade_count,
+               COALESCE(SUM(w.buy_value), 0) AS buy_value,
+               COALESCE(SUM(w.sell_value), 0) AS sell_value,
+               SUM(
+                   COALESCE(w.sell_value, 0) - COALESCE(w.buy_value, 0)
+                   + p.quantity * mark.price
+                   - (p.quantity - COALESCE(w.net_qty, 0)) * COALESCE(opening.price, mark.price)
+               ) AS profit,
+               SUM(p.realized_pnl + p.quantity * mark.price - p.cost_basis) AS total_pnl,
+               MAX(w.last_trade_at) AS last_trade_at
+        FROM user_positions p
+        LEFT JOIN (
+            SELECT user_id, symbol,
+                   COUNT(*) AS trade_count,
+                   COALESCE(SUM(qty * price) FILTER (WHERE LOWER(side) = 'buy'), 0) AS buy_value,
+                   COALESCE(SUM(qty * price) FILTER (WHERE LOWER(side) = 'sell'), 0) AS sell_value,
+                   SUM(CASE WHEN LOWER(side) = 'buy' THEN qty ELSE -qty END) AS net_qty,
+                   MAX(executed_at) AS last_trade_at
+            FROM trades
+            WHERE TRUE{window} {users}
+            GROUP BY user_id, symbol
+        ) w ON w.user_id = p.user_id AND w.symbol = p.symbol
+        CROSS JOIN LATERAL (
+            SELECT COALESCE((
+                SELECT b.close
+                FROM benchmarks b
+                WHERE p.quantity <> 0
+                  AND b.symbol = p.symbol
+                  AND b.date >= (p.last_trade_at AT TIME ZONE 'UTC')::date
+                  AND b.close IS NOT NULL
+                ORDER BY b.date DESC
+                LIMIT 1
+            ), p.last_price, 0) AS price
+        ) mark
+        LEFT JOIN LATERAL (
+            SELECT b.close AS price
+            FROM benchmarks b
+            WHERE p.quantity <> COALESCE(w.net_qty, 0)
+              AND b.symbol = p.symbol
+              AND b.date < $4
+              AND b.close IS NOT NULL
+            ORDER BY b.date DESC
+            LIMIT 1
+        ) opening ON TRUE
+        WHERE p.cost_method = $1 {position_users}
+        GROUP BY p.user_id
+    ) totals
+    WHERE trade_count >= GREATEST($2, 1)
+      AND starting_equity + total_pnl - profit > 0
+"""
+
+def _leaderboard_insert(
+    window_start: date,
+    min_trades: int,
+    user_ids: Optional[List] = None
+) -> Tuple[str, List]:
+    """LEADERBOARD_INSERT and its arguments for all users or the given ones"""
+    params = [lots.COST_BASIS_METHOD, min_trades, lots.STARTING_EQUITY, window_start]
+    window = _executed_at_range(params, window_start, None)
+    users = position_users = ""
+    if user_ids is not None:
+        params.append(user_ids)
+        users = f"AND user_id = ANY(${len(params)}::uuid[])"
+        position_users = f"AND p.user_id = ANY(${len(params)}::uuid[])"
+    query = LEADERBOARD_INSERT.format(
+        columns=LEADERBOARD_COLUMNS, window=window, users=users, position_users=position_users
+    )
+    return query, params
+
+LEADERBOARD_STATE_UPSERT = """
+    INSERT INTO leaderboard_state (
+        id, window_start, benchmark, benchmark_return_percent, users,
+        full_refreshed_at, refreshed_at
+    )
+    VALUES (1, $1, $2, $3, $4, CASE WHEN $5 THEN now() END, now())
+    ON CONFLICT (id)
+    DO UPDATE SET
+        window_start = EXCLUDED.window_start,
+        benchmark = EXCLUDED.benchmark,
+        benchmark_return_percent = EXCLUDED.benchmark_return_percent,
+        users = EXCLUDED.users,
+        full_refreshed_at = COALESCE(EXCLUDED.full_refreshed_at, leaderboard_state.full_refreshed_at),
+        refreshed_at = EXCLUDED.refreshed_at
+    RETURNING window_start, benchmark,
+              benchmark_return_percent::float8 AS benchmark_return_percent,
+              users, full_refreshed_at, refreshed_at
+"""
+
+async def get_leaderboard_state() -> Optional[Dict]:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT window_start, benchmark,
+                   benchmark_return_percent::float8 AS benchmark_return_percent,
+                   users, full_refreshed_at, refreshed_at
+            FROM leaderboard_state
+            WHERE id = 1
+        """)
+        return dict(row) if row else None
+
+async def rebuild_leaderboard(
+    window_start: date,
+    min_trades: int,
+    benchmark: str,
+    benchmark_return: Optional[float]
+) -> Dict:
+    """
+    Recompute every user's leaderboard row from their stored positions and
+    one scan of the window's trades
+
+    Stale flags are cleared first, in their own short transaction, so
+    trades ingested during the scan stay flagged for the next incremental
+    refresh; window_start is nulled with them so a failed rebuild is
+    retried in full. The rebuild replaces rows with DELETE rather than
+    TRUNCATE, so readers keep seeing the previous snapshot until commit.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("UPDATE leaderboard_state SET window_start = NULL")
+            await conn.execute("UPDATE user_metrics SET leaderboard_stale = false WHERE leaderboard_stale")
+
+        async with conn.transaction():
+            await conn.execute("DELETE FROM leaderboard")
+            query, params = _leaderboard_insert(window_start, min_trades)
+            status = await conn.execute(query, *params)
+            users = int(status.split()[-1])
+            row = await conn.fetchrow(
+                LEADERBOARD_STATE_UPSERT,
+                window_start, benchmark, benchmark_return, users, True
+            )
+            return dict(row)
+
+async def refresh_leaderboard_users(
+    window_start: date,
+    min_trades: int,
+    benchmark: str,
+    benchmark_return: Optional[float]
+) -> Tuple[Dict, int]:
+    """
+    Recompute the leaderboard rows of users flagged stale since the last refresh
+
+    Claiming the flags, rewriting the rows and updating the user count
+    happen in one transaction, so a failure leaves the users flagged.
+    Returns (state, users refreshed).
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            rows = await conn.fetch("""
+                UPDATE user_metrics SET leaderboard_stale = false
+                WHERE leaderboard_stale
+                RETURNING user_id
+            """)
+            user_ids = [row["user_id"] for row in rows]
+            removed = inserted = 0
+            if user_ids:
+                status = await conn.execute("DELETE FROM leaderboard WHERE user_id = ANY($1)", user_ids)
+                removed = int(status.split()[-1])
+                query, params = _leaderboard_insert(window_start, min_trades, user_ids)
+                status = await conn.execute(query, *params)
+                inserted = int(status.split()[-1])
+            users = await conn.fetchval("SELECT users FROM leaderboard_state WHERE id = 1 FOR UPDATE")
+            row = await conn.fetchrow(
+                LEADERBOARD_STATE_UPSERT,
+                window_start, benchmark, benchmark_return, (users or 0) - removed + inserted, False
+            )
+            return dict(row), len(user_ids)
+
+async def get_leaderboard_top(limit: int) -> List[Dict]:
+    """Highest returns first (ties by user_id), from the return index"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT l.user_id, l.trade_count,
+                   l.buy_value::float8 AS buy_value, l.sell_value::float8 AS sell_value,
+                   l.profit::float8 AS profit, l.return_percent::float8 AS return_percent,
+                   l.last_trade_at
+            FROM leaderboard l
+            -- Qualified so the sort uses the index, not the float8 output column
+            ORDER BY l.return_percent DESC, l.user_id
+            LIMIT $1
+        """, limit)
+        return [dict(row) for row in rows]
+
+async def get_leaderboard_entry(user_id: str) -> Optional[Dict]:
+    """
+    A user's leaderboard row plus the number of users with a higher return
+
+    The count is an index range scan over the users ranked above.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT l.user_id, l.trade_count,
+                   l.buy_value::float8 AS buy_value, l.sell_value::float8 AS sell_value,
+                   l.profit::float8 AS profit, l.return_percent::float8 AS return_percent,
+                   l.last_trade_at,
+                   (SELECT COUNT(*) FROM leaderboard a
+                    WHERE a.return_percent > l.return_percent) AS above
+            FROM leaderboard l
+            WHERE l.user_id = $1
+        """, user_id)
+        return dict(row) if row else None
+
 async def close_pool():
     """Close database connection pool"""
     global _pool
@@ -0,0 +1,545 @@
+"""
+Daily equity curve engine
+Builds each user's end-of-day mark-to-market equity from trades and cached
+closes with NumPy, keeps running sums of the daily returns so risk metrics
+come from one pass, and extends cached curves as new days arrive
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from . import analytics_executor, db, lots
+
+# Business days per year used to annualize daily statistics
+TRADING_DAYS = 252
+
+# Annual risk-free rate for Sharpe and the Sortino target return
+RISK_FREE_RATE = float(os.getenv("RISK_FREE_RATE", "0.02"))
+
+# Maximum number of user curves held in memory (least recently used evicted)
+MAX_CURVES = int(os.getenv("EQUITY_CURVE_CACHE_SIZE", "256"))
+
+# Safety net for closes backfilled by other processes, which cannot
+# invalidate us; older curves are rebuilt from scratch
+CURVE_TTL_SECONDS = 3600
+
+
+class CurveState:
+    """Open quantity, last mark and cash at the end of one curve day"""
+
+    __slots__ = ("symbols", "qty", "marks", "cash")
+
+    def __init__(self, symbols: List[str], qty: np.ndarray, marks: np.ndarray, cash: float):
+        self.symbols = symbols
+        self.qty = qty
+        self.marks = marks
+        self.cash = cash
+
+    @classmethod
+    def empty(cls, cash: float) -> "CurveState":
+        return cls([], np.zeros(0), np.zeros(0), cash)
+
+
+class RiskAccumulator:
+    """
+    Running sums over a curve's daily returns
+
+    extended() folds more equity values in and returns a new accumulator,
+    so metrics for a curve that grows by a day cost one step, not a pass
+    over its whole history. Returns after a non-positive equity are
+    undefined and skipped.
+    """
+
+    __slots__ = (
+        "target", "start_equity", "last_equity", "count", "sum_returns",
+        "sum_squares", "sum_downside", "peak", "max_drawdown"
+    )
+
+    def __init__(self, start_equity: float, risk_free_rate: float = RISK_FREE_RATE):
+        # Daily target return for Sortino's downside deviation
+        self.target = risk_free_rate / TRADING_DAYS
+        self.start_equity = start_equity
+        self.last_equity = start_equity
+        self.count = 0
+        self.sum_returns = 0.0
+        self.sum_squares = 0.0
+        self.sum_downside = 0.0
+        self.peak = start_equity
+        self.max_drawdown = 0.0
+
+    def extended(self, equity: np.ndarray) -> "RiskAccumulator":
+        result = RiskAccumulator.__new__(RiskAccumulator)
+        for name in RiskAccumulator.__slots__:
+            setattr(result, name, getattr(self, name))
+        if not len(equity):
+            return result
+
+        previous = np.concatenate(([self.last_equity], equity[:-1]))
+        valid = previous > 0
+        returns = equity[valid] / previous[valid] - 1
+        downside = np.minimum(returns - self.target, 0.0)
+
+        peaks = np.maximum.accumulate(np.concatenate(([self.peak], equity)))[1:]
+        drawdowns = np.where(peaks > 0, equity / np.where(peaks > 0, peaks, 1) - 1, 0.0)
+
+        result.last_equity = float(equity[-1])
+        result.count = self.count + len(returns)
+        result.sum_returns = self.sum_returns + float(returns.sum())
+        result.sum_squares = self.sum_squares + float((returns * returns).sum())
+        result.sum_downside = self.sum_downside + float((downside * downside).sum())
+        result.peak = float(peaks[-1])
+        result.max_drawdown = min(self.max_drawdown, float(drawdowns.min()))
+        return result
+
+    def metrics(self) -> Dict:
+        """Annualized return and risk statistics; None where undefined"""
+        n = self.count
+        mean = self.sum_returns / n if n else 0.0
+        variance = (self.sum_squares - n * mean * mean) / (n - 1) if n > 1 else 0.0
+        std = max(variance, 0.0) ** 0.5
+        downside = (self.sum_downside / n) ** 0.5 if n else 0.0
+        excess = mean - self.target
+        annualize = TRADING_DAYS ** 0.5
+
+        total_return = self.last_equity / self.start_equity - 1 if self.start_equity > 0 else None
+        cagr = None
+        if n and total_return is not None and self.last_equity > 0:
+            cagr = (self.last_equity / self.start_equity) ** (TRADING_DAYS / n) - 1
+
+        return {
+            "total_return": total_return,
+            "cagr": cagr,
+            "volatility": std * annualize,
+            "sharpe_ratio": excess / std * annualize if std > 0 else None,
+            "sortino_ratio": excess / downside * annualize if downside > 0 else None,
+            "max_drawdown": self.max_drawdown,
+            "calmar_ratio": cagr / -self.max_drawdown if cagr is not None and self.max_drawdown < 0 else None,
+        }
+
+
+def business_day(value) -> np.datetime64:
+    """The business day a trade's effect lands on (weekends roll to Monday)"""
+    return np.busday_offset(np.datetime64(value, "D"), 0, roll="forward")
+
+
+def last_business_day(today: Optional[date] = None) -> np.datetime64:
+    today = today or datetime.utcnow().date()
+    return np.busday_offset(np.datetime64(today, "D"), 0, roll="backward")
+
+
+def _rows(values, index: Dict[str, int]) -> np.ndarray:
+    """Row of each symbol in index, or -1; looks up categories, not every value"""
+    categorical = pd.Categorical(values)
+    lookup = np.array([index.get(c, -1) for c in categorical.categories] + [-1], dtype=np.int64)
+    # Missing values have code -1, which picks the trailing -1
+    return lookup[categorical.codes]
+
+
+def _day_positions(days: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Index of each date in days (sorted business days), or -1
+
+    Uses a table over the calendar span of days, so each lookup is one
+    gather instead of a binary search.
+    """
+    calendar = np.full(int((days[-1] - days[0]).astype(np.int64)) + 1, -1, dtype=np.int64)
+    calendar[(days - days[0]).astype(np.int64)] = np.arange(len(days))
+    offsets = (values - days[0]).astype(np.int64)
+    inside = (offsets >= 0) & (offsets < len(calendar))
+    positions = np.full(len(values), -1, dtype=np.int64)
+    positions[inside] = calendar[offsets[inside]]
+    return positions
+
+
+def simulate(
+    columns: Dict,
+    closes: Dict,
+    days: np.ndarray,
+    state: CurveState
+) -> Tuple[np.ndarray, CurveState, CurveState, int]:
+    """
+    Mark a user's account to market at the end of each day in days
+
+    Starts from state (the end of the day before days[0]) and applies the
+    trades in columns, which must all land on or after days[0]. Each
+    symbol is marked at its close that day, else its last trade price that
+    day, else its previous mark. Cash starts at state.cash and moves by
+    each trade's notional, so equity matches lots.summarize_equity().
+
+    Returns (equity per day, state after the second-to-last day, state
+    after the last day, trades landing on or after the last day).
+    """
+    n_days = len(days)
+    trade_symbols = pd.Categorical(columns["symbol"])
+    index = {symbol: k for k, symbol in enumerate(state.symbols)}
+    symbols = list(state.symbols)
+    for symbol in trade_symbols.categories:
+        if symbol not in index:
+            index[symbol] = len(symbols)
+            symbols.append(symbol)
+    n_symbols = len(symbols)
+
+    trade_days = np.busday_offset(
+        np.asarray(columns["executed_at"]).astype("datetime64[D]"), 0, roll="forward"
+    )
+    tail_trades = int((trade_days >= days[-1]).sum())
+    day_index = _day_positions(days, trade_days)
+    # Trades dated after the last day are not part of the curve yet
+    current = day_index >= 0
+    day_index = day_index[current]
+    symbol_index = _rows(trade_symbols, index)[current]
+    side = pd.Categorical(columns["side"])
+    buy_code = list(side.categories).index("buy") if "buy" in side.categories else -2
+    price = np.asarray(columns["price"], dtype=np.float64)[current]
+    signed_qty = np.where(side.codes[current] == buy_code, 1.0, -1.0) * np.asarray(columns["qty"], dtype=np.float64)[current]
+
+    # Cash after each day's trades
+    cash = state.cash - np.cumsum(np.bincount(day_index, weights=signed_qty * price, minlength=n_days))
+
+    # Open quantity per symbol (rows) and day (columns)
+    qty_change = np.zeros((n_symbols, n_days))
+    np.add.at(qty_change, (symbol_index, day_index), signed_qty)
+    start_qty = np.zeros(n_symbols)
+    start_qty[:len(state.qty)] = state.qty
+    qty = start_qty[:, None] + np.cumsum(qty_change, axis=1)
+
+    # Marks: the previous mark, then the day's last trade price, then its close
+    marks = np.full((n_symbols, n_days + 1), np.nan)
+    marks[:len(state.marks), 0] = state.marks
+    if len(day_index):
+        # Trades are in execution order: keep the highest row per symbol-day
+        last = np.full(n_symbols * n_days, -1, dtype=np.int64)
+        np.maximum.at(last, symbol_index * n_days + day_index, np.arange(len(day_index)))
+        last = last[last >= 0]
+        marks[symbol_index[last], day_index[last] + 1] = price[last]
+
+    close_rows = _rows(closes["symbol"], index)
+    if len(close_rows):
+        position = _day_positions(days, np.asarray(closes["date"], dtype="datetime64[D]"))
+        # Only closes of known symbols on curve days (not holidays/weekends)
+        on_curve = (close_rows >= 0) & (position >= 0)
+        marks[close_rows[on_curve], position[on_curve] + 1] = np.asarray(closes["close"], dtype=np.float64)[on_curve]
+
+    # Forward-fill each symbol's marks along the days
+    filled = np.where(~np.isnan(marks), np.arange(n_days + 1), 0)
+    np.maximum.accumulate(filled, axis=1, out=filled)
+    marks = marks[np.arange(n_symbols)[:, None], filled]
+
+    value = np.where(qty != 0, qty * np.nan_to_num(marks[:, 1:]), 0.0).sum(axis=0)
+    equity = cash + value
+
+    def state_after(k: int) -> CurveState:
+        if k < 0:
+            return CurveState(symbols, start_qty, marks[:, 0], state.cash)
+        return CurveState(symbols, qty[:, k].copy(), marks[:, k + 1].copy(), float(cash[k]))
+
+    return equity, state_after(n_days - 2), state_after(n_days - 1), tail_trades
+
+
+def _growth(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Daily returns of a value series and their running compounded growth"""
+    previous = values[:-1]
+    valid = previous > 0
+    returns = np.where(valid, values[1:] / np.where(valid, previous, 1) - 1, 0.0)
+    return returns, np.cumprod(1 + returns)
+
+
+def align_with_benchmark(
+    days: np.ndarray,
+    equity: np.ndarray,
+    benchmark_days: np.ndarray,
+    benchmark_closes: np.ndarray,
+    start_day: np.datetime64,
+    end_day: np.datetime64,
+    starting_equity: float
+) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Put a user's equity curve and a benchmark's closes on one daily grid
+
+    The grid is the business days from the day before start_day through
+    end_day. Each series takes its value as of each grid day with one
+    np.searchsorted over its sorted dates: the user is at starting_equity
+    before their first curve day, and the grid starts at the benchmark's
+    first close if that is later. Returns daily returns and compounded
+    (time-weighted) growth for both, one entry per grid day after the
+    first, or None when fewer than two grid days have a benchmark close.
+    """
+    first_day = np.busday_offset(start_day, 0, roll="forward")
+    grid = np.arange(
+        np.busday_offset(first_day, -1), end_day + np.timedelta64(1, "D"), dtype="datetime64[D]"
+    )
+    grid = grid[np.is_busday(grid)]
+
+    benchmark_index = np.searchsorted(benchmark_days, grid, side="right") - 1
+    covered = benchmark_index >= 0
+    grid, benchmark_index = grid[covered], benchmark_index[covered]
+    if len(grid) < 2:
+        return None
+
+    user_index = np.searchsorted(days, grid, side="right") - 1
+    user_values = np.where(user_index >= 0, equity[np.maximum(user_index, 0)], starting_equity)
+
+    user_returns, user_growth = _growth(user_values)
+    benchmark_returns, benchmark_growth = _growth(benchmark_closes[benchmark_index])
+    return {
+        "days": grid[1:],
+        "user_start": user_values[0],
+        "user_end": user_values[-1],
+        "benchmark_start": benchmark_closes[benchmark_index[0]],
+        "benchmark_end": benchmark_closes[benchmark_index[-1]],
+        "user_returns": user_returns,
+        "user_growth": user_growth,
+        "benchmark_returns": benchmark_returns,
+        "benchmark_growth": benchmark_growth,
+    }
+
+
+def downsample(count: int, points: int) -> np.ndarray:
+    """At most points evenly spaced indexes into count values, first and last included"""
+    if points <= 0 or count <= 0:
+        return np.empty(0, dtype=np.int64)
+    if points >= count:
+        return np.arange(count)
+    return np.unique(np.linspace(0, count - 1, points).round().astype(np.int64))
+
+
+class EquityCurve:
+    """
+    A user's cached daily equity and the running risk sums behind it
+
+    The last day is provisional (its close may not be cached yet), so the
+    state and risk sums at the end of the day before it are kept as the
+    anchor from which an extension recomputes.
+    """
+
+    def __init__(
+        self,
+        days: np.ndarray,
+        equity: np.ndarray,
+        anchor: CurveState,
+        anchor_risk: RiskAccumulator,
+        risk: RiskAccumulator,
+        trade_count: int,
+        tail_trades: int
+    ):
+        self.days = days
+        self.equity = equity
+        self.anchor = anchor
+        self.anchor_risk = anchor_risk
+        self.risk = risk
+        self.trade_count = trade_count
+        self.tail_trades = tail_trades
+        self.symbols = set(anchor.symbols)
+        self.built_at = time.monotonic()
+
+    @property
+    def end_day(self) -> Optional[np.datetime64]:
+        return self.days[-1] if len(self.days) else None
+
+    def metrics(self, risk_free_rate: float = RISK_FREE_RATE) -> Dict:
+        if risk_free_rate == RISK_FREE_RATE:
+            return self.risk.metrics()
+        # Sortino's target depends on the rate; refold the whole curve once
+        return RiskAccumulator(lots.STARTING_EQUITY, risk_free_rate).extended(self.equity).metrics()
+
+
+_curves: "OrderedDict[str, EquityCurve]" = OrderedDict()
+_locks: Dict[str, asyncio.Lock] = {}
+
+stats = {"hits": 0, "extended": 0, "rebuilt": 0}
+
+
+def _empty_curve(trade_count: int) -> EquityCurve:
+    risk = RiskAccumulator(lots.STARTING_EQUITY)
+    return EquityCurve(
+        np.empty(0, dtype="datetime64[D]"), np.empty(0),
+        CurveState.empty(lots.STARTING_EQUITY), risk, risk, trade_count, 0
+    )
+
+
+async def _segment(
+    columns: Dict,
+    first_day: np.datetime64,
+    end_day: np.datetime64,
+    anchor: CurveState
+) -> Tuple[np.ndarray, np.ndarray, CurveState, CurveState, int]:
+    """Load closes and simulate days first_day..end_day from anchor"""
+    days = np.arange(first_day, end_day + np.timedelta64(1, "D"), dtype="datetime64[D]")
+    days = days[np.is_busday(days)]
+    symbols = sorted(set(anchor.symbols) | set(pd.unique(np.asarray(columns["symbol"], dtype=object))))
+    closes = await db.get_closes(symbols, first_day.item(), end_day.item()) if symbols else {
+        "symbol": pd.Categorical([]),
+        "date": np.empty(0, dtype="datetime64[D]"),
+        "close": np.empty(0),
+    }
+    (equity, before_last, last, tail_trades), _ = await analytics_executor.run(
+        simulate, columns, closes, days, anchor
+    )
+    return days, equity, before_last, last, tail_trades
+
+
+async def _rebuild(user_id: str, trade_count: int, end_day: np.datetime64) -> EquityCurve:
+    columns = await db.fetch_user_trades_columns(user_id)
+    if not len(columns["id"]):
+        return _empty_curve(trade_count)
+
+    first_day = business_day(np.asarray(columns["executed_at"]).min())
+    if first_day > end_day:
+        return _empty_curve(trade_count)
+
+    days, equity, before_last, _, tail_trades = await _segment(
+        columns, first_day, end_day, CurveState.empty(lots.STARTING_EQUITY)
+    )
+    anchor_risk = RiskAccumulator(lots.STARTING_EQUITY).extended(equity[:-1])
+    return EquityCurve(
+        days, equity, before_last, anchor_risk, anchor_risk.extended(equity[-1:]),
+        trade_count, tail_trades
+    )
+
+
+async def _extend(
+    user_id: str,
+    curve: EquityCurve,
+    trade_count: int,
+    end_day: np.datetime64
+) -> Optional[EquityCurve]:
+    """
+    Recompute the provisional last day and append days through end_day
+
+    Returns None if trades were added on or before the anchor day, which
+    needs a rebuild.
+    """
+    tail_day = curve.end_day
+    # Weekend trades before tail_day land on it too
+    fetch_from = np.busday_offset(tail_day, -1) + np.timedelta64(1, "D")
+    columns = await db.fetch_user_trades_columns(user_id, fetch_from.item())
+    if len(columns["id"]) != curve.tail_trades + trade_count - curve.trade_count:
+        return None
+
+    days, equity, before_last, _, tail_trades = await _segment(
+        columns, tail_day, end_day, curve.anchor
+    )
+    anchor_risk = curve.anchor_risk.extended(equity[:-1])
+    return EquityCurve(
+        np.concatenate((curve.days[:-1], days)),
+        np.concatenate((curve.equity[:-1], equity)),
+        before_last,
+        anchor_risk,
+        anchor_risk.extended(equity[-1:]),
+        trade_count,
+        tail_trades
+    )
+
+
+async def get_curve(user_id: str, today: Optional[date] = None) -> Tuple[EquityCurve, str]:
+    """
+    Get a user's equity curve through the last business day
+
+    The cached curve is reused while the user's trade count (one
+    user_metrics read) and the last business day are unchanged, extended
+    when new days or trades arrive after its anchor day, and rebuilt
+    otherwise. Returns (curve, "hit" | "extended" | "rebuilt").
+    """
+    end_day = last_business_day(today)
+    lock = _locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        row = await db.get_user_metrics_row(user_id)
+        trade_count = int(row["total_trades"]) if row else 0
+
+        curve = _curves.get(user_id)
+        if curve is not None and time.monotonic() - curve.built_at >= CURVE_TTL_SECONDS:
+            curve = None
+
+        if curve is not None and curve.trade_count == trade_count and (
+            curve.end_day == end_day or (curve.end_day is None and trade_count == 0)
+        ):
+            stats["hits"] += 1
+            _curves.move_to_end(user_id)
+            return curve, "hit"
+
+        outcome = "rebuilt"
+        if curve is not None and curve.end_day is not None and curve.end_day <= end_day:
+            built_at = curve.built_at
+            curve = await _extend(user_id, curve, trade_count, end_day)
+            if curve is not None:
+                # Extensions keep the rebuild deadline of the original curve
+                curve.built_at = built_at
+                outcome = "extended"
+        else:
+            curve = None
+
+        if curve is None:
+            curve = await _rebuild(user_id, trade_count, end_day)
+
+        stats[outcome] += 1
+        _curves[user_id] = curve
+        _curves.move_to_end(user_id)
+        while len(_curves) > MAX_CURVES:
+            evicted, _ = _curves.popitem(last=False)
+            _locks.pop(evicted, None)
+        return curve, outcome
+
+
+async def get_risk_metrics(
+    user_id: str,
+    risk_free_rate: float = RISK_FREE_RATE,
+    include_curve: bool = False
+) -> Dict:
+    """
+    Risk-adjusted performance of a user's daily equity curve
+
+    Sharpe, Sortino and volatility are annualized from daily returns;
+    Calmar is CAGR over the maximum drawdown. Ratios are None when
+    undefined (e.g. no volatility or no drawdown yet).
+    """
+    curve, outcome = await get_curve(user_id)
+    metrics = curve.metrics(risk_free_rate)
+
+    def percent(value: Optional[float]) -> Optional[float]:
+        return round(value * 100, 2) if value is not None else None
+
+    def ratio(value: Optional[float]) -> Optional[float]:
+        return round(value, 2) if value is not None else None
+
+    result = {
+        "user_id": user_id,
+        "start_date": str(curve.days[0]) if len(curve.days) else None,
+        "end_date": str(curve.days[-1]) if len(curve.days) else None,
+        "days": len(curve.days),
+        "starting_equity": lots.STARTING_EQUITY,
+        "ending_equity": round(float(curve.equity[-1]), 2) if len(curve.equity) else lots.STARTING_EQUITY,
+        "total_return_percent": percent(metrics["total_return"]),
+        "cagr_percent": percent(metrics["cagr"]),
+        "volatility_percent": percent(metrics["volatility"]),
+        "sharpe_ratio": ratio(metrics["sharpe_ratio"]),
+        "sortino_ratio": ratio(metrics["sortino_ratio"]),
+        "max_drawdown_percent": percent(metrics["max_drawdown"]),
+        "calmar_ratio": ratio(metrics["calmar_ratio"]),
+        "risk_free_rate": risk_free_rate,
+        "cache": outcome,
+    }
+    if include_curve:
+        result["curve"] = [
+            {"date": str(day), "equity": round(float(value), 2)}
+            for day, value in zip(curve.days, curve.equity)
+        ]
+    return result
+
+
+def invalidate(symbol: Optional[str] = None):
+    """Drop cached curves holding a symbol (after its closes changed), or all of them"""
+    if symbol is None:
+        _curves.clear()
+        return
+    for user_id in [u for u, curve in _curves.items() if symbol in curve.symbols]:
+        del _curves[user_id]
+
+
+def get_stats() -> Dict:
+    return {**stats, "cached_curves": len(_curves)}
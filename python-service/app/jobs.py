@@ -0,0 +1,171 @@
+"""
+Durable post-ingest job queue
+Postgres-backed jobs claimed with FOR UPDATE SKIP LOCKED by a pool of
+async workers, either inside the API process or via `python -m app.worker`
+"""
+
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, List, Optional
+from . import compliance, db, profit
+
+# In-process workers started by the API (0 when a separate worker tier runs)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+# Idle workers poll for new jobs this often
+POLL_INTERVAL_SECONDS = 1.0
+
+# A claimed job becomes claimable again if not finished within this time;
+# the worker running it extends the timeout every HEARTBEAT_FRACTION of it
+VISIBILITY_TIMEOUT_SECONDS = 300
+HEARTBEAT_FRACTION = 1 / 3
+
+# Retry backoff: RETRY_BASE_SECONDS * 2^(attempt - 1), capped
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 600
+
+# Handlers may return compliance audit rows; they are written in the same
+# transaction that completes the job
+JobHandler = Callable[[str, Dict], Awaitable[Optional[List[Dict]]]]
+HANDLERS: Dict[str, JobHandler] = {}
+
+
+def handler(kind: str):
+    """Register a coroutine as the handler for a job kind"""
+    def register(fn: JobHandler) -> JobHandler:
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+@handler("compliance")
+async def run_compliance_job(user_id: str, payload: Dict) -> List[Dict]:
+    """Run compliance checks for the trades accumulated on the job"""
+    trade_ids = list(dict.fromkeys(payload.get("trade_ids", [])))
+    trades = await db.get_trades_by_ids(user_id, trade_ids)
+    return await compliance.run_checks_for_trades(trades)
+
+
+@handler("recompute_metrics")
+async def run_recompute_metrics_job(user_id: str, payload: Dict):
+    """Rebuild a user's stored metrics from history"""
+    await profit.request_recompute_user_metrics(user_id)
+
+
+def retry_delay(attempts: int) -> float:
+    return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0))
+
+
+class JobWorkerPool:
+    """Runs N workers that claim and execute jobs until stopped"""
+
+    def __init__(
+        self,
+        concurrency: int,
+        poll_interval: float = POLL_INTERVAL_SECONDS,
+        visibility_timeout: float = VISIBILITY_TIMEOUT_SECONDS
+    ):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self._stopping = asyncio.Event()
+        self._tasks = []
+        self.stats = {"completed": 0, "retried": 0, "failed": 0, "lost": 0}
+
+    async def start(self):
+        self._stopping.clear()
+        self._tasks = [
+            asyncio.create_task(self._work(n)) for n in range(self.concurrency)
+        ]
+
+    async def stop(self):
+        """Let in-flight jobs finish, then stop all workers"""
+        self._stopping.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self, worker_number: int):
+        while not self._stopping.is_set():
+            try:
+                claimed = await db.claim_jobs(1, self.visibility_timeout)
+            except Exception as e:
+                print(f"Job worker {worker_number} failed to claim jobs: {e}")
+                claimed = []
+
+            if not claimed:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for job in claimed:
+                await self._execute(job)
+
+    async def _heartbeat(self, job: Dict):
+        """Keep a running job's claim alive until cancelled"""
+        interval = self.visibility_timeout * HEARTBEAT_FRACTION
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await db.extend_job_lease(job, self.visibility_timeout):
+                    print(f"Job {job['id']} was reclaimed by another worker; its result will be discarded")
+                    return
+            except Exception as e:
+                print(f"Could not extend the claim on job {job['id']}: {e}")
+
+    async def _execute(self, job: Dict):
+        fn = HANDLERS.get(job["kind"])
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            if fn is None:
+                raise ValueError(f"No handler registered for job kind {job['kind']!r}")
+            audits = await fn(str(job["user_id"]), job["payload"])
+        except Exception as e:
+            print(f"Job {job['id']} ({job['kind']}) failed on attempt {job['attempts']}: {e}")
+            try:
+                await db.fail_job(job, str(e), retry_delay(job["attempts"]))
+            except Exception as fail_error:
+                # Left running; it is reclaimed after the visibility timeout
+                print(f"Could not record failure for job {job['id']}: {fail_error}")
+            if job["attempts"] >= job["max_attempts"]:
+                self.stats["failed"] += 1
+            else:
+                self.stats["retried"] += 1
+            return
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+        try:
+            if await db.complete_job(job, audits):
+                self.stats["completed"] += 1
+            else:
+                self.stats["lost"] += 1
+                print(f"Job {job['id']} was reclaimed by another worker; discarded its result")
+        except Exception as e:
+            # Rolled back with its audits; it is reclaimed after the visibility timeout
+            print(f"Could not complete job {job['id']}: {e}")
+
+
+_pool: Optional[JobWorkerPool] = None
+
+
+async def start_workers(concurrency: int = JOB_WORKERS):
+    """Start the in-process worker pool (no-op when concurrency is 0)"""
+    global _pool
+    if concurrency <= 0 or _pool is not None:
+        return
+    _pool = JobWorkerPool(concurrency)
+    await _pool.start()
+
+
+async def stop_workers():
+    global _pool
+    if _pool:
+        await _pool.stop()
+        _pool = None
+
+
+def get_stats() -> Optional[Dict]:
+    return _pool.stats if _pool else None
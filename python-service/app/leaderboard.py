@@ -0,0 +1,216 @@
+"""
+Cohort leaderboard
+Ranks every user's mark-to-market return over a trailing window against a
+benchmark. A full refresh combines the stored positions with one scan of
+the window's trades grouped by user; in between, only users whose trades
+or marks changed since the last refresh are recomputed. The window moves
+daily, so the first refresh of a day is a full one:
+
+    python -m app.leaderboard            # incremental (full when due)
+    python -m app.leaderboard --full     # force a full refresh
+"""
+
+import argparse
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+from . import db, profit
+
+# Benchmark whose window return is reported next to each user's
+LEADERBOARD_BENCHMARK = os.getenv("LEADERBOARD_BENCHMARK", "SPY")
+
+# Trailing window the return is measured over
+LEADERBOARD_WINDOW_DAYS = int(os.getenv("LEADERBOARD_WINDOW_DAYS", "365"))
+
+# Users with fewer trades in the window are not ranked
+LEADERBOARD_MIN_TRADES = int(os.getenv("LEADERBOARD_MIN_TRADES", "1"))
+
+# In-process refresh interval (0 disables the loop; run python -m app.leaderboard instead)
+LEADERBOARD_REFRESH_SECONDS = int(os.getenv("LEADERBOARD_REFRESH_SECONDS", "300"))
+
+# Upper bound on rows returned by one top-K lookup
+MAX_LEADERS = 1000
+
+LOCK_KEY = "leaderboard"
+
+_task: Optional[asyncio.Task] = None
+stats = {"full": 0, "incremental": 0, "users_refreshed": 0, "skipped": 0, "failed": 0}
+
+
+def window_start(today: Optional[date] = None) -> date:
+    """First day of the trailing window ending today"""
+    return (today or datetime.now().date()) - timedelta(days=LEADERBOARD_WINDOW_DAYS)
+
+
+async def _benchmark_return(start_date: date, end_date: date) -> Optional[float]:
+    """Benchmark return over the window, falling back to the mock returns"""
+    data = await profit.get_benchmark_returns(LEADERBOARD_BENCHMARK, start_date, end_date)
+    if not data:
+        data = profit.get_mock_benchmark_returns(LEADERBOARD_BENCHMARK, start_date, end_date)
+    return data["returns_percent"]
+
+
+async def refresh(full: bool = False) -> Optional[Dict]:
+    """
+    Bring the leaderboard up to date
+
+    Runs a full refresh when forced, when there is no snapshot yet or when
+    the window has moved since the last one; otherwise recomputes only the
+    users flagged stale on ingest. Only one process refreshes at a time;
+    returns None if another one is already refreshing.
+    """
+    lock = await db.try_session_lock(LOCK_KEY)
+    if lock is None:
+        stats["skipped"] += 1
+        return None
+
+    try:
+        today = datetime.now().date()
+        start = window_start(today)
+        state = await db.get_leaderboard_state()
+        full = full or state is None or state["window_start"] != start
+        benchmark_return = await _benchmark_return(start, today)
+
+        if full:
+            state = await db.rebuild_leaderboard(
+                start, LEADERBOARD_MIN_TRADES, LEADERBOARD_BENCHMARK, benchmark_return
+            )
+            refreshed = state["users"]
+            stats["full"] += 1
+        else:
+            state, refreshed = await db.refresh_leaderboard_users(
+                start, LEADERBOARD_MIN_TRADES, LEADERBOARD_BENCHMARK, benchmark_return
+            )
+            stats["incremental"] += 1
+        stats["users_refreshed"] += refreshed
+        return {"mode": "full" if full else "incremental", "users_refreshed": refreshed, **state}
+    except Exception:
+        stats["failed"] += 1
+        raise
+    finally:
+        await db.release_session_lock(lock, LOCK_KEY)
+
+
+def _percentile(rank: int, users: int) -> float:
+    """Share of the other ranked users placed below (tied users share a rank)"""
+    if users <= 1:
+        return 100.0
+    return round((users - rank) / (users - 1) * 100, 2)
+
+
+def _entry(row: Dict, rank: int, state: Dict) -> Dict:
+    benchmark_return = state["benchmark_return_percent"]
+    return {
+        "rank": rank,
+        "percentile": _percentile(rank, state["users"]),
+        "user_id": str(row["user_id"]),
+        "return_percent": round(row["return_percent"], 2),
+        "excess_return_percent": (
+            round(row["return_percent"] - benchmark_return, 2) if benchmark_return is not None else None
+        ),
+        "profit": round(row["profit"], 2),
+        "trade_count": row["trade_count"],
+        "last_trade_at": row["last_trade_at"].isoformat() if row["last_trade_at"] else None
+    }
+
+
+def _summary(state: Dict) -> Dict:
+    benchmark_return = state["benchmark_return_percent"]
+    return {
+        "benchmark": state["benchmark"],
+        "benchmark_return_percent": round(benchmark_return, 2) if benchmark_return is not None else None,
+        "window": {
+            "start_date": state["window_start"].isoformat() if state["window_start"] else None,
+            "days": LEADERBOARD_WINDOW_DAYS
+        },
+        "users": state["users"],
+        "refreshed_at": state["refreshed_at"].isoformat() if state["refreshed_at"] else None,
+        "full_refreshed_at": state["full_refreshed_at"].isoformat() if state["full_refreshed_at"] else None
+    }
+
+
+async def get_top(limit: int = 100) -> Optional[Dict]:
+    """Top `limit` users by return; None before the first refresh"""
+    if not 1 <= limit <= MAX_LEADERS:
+        raise ValueError(f"limit must be between 1 and {MAX_LEADERS}")
+
+    state = await db.get_leaderboard_state()
+    if state is None:
+        return None
+
+    rows = await db.get_leaderboard_top(limit)
+    leaders: List[Dict] = []
+    rank = 0
+    for position, row in enumerate(rows, start=1):
+        # Competition ranking: ties share the rank of the first of them
+        if not leaders or row["return_percent"] != rows[position - 2]["return_percent"]:
+            rank = position
+        leaders.append(_entry(row, rank, state))
+    return {**_summary(state), "leaders": leaders}
+
+
+async def get_user_rank(user_id: str) -> Optional[Dict]:
+    """
+    A user's rank and percentile
+
+    Returns None before the first refresh or if the user is not ranked
+    (too few trades in the window).
+    """
+    state = await db.get_leaderboard_state()
+    if state is None:
+        return None
+    row = await db.get_leaderboard_entry(user_id)
+    if row is None:
+        return None
+    return {**_summary(state), **_entry(row, row["above"] + 1, state)}
+
+
+async def _refresh_loop(interval: float):
+    while True:
+        try:
+            result = await refresh()
+            if result and result["users_refreshed"]:
+                print(f"Leaderboard {result['mode']} refresh: {result['users_refreshed']} users")
+        except Exception as e:
+            print(f"Leaderboard refresh failed: {e}")
+        await asyncio.sleep(interval)
+
+
+async def start(interval: float = LEADERBOARD_REFRESH_SECONDS):
+    """Start the periodic refresh task (no-op when interval is 0)"""
+    global _task
+    if interval <= 0 or _task is not None:
+        return
+    _task = asyncio.create_task(_refresh_loop(interval))
+
+
+async def stop():
+    global _task
+    if _task:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+def get_stats() -> Dict:
+    return {**stats, "loop_running": _task is not None}
+
+
+async def main(full: bool):
+    await db.ensure_schema()
+    try:
+        result = await refresh(full)
+        if result is None:
+            print("Another process is refreshing the leaderboard")
+        else:
+            print(f"Leaderboard {result['mode']} refresh: {result['users_refreshed']} users, {result['users']} ranked")
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the cohort leaderboard")
+    parser.add_argument("--full", action="store_true", help="recompute every user, not only changed ones")
+    args = parser.parse_args()
+    asyncio.run(main(args.full))
@@ -0,0 +1,251 @@
+"""
+Position lot engine
+Matches trades against open lots (FIFO, LIFO or average cost) to track
+realized PnL and open positions per user and symbol
+"""
+
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+COST_METHODS = ("fifo", "lifo", "average")
+
+# Cost basis method used for stored positions
+COST_BASIS_METHOD = os.getenv("COST_BASIS_METHOD", "fifo").lower()
+if COST_BASIS_METHOD not in COST_METHODS:
+    raise ValueError(f"COST_BASIS_METHOD must be one of {COST_METHODS}, got {COST_BASIS_METHOD!r}")
+
+# Lots smaller than this are treated as fully closed (float residue)
+QTY_EPSILON = 1e-9
+
+# Account value before any trading PnL; equity snapshots add realized and
+# unrealized PnL to it until account balances are synced from the broker
+STARTING_EQUITY = float(os.getenv("ACCOUNT_STARTING_EQUITY", "100000"))
+
+
+class Position:
+    """
+    Open lots and running PnL for one symbol
+
+    Lots are [signed_qty, price] pairs: positive for long lots opened by
+    buys, negative for short lots opened by sells. A trade first closes
+    lots of the opposite sign (oldest first for FIFO, newest first for
+    LIFO, the single pooled lot for average cost) and opens a new lot with
+    whatever quantity remains. Trades must be applied in execution order.
+    """
+
+    def __init__(self, symbol: str, method: str = COST_BASIS_METHOD):
+        if method not in COST_METHODS:
+            raise ValueError(f"Unknown cost basis method: {method}")
+        self.symbol = symbol
+        self.method = method
+        self.lots: List[List[float]] = []
+        self.realized_pnl = 0.0
+        self.winning_closes = 0
+        self.losing_closes = 0
+        self.gross_profit = 0.0
+        self.gross_loss = 0.0
+        self.trade_count = 0
+        self.buy_value = 0.0
+        self.sell_value = 0.0
+        self.last_price: Optional[float] = None
+        self.last_trade_at: Optional[datetime] = None
+
+    @property
+    def quantity(self) -> float:
+        """Net open quantity (negative when short)"""
+        return sum(qty for qty, _ in self.lots)
+
+    @property
+    def cost_basis(self) -> float:
+        """Signed cost of the open lots"""
+        return sum(qty * price for qty, price in self.lots)
+
+    @property
+    def average_cost(self) -> Optional[float]:
+        quantity = self.quantity
+        if abs(quantity) < QTY_EPSILON:
+            return None
+        return self.cost_basis / quantity
+
+    def unrealized_pnl(self, mark_price: Optional[float] = None) -> float:
+        """Open PnL at mark_price (defaults to the last traded price)"""
+        price = self.last_price if mark_price is None else mark_price
+        if price is None or not self.lots:
+            return 0.0
+        return self.quantity * price - self.cost_basis
+
+    def apply(
+        self,
+        side: str,
+        qty: float,
+        price: float,
+        executed_at: Optional[datetime] = None
+    ) -> float:
+        """
+        Apply one trade; returns the PnL it realized
+        """
+        side = side.lower()
+        qty = float(qty)
+        price = float(price)
+        direction = 1.0 if side == "buy" else -1.0
+
+        self.trade_count += 1
+        if side == "buy":
+            self.buy_value += qty * price
+        else:
+            self.sell_value += qty * price
+        self.last_price = price
+        if executed_at is not None:
+            self.last_trade_at = executed_at
+
+        remaining = qty
+        realized = 0.0
+        closed = 0.0
+        while remaining > QTY_EPSILON and self.lots:
+            index = -1 if self.method == "lifo" else 0
+            lot = self.lots[index]
+            lot_qty, lot_price = lot
+            if lot_qty * direction > 0:
+                # Same side as the trade: nothing left to close
+                break
+
+            matched = min(remaining, abs(lot_qty))
+            # Long lots gain when sold above cost, short lots when bought back below
+            realized += (price - lot_price) * matched * (1.0 if lot_qty > 0 else -1.0)
+            closed += matched
+            remaining -= matched
+            lot[0] = lot_qty + matched * direction
+            if abs(lot[0]) < QTY_EPSILON:
+                self.lots.pop(index)
+
+        if remaining > QTY_EPSILON:
+            if self.method == "average" and self.lots:
+                # One pooled lot at the weighted average price
+                lot_qty, lot_price = self.lots[0]
+                total = lot_qty + remaining * direction
+                self.lots[0] = [total, (lot_qty * lot_price + remaining * direction * price) / total]
+            else:
+                self.lots.append([remaining * direction, price])
+
+        if closed > 0:
+            self.realized_pnl += realized
+            if realized > 0:
+                self.winning_closes += 1
+                self.gross_profit += realized
+            elif realized < 0:
+                self.losing_closes += 1
+                self.gross_loss += realized
+
+        return realized
+
+    def to_record(self) -> Dict:
+        """Column values for the user_positions table"""
+        return {
+            "symbol": self.symbol,
+            "cost_method": self.method,
+            "quantity": self.quantity,
+            "cost_basis": self.cost_basis,
+            "lots": json.dumps(self.lots),
+            "realized_pnl": self.realized_pnl,
+            "winning_closes": self.winning_closes,
+            "losing_closes": self.losing_closes,
+            "gross_profit": self.gross_profit,
+            "gross_loss": self.gross_loss,
+            "trade_count": self.trade_count,
+            "buy_value": self.buy_value,
+            "sell_value": self.sell_value,
+            "last_price": self.last_price,
+            "last_trade_at": self.last_trade_at
+        }
+
+    @classmethod
+    def from_row(cls, row: Dict) -> "Position":
+        """Restore a position stored by to_record()"""
+        position = cls(row["symbol"], row["cost_method"])
+        lots = row["lots"]
+        if isinstance(lots, str):
+            lots = json.loads(lots)
+        position.lots = [[float(qty), float(price)] for qty, price in lots]
+        position.realized_pnl = float(row["realized_pnl"])
+        position.winning_closes = int(row["winning_closes"])
+        position.losing_closes = int(row["losing_closes"])
+        position.gross_profit = float(row["gross_profit"])
+        position.gross_loss = float(row["gross_loss"])
+        position.trade_count = int(row["trade_count"])
+        position.buy_value = float(row["buy_value"])
+        position.sell_value = float(row["sell_value"])
+        position.last_price = float(row["last_price"]) if row["last_price"] is not None else None
+        position.last_trade_at = row["last_trade_at"]
+        return position
+
+
+def build_positions(trades: Iterable[Dict], method: str = COST_BASIS_METHOD) -> Dict[str, Position]:
+    """
+    Replay trades (in execution order) into positions keyed by symbol
+    """
+    positions: Dict[str, Position] = {}
+    for t in trades:
+        position = positions.get(t["symbol"])
+        if position is None:
+            position = positions[t["symbol"]] = Position(t["symbol"], method)
+        position.apply(t["side"], t["qty"], t["price"], t["executed_at"])
+    return positions
+
+
+def summarize_positions(positions: List[Dict]) -> Dict:
+    """
+    Totals across a user's stored positions (rows from db.get_user_positions)
+    """
+    summary = {
+        "realized_pnl": 0.0,
+        "unrealized_pnl": 0.0,
+        "open_positions": 0,
+        "winning_closes": 0,
+        "losing_closes": 0,
+        "gross_profit": 0.0,
+        "gross_loss": 0.0
+    }
+    for row in positions:
+        position = Position.from_row(row)
+        summary["realized_pnl"] += position.realized_pnl
+        summary["unrealized_pnl"] += position.unrealized_pnl()
+        summary["open_positions"] += 1 if position.lots else 0
+        summary["winning_closes"] += position.winning_closes
+        summary["losing_closes"] += position.losing_closes
+        summary["gross_profit"] += position.gross_profit
+        summary["gross_loss"] += position.gross_loss
+    return summary
+
+
+def summarize_equity(snapshot: Optional[Dict]) -> Dict:
+    """
+    Account equity and exposure from a user_equity row (db.get_user_equity)
+
+    A missing snapshot (user with no positions yet) is an account at
+    STARTING_EQUITY with no exposure.
+    """
+    snapshot = snapshot or {}
+    realized_pnl = float(snapshot.get("realized_pnl") or 0)
+    cost_basis = float(snapshot.get("cost_basis") or 0)
+    long_value = float(snapshot.get("long_value") or 0)
+    short_value = float(snapshot.get("short_value") or 0)
+
+    # short_value is negative: the marked value of the short lots
+    unrealized_pnl = long_value + short_value - cost_basis
+    equity = STARTING_EQUITY + realized_pnl + unrealized_pnl
+    gross_exposure = long_value - short_value
+    return {
+        "equity": equity,
+        "starting_equity": STARTING_EQUITY,
+        "realized_pnl": realized_pnl,
+        "unrealized_pnl": unrealized_pnl,
+        "long_value": long_value,
+        "short_value": short_value,
+        "gross_exposure": gross_exposure,
+        "net_exposure": long_value + short_value,
+        "leverage": gross_exposure / equity if equity > 0 else None,
+        "open_positions": int(snapshot.get("open_positions") or 0),
+        "marked_at": snapshot.get("marked_at")
+    }
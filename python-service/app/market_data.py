@@ -0,0 +1,155 @@
+"""
+Market data client module
+Shared pooled HTTP client for the Alpaca Markets data API with
+pagination and retries
+"""
+
+import asyncio
+import os
+import random
+from datetime import date
+from typing import AsyncIterator, Dict, List, Optional
+import httpx
+
+# Alpaca API configuration
+ALPACA_API_KEY = os.getenv("ALPACA_API_KEY", "")
+ALPACA_SECRET_KEY = os.getenv("ALPACA_SECRET_KEY", "")
+ALPACA_BASE_URL = os.getenv("ALPACA_BASE_URL", "https://data.alpaca.markets/v2")
+
+# HTTP/2 is opt-in and needs the optional "h2" package (httpx[http2])
+MARKET_DATA_HTTP2 = os.getenv("MARKET_DATA_HTTP2", "").lower() in ("1", "true", "yes")
+
+# Connection pool and request limits
+MAX_CONNECTIONS = 20
+KEEPALIVE_EXPIRY_SECONDS = 60
+REQUEST_TIMEOUT_SECONDS = 10.0
+
+# Bars per page; keeps each response body small
+PAGE_LIMIT = 1000
+
+# Retry policy: exponential backoff with full jitter
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 10.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    if not MARKET_DATA_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("MARKET_DATA_HTTP2 is set but the h2 package is not installed; using HTTP/1.1")
+        return False
+    return True
+
+
+def get_client() -> httpx.AsyncClient:
+    """Get or create the shared market data HTTP client"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=ALPACA_BASE_URL,
+            headers={
+                "APCA-API-KEY-ID": ALPACA_API_KEY,
+                "APCA-API-SECRET-KEY": ALPACA_SECRET_KEY
+            },
+            http2=_http2_available(),
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS
+            ),
+            timeout=REQUEST_TIMEOUT_SECONDS
+        )
+    return _client
+
+
+async def close_client():
+    """Close the shared market data HTTP client"""
+    global _client
+    if _client:
+        await _client.aclose()
+        _client = None
+
+
+def _backoff_delay(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    """Delay before the next retry, honouring Retry-After when present"""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX_SECONDS)
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+async def get_with_retry(path: str, params: Dict) -> httpx.Response:
+    """
+    GET a market data path, retrying transport errors and 429/5xx responses
+    """
+    client = get_client()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = await client.get(path, params=params)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(_backoff_delay(attempt))
+            continue
+
+        if response.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+            await asyncio.sleep(_backoff_delay(attempt, response))
+            continue
+
+        response.raise_for_status()
+        return response
+
+
+async def iter_bar_pages(
+    symbol: str,
+    start_date: date,
+    end_date: date,
+    timeframe: str = "1Day"
+) -> AsyncIterator[List[Dict]]:
+    """
+    Yield a symbol's bars one page at a time, following next_page_token
+
+    Callers can process each page as it arrives instead of holding the
+    whole history in memory.
+    """
+    params = {
+        "start": start_date.isoformat(),
+        "end": end_date.isoformat(),
+        "timeframe": timeframe,
+        "limit": PAGE_LIMIT
+    }
+
+    while True:
+        response = await get_with_retry(f"/stocks/{symbol}/bars", params)
+        page = response.json()
+
+        bars = page.get("bars") or []
+        if bars:
+            yield bars
+
+        next_page_token = page.get("next_page_token")
+        if not next_page_token:
+            break
+        params["page_token"] = next_page_token
+
+
+async def fetch_bars(
+    symbol: str,
+    start_date: date,
+    end_date: date,
+    timeframe: str = "1Day"
+) -> List[Dict]:
+    """
+    Fetch every bar for a symbol and date range across all pages
+    """
+    bars = []
+    async for page in iter_bar_pages(symbol, start_date, end_date, timeframe):
+        bars.extend(page)
+    return bars
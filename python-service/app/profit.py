@@ -4,65 +4,214 @@ Calculates user returns and compares against market benchmarks
 """
 
 import asyncio
-from typing import Dict, List, Optional
-from datetime import datetime, date, timedelta
-import httpx
-from . import db
+import time
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, date, timedelta, timezone
 
-# Alpaca API configuration
-ALPACA_API_KEY = ""  # Set from environment
-ALPACA_SECRET_KEY = ""  # Set from environment
-ALPACA_BASE_URL = "https://data.alpaca.markets/v2"
+import numpy as np
+from . import benchmark_cache, db, equity_curve, lots, market_data, response_cache
+from .singleflight import SingleFlight
+
+# Coalesces concurrent recompute requests per user
+recompute_flight = SingleFlight()
+
+# Upper bound on points in a downsampled comparison series
+MAX_SERIES_POINTS = 2000
+
+# Upper bound on symbols in one multi-benchmark comparison
+MAX_BENCHMARKS = 16
+
+async def get_user_positions(user_id: str) -> List[Dict]:
+    """
+    Get a user's stored positions, backfilling them from history on first read
+    """
+    positions = await db.get_user_positions(user_id)
+    if not positions:
+        positions = await db.rebuild_user_positions(user_id)
+    return positions
+
+async def load_user_equity(user_id: str) -> Dict:
+    """
+    Get a user's account equity and exposure (lots.summarize_equity)
+
+    Reads the materialized snapshot; users whose positions predate the
+    snapshot table are backfilled once.
+    """
+    snapshot = await db.get_user_equity(user_id)
+    if snapshot is None:
+        await get_user_positions(user_id)
+        snapshot = await db.refresh_user_equity(user_id)
+    return lots.summarize_equity(snapshot)
+
+async def get_user_equity(user_id: str) -> Dict:
+    """
+    Get a user's equity snapshot for the API
+    """
+    equity = await load_user_equity(user_id)
+    return {
+        "user_id": user_id,
+        "cost_basis_method": lots.COST_BASIS_METHOD,
+        **{
+            key: round(value, 2) if isinstance(value, float) else value
+            for key, value in equity.items()
+        },
+        "marked_at": equity["marked_at"].isoformat() if equity["marked_at"] else None
+    }
 
 async def get_user_metrics(user_id: str) -> Dict:
     """
-    Calculate comprehensive trading metrics for a user
+    Get comprehensive trading metrics for a user
+
+    Reads the incrementally maintained user_metrics row and per-symbol
+    positions, so the cost grows with the number of symbols traded rather
+    than the trade history. Users who traded before the tables existed are
+    backfilled once on first read.
     """
-    trades = await db.get_user_trades(user_id)
+    row = await db.get_user_metrics_row(user_id)
+    if row is None:
+        row = await db.rebuild_user_metrics(user_id)
 
-    if not trades:
+    if not row or not row["total_trades"]:
         return {
             "user_id": user_id,
             "total_trades": 0,
             "total_invested": 0,
             "total_value": 0,
             "realized_pnl": 0,
+            "unrealized_pnl": 0,
             "returns_percent": 0,
             "trades": []
         }
 
     # Calculate metrics
-    total_buy_value = sum(t["value"] for t in trades if t["side"].lower() == "buy")
-    total_sell_value = sum(t["value"] for t in trades if t["side"].lower() == "sell")
+    total_buy_value = float(row["buy_value"])
+    total_sell_value = float(row["sell_value"])
 
-    realized_pnl = total_sell_value - total_buy_value
-    returns_percent = (realized_pnl / total_buy_value * 100) if total_buy_value > 0 else 0
+    # Realized PnL from matched lots; open lots are marked at the last trade price
+    pnl = lots.summarize_positions(await get_user_positions(user_id))
+    realized_pnl = pnl["realized_pnl"]
+    unrealized_pnl = pnl["unrealized_pnl"]
+    total_pnl = realized_pnl + unrealized_pnl
+    returns_percent = (total_pnl / total_buy_value * 100) if total_buy_value > 0 else 0
 
     return {
         "user_id": user_id,
-        "total_trades": len(trades),
+        "total_trades": row["total_trades"],
+        "buy_count": row["buy_count"],
+        "sell_count": row["sell_count"],
         "total_invested": round(total_buy_value, 2),
         "total_value": round(total_sell_value, 2),
         "realized_pnl": round(realized_pnl, 2),
+        "unrealized_pnl": round(unrealized_pnl, 2),
+        "total_pnl": round(total_pnl, 2),
+        "open_positions": pnl["open_positions"],
+        "cost_basis_method": lots.COST_BASIS_METHOD,
         "returns_percent": round(returns_percent, 2),
-        "first_trade": trades[0]["executed_at"].isoformat() if trades else None,
-        "last_trade": trades[-1]["executed_at"].isoformat() if trades else None
+        "first_trade": row["first_trade_at"].isoformat() if row["first_trade_at"] else None,
+        "last_trade": row["last_trade_at"].isoformat() if row["last_trade_at"] else None
     }
 
 async def recompute_user_metrics(user_id: str):
     """
-    Recompute and cache user metrics
-    This runs asynchronously after trade ingestion
+    Rebuild a user's stored metrics from their full trade history
+
+    Ingest keeps user_metrics and user_positions current incrementally;
+    this is only needed for backfills or to repair drift.
     """
     try:
+        await db.rebuild_user_metrics(user_id)
+        await db.rebuild_user_positions(user_id)
         metrics = await get_user_metrics(user_id)
-        # TODO: Cache metrics in Redis or database for fast retrieval
         print(f"Updated metrics for user {user_id}: {metrics}")
         return metrics
     except Exception as e:
         print(f"Error recomputing metrics for user {user_id}: {e}")
         raise
 
+async def request_recompute_user_metrics(user_id: str):
+    """
+    Recompute a user's metrics, coalescing with in-flight requests
+
+    A burst of requests for one user triggers at most one running
+    recompute plus one trailing recompute; see recompute_flight.stats.
+    """
+    return await recompute_flight.run(user_id, lambda: recompute_user_metrics(user_id))
+
+def parse_benchmarks(value: str) -> List[str]:
+    """
+    Parse a comma-separated benchmark list ("SPY,QQQ"), uppercased and deduplicated
+    """
+    symbols = list(dict.fromkeys(
+        symbol.strip().upper() for symbol in value.split(",") if symbol.strip()
+    ))
+    if not symbols:
+        raise ValueError("benchmarks must list at least one symbol")
+    if len(symbols) > MAX_BENCHMARKS:
+        raise ValueError(f"benchmarks must list at most {MAX_BENCHMARKS} symbols")
+    return symbols
+
+def _default_window(start_date: Optional[date], end_date: Optional[date]) -> Tuple[date, date]:
+    """Default to the year before end_date (today, in UTC, if not given)"""
+    if not end_date:
+        end_date = datetime.now(timezone.utc).date()
+    if not start_date:
+        start_date = end_date - timedelta(days=365)
+    return start_date, end_date
+
+def _timeframe(start_date: date, end_date: date) -> Dict:
+    """Timeframe section of a comparison response"""
+    return {
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "days": (end_date - start_date).days
+    }
+
+def _user_window_performance(user_trades: List[Dict]) -> Tuple[Dict, float]:
+    """Buy/sell totals and window PnL; returns (rounded summary, profit percent)"""
+    buy_value = sum(t["value"] for t in user_trades if t["side"].lower() == "buy")
+    sell_value = sum(t["value"] for t in user_trades if t["side"].lower() == "sell")
+
+    user_profit = sell_value - buy_value
+    user_profit_percent = (user_profit / buy_value * 100) if buy_value > 0 else 0
+
+    return {
+        "buy_value": round(buy_value, 2),
+        "sell_value": round(sell_value, 2),
+        "profit_dollar": round(user_profit, 2),
+        "profit_percent": round(user_profit_percent, 2)
+    }, user_profit_percent
+
+async def _benchmark_comparison(
+    benchmark: str,
+    start_date: date,
+    end_date: date,
+    user_profit_percent: float
+) -> Dict:
+    """Benchmark return over the window and its difference to the user's"""
+    benchmark_data = await get_benchmark_returns(benchmark, start_date, end_date)
+
+    if not benchmark_data:
+        # Fallback to mock data if API fails
+        benchmark_data = get_mock_benchmark_returns(benchmark, start_date, end_date)
+
+    benchmark_returns = benchmark_data["returns_percent"]
+    difference = user_profit_percent - benchmark_returns
+
+    return {
+        "benchmark_performance": {
+            "symbol": benchmark,
+            "name": benchmark_data.get("name", benchmark),
+            "start_price": benchmark_data.get("start_price"),
+            "end_price": benchmark_data.get("end_price"),
+            "returns_percent": round(benchmark_returns, 2)
+        },
+        "comparison": {
+            "difference_percent": round(difference, 2),
+            "outperformance": difference > 0,
+            "status": "outperformed" if difference > 0 else "underperformed"
+        }
+    }
+
 async def get_user_vs_benchmark(
     user_id: str,
     benchmark: str = "SPY",
@@ -72,11 +221,7 @@ async def get_user_vs_benchmark(
     """
     Compare user's trading performance against a market benchmark
     """
-    # Default to last year if no dates provided
-    if not end_date:
-        end_date = datetime.now().date()
-    if not start_date:
-        start_date = end_date - timedelta(days=365)
+    start_date, end_date = _default_window(start_date, end_date)
 
     # Get user trades in date range
     user_trades = await db.get_user_trades(user_id, start_date, end_date)
@@ -90,47 +235,241 @@ async def get_user_vs_benchmark(
             "end_date": end_date.isoformat()
         }
 
-    # Calculate user returns
-    buy_value = sum(t["value"] for t in user_trades if t["side"].lower() == "buy")
-    sell_value = sum(t["value"] for t in user_trades if t["side"].lower() == "sell")
+    user_performance, user_profit_percent = _user_window_performance(user_trades)
 
-    user_profit = sell_value - buy_value
-    user_profit_percent = (user_profit / buy_value * 100) if buy_value > 0 else 0
+    return {
+        "user_id": user_id,
+        "timeframe": _timeframe(start_date, end_date),
+        "user_performance": user_performance,
+        **await _benchmark_comparison(benchmark, start_date, end_date, user_profit_percent)
+    }
 
-    # Get benchmark data
-    benchmark_data = await get_benchmark_returns(benchmark, start_date, end_date)
+async def get_user_vs_benchmarks(
+    user_id: str,
+    benchmarks: List[str],
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
+) -> Dict:
+    """
+    Compare user's trading performance against several benchmarks at once
 
-    if not benchmark_data:
-        # Fallback to mock data if API fails
-        benchmark_data = get_mock_benchmark_returns(benchmark, start_date, end_date)
+    The user's trades are read once and the cached closes of every
+    benchmark not yet in memory are loaded in one query, instead of one
+    get_user_vs_benchmark() call (and trade scan) per symbol.
+    """
+    start_date, end_date = _default_window(start_date, end_date)
 
-    benchmark_returns = benchmark_data["returns_percent"]
-    difference = user_profit_percent - benchmark_returns
+    user_trades = await db.get_user_trades(user_id, start_date, end_date)
+
+    if not user_trades:
+        return {
+            "error": "No trades found in specified timeframe",
+            "user_id": user_id,
+            "benchmarks": benchmarks,
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat()
+        }
+
+    user_performance, user_profit_percent = _user_window_performance(user_trades)
+
+    # Warm the series cache for all symbols; only uncached symbols hit the API
+    await benchmark_cache.get_many(benchmarks)
+    comparisons = await asyncio.gather(*[
+        _benchmark_comparison(benchmark, start_date, end_date, user_profit_percent)
+        for benchmark in benchmarks
+    ])
 
     return {
         "user_id": user_id,
+        "timeframe": _timeframe(start_date, end_date),
+        "user_performance": user_performance,
+        "benchmarks": comparisons
+    }
+
+def _time_weighted_comparison(
+    curve: equity_curve.EquityCurve,
+    series: benchmark_cache.BenchmarkSeries,
+    start_date: date,
+    end_date: date,
+    series_points: int
+) -> Optional[Dict]:
+    """
+    Align a user's equity curve with one benchmark and compare their returns
+
+    Returns None if the benchmark has no closes in the window.
+    """
+    aligned = equity_curve.align_with_benchmark(
+        curve.days,
+        curve.equity,
+        series.date_array,
+        series.close_array,
+        np.datetime64(start_date, "D"),
+        np.datetime64(end_date, "D"),
+        lots.STARTING_EQUITY
+    )
+    if aligned is None:
+        return None
+
+    user_return = (aligned["user_growth"][-1] - 1) * 100
+    benchmark_return = (aligned["benchmark_growth"][-1] - 1) * 100
+    excess = user_return - benchmark_return
+    daily_excess = aligned["user_returns"] - aligned["benchmark_returns"]
+    tracking_error = daily_excess.std(ddof=1) * equity_curve.TRADING_DAYS ** 0.5 * 100 if len(daily_excess) > 1 else 0.0
+
+    result = {
         "timeframe": {
-            "start_date": start_date.isoformat(),
-            "end_date": end_date.isoformat(),
-            "days": (end_date - start_date).days
+            "start_date": str(aligned["days"][0]),
+            "end_date": str(aligned["days"][-1]),
+            "trading_days": len(aligned["days"])
         },
         "user_performance": {
-            "buy_value": round(buy_value, 2),
-            "sell_value": round(sell_value, 2),
-            "profit_dollar": round(user_profit, 2),
-            "profit_percent": round(user_profit_percent, 2)
+            "start_equity": round(float(aligned["user_start"]), 2),
+            "end_equity": round(float(aligned["user_end"]), 2),
+            "time_weighted_return_percent": round(float(user_return), 2)
         },
         "benchmark_performance": {
-            "symbol": benchmark,
-            "name": benchmark_data.get("name", benchmark),
-            "start_price": benchmark_data.get("start_price"),
-            "end_price": benchmark_data.get("end_price"),
-            "returns_percent": round(benchmark_returns, 2)
+            "symbol": series.symbol,
+            "start_price": float(aligned["benchmark_start"]),
+            "end_price": float(aligned["benchmark_end"]),
+            "returns_percent": round(float(benchmark_return), 2)
         },
         "comparison": {
-            "difference_percent": round(difference, 2),
-            "outperformance": difference > 0,
-            "status": "outperformed" if difference > 0 else "underperformed"
+            "excess_return_percent": round(float(excess), 2),
+            "tracking_error_percent": round(float(tracking_error), 2),
+            "outperformance": bool(excess > 0),
+            "status": "outperformed" if excess > 0 else "underperformed"
+        }
+    }
+
+    if series_points:
+        points = equity_curve.downsample(len(aligned["days"]), series_points)
+        user_series = (aligned["user_growth"][points] - 1) * 100
+        benchmark_series = (aligned["benchmark_growth"][points] - 1) * 100
+        result["series"] = [
+            {
+                "date": str(day),
+                "user_return_percent": round(float(u), 2),
+                "benchmark_return_percent": round(float(b), 2)
+            }
+            for day, u, b in zip(aligned["days"][points], user_series, benchmark_series)
+        ]
+    return result
+
+def _time_weighted_window(
+    start_date: Optional[date],
+    end_date: Optional[date],
+    series_points: int
+) -> Tuple[date, date]:
+    """Validate time-weighted comparison arguments and fill in the window"""
+    if not 0 <= series_points <= MAX_SERIES_POINTS:
+        raise ValueError(f"series_points must be between 0 and {MAX_SERIES_POINTS}")
+    start_date, end_date = _default_window(start_date, end_date)
+    if start_date > end_date:
+        raise ValueError("start_date must not be after end_date")
+    return start_date, end_date
+
+async def get_user_vs_benchmark_time_weighted(
+    user_id: str,
+    benchmark: str = "SPY",
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    series_points: int = 0
+) -> Dict:
+    """
+    Compare the user's time-weighted return against a benchmark, day by day
+
+    The user's daily equity curve (equity_curve.get_curve) and the
+    benchmark's closes are aligned on one business-day grid with as-of
+    lookups, and both are compounded from daily returns. Trade timing and
+    position size are therefore reflected, unlike the window-total PnL of
+    get_user_vs_benchmark().
+
+    Args:
+        series_points: Also return up to this many evenly spaced points of
+                       the cumulative returns (0 for none)
+    """
+    start_date, end_date = _time_weighted_window(start_date, end_date, series_points)
+
+    curve, curve_cache = await equity_curve.get_curve(user_id)
+    if not len(curve.days):
+        return {
+            "error": "No trades found",
+            "user_id": user_id,
+            "benchmark": benchmark,
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat()
+        }
+
+    # Closes come from the cache only; gaps are filled by /benchmarks/update
+    series = await benchmark_cache.get_series(benchmark)
+
+    align_start = time.perf_counter()
+    comparison = _time_weighted_comparison(curve, series, start_date, end_date, series_points)
+    if comparison is None:
+        return {
+            "error": f"No benchmark data for {benchmark} in specified timeframe",
+            "user_id": user_id,
+            "benchmark": benchmark,
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat()
+        }
+
+    return {
+        "user_id": user_id,
+        "method": "time_weighted",
+        **comparison,
+        "execution": {
+            "curve_cache": curve_cache,
+            "align_ms": round((time.perf_counter() - align_start) * 1000, 2)
+        }
+    }
+
+async def get_user_vs_benchmarks_time_weighted(
+    user_id: str,
+    benchmarks: List[str],
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    series_points: int = 0
+) -> Dict:
+    """
+    get_user_vs_benchmark_time_weighted() for several benchmarks
+
+    The equity curve is built (or fetched) once and every benchmark's
+    closes come from one cache load; each benchmark is then one aligned
+    comparison. Benchmarks without closes in the window carry an error.
+    """
+    start_date, end_date = _time_weighted_window(start_date, end_date, series_points)
+
+    curve, curve_cache = await equity_curve.get_curve(user_id)
+    if not len(curve.days):
+        return {
+            "error": "No trades found",
+            "user_id": user_id,
+            "benchmarks": benchmarks,
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat()
+        }
+
+    series = await benchmark_cache.get_many(benchmarks)
+
+    align_start = time.perf_counter()
+    comparisons = []
+    for benchmark in benchmarks:
+        comparison = _time_weighted_comparison(curve, series[benchmark], start_date, end_date, series_points)
+        if comparison is None:
+            comparison = {
+                "benchmark_performance": {"symbol": benchmark},
+                "error": f"No benchmark data for {benchmark} in specified timeframe"
+            }
+        comparisons.append(comparison)
+
+    return {
+        "user_id": user_id,
+        "method": "time_weighted",
+        "benchmarks": comparisons,
+        "execution": {
+            "curve_cache": curve_cache,
+            "align_ms": round((time.perf_counter() - align_start) * 1000, 2)
         }
     }
 
@@ -143,13 +482,13 @@ async def get_benchmark_returns(
     Fetch benchmark returns from market data API
     """
     try:
-        # Check if we have cached data
-        cached_data = await db.get_benchmark_range(symbol, start_date, end_date)
+        # Check if we have cached data (in-process series, loaded from the DB once)
+        cached_range = await benchmark_cache.price_range(symbol, start_date, end_date)
 
-        if cached_data and len(cached_data) >= 2:
+        if cached_range:
             # Use cached data
-            start_price = cached_data[0]["close"]
-            end_price = cached_data[-1]["close"]
+            start_price = cached_range["start_price"]
+            end_price = cached_range["end_price"]
             returns = ((end_price - start_price) / start_price) * 100
 
             return {
@@ -170,61 +509,81 @@ async def get_benchmark_returns(
         print(f"Error fetching benchmark {symbol}: {e}")
         return None
 
-async def fetch_benchmark_from_api(
+async def cache_benchmark_bars(
     symbol: str,
     start_date: date,
     end_date: date
-) -> Optional[Dict]:
+) -> Dict:
     """
-    Fetch benchmark data from Alpaca Markets API
+    Download a symbol's bars for a date range and cache them page by page
+
+    Equity snapshots of users holding the symbol are then re-marked at the
+    new closes, and cached equity curves holding it and cached responses
+    are dropped. Returns the bar count and the first and last close seen.
     """
-    try:
-        async with httpx.AsyncClient() as client:
-            url = f"{ALPACA_BASE_URL}/stocks/{symbol}/bars"
-            headers = {
-                "APCA-API-KEY-ID": ALPACA_API_KEY,
-                "APCA-API-SECRET-KEY": ALPACA_SECRET_KEY
-            }
-            params = {
-                "start": start_date.isoformat(),
-                "end": end_date.isoformat(),
-                "timeframe": "1Day",
-                "limit": 10000
+    start_price = None
+    end_price = None
+    bar_count = 0
+
+    async for bars in market_data.iter_bar_pages(symbol, start_date, end_date):
+        if start_price is None:
+            start_price = bars[0]["c"]
+        end_price = bars[-1]["c"]
+        bar_count += len(bars)
+
+        # Cache the page in one bulk upsert
+        await db.upsert_benchmarks_bulk([
+            {
+                "symbol": symbol,
+                "date": datetime.fromisoformat(bar["t"].replace("Z", "+00:00")).date(),
+                "open": bar["o"],
+                "high": bar["h"],
+                "low": bar["l"],
+                "close": bar["c"],
+                "volume": bar["v"]
             }
+            for bar in bars
+        ])
 
-            response = await client.get(url, headers=headers, params=params, timeout=10.0)
-            response.raise_for_status()
+    if bar_count:
+        equity_curve.invalidate(symbol)
+        response_cache.invalidate()
+        try:
+            marked = await db.mark_equity_to_market([symbol])
+            if marked:
+                print(f"Marked {marked} equity snapshots to market at new {symbol} closes")
+        except Exception as e:
+            print(f"Error marking equity snapshots for {symbol}: {e}")
 
-            data = response.json()
-            bars = data.get("bars", [])
+    return {"bars": bar_count, "start_price": start_price, "end_price": end_price}
 
-            if not bars or len(bars) < 2:
-                return None
+async def fetch_benchmark_from_api(
+    symbol: str,
+    start_date: date,
+    end_date: date
+) -> Optional[Dict]:
+    """
+    Fetch benchmark data from Alpaca Markets API
 
-            start_price = bars[0]["c"]
-            end_price = bars[-1]["c"]
-            returns = ((end_price - start_price) / start_price) * 100
+    Pages are cached as they arrive through the shared market data client.
+    """
+    try:
+        cached = await cache_benchmark_bars(symbol, start_date, end_date)
 
-            # Cache the data
-            for bar in bars:
-                bar_date = datetime.fromisoformat(bar["t"].replace("Z", "+00:00")).date()
-                await db.upsert_benchmark({
-                    "symbol": symbol,
-                    "date": bar_date,
-                    "open": bar["o"],
-                    "high": bar["h"],
-                    "low": bar["l"],
-                    "close": bar["c"],
-                    "volume": bar["v"]
-                })
+        if cached["bars"] < 2:
+            return None
 
-            return {
-                "symbol": symbol,
-                "start_price": start_price,
-                "end_price": end_price,
-                "returns_percent": returns,
-                "data_source": "api"
-            }
+        start_price = cached["start_price"]
+        end_price = cached["end_price"]
+        returns = ((end_price - start_price) / start_price) * 100
+
+        return {
+            "symbol": symbol,
+            "start_price": start_price,
+            "end_price": end_price,
+            "returns_percent": returns,
+            "data_source": "api"
+        }
     except Exception as e:
         print(f"API fetch error for {symbol}: {e}")
         return None
@@ -274,62 +633,114 @@ def get_mock_benchmark_returns(symbol: str, start_date: date, end_date: date) ->
         "data_source": "mock"
     }
 
+def _next_trading_day(day: date) -> date:
+    """First weekday on or after a date (exchange holidays are not modelled)"""
+    while day.weekday() >= 5:
+        day += timedelta(days=1)
+    return day
+
+def _previous_trading_day(day: date) -> date:
+    """Last weekday on or before a date (exchange holidays are not modelled)"""
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return day
+
+def last_completed_session(today: Optional[date] = None) -> date:
+    """
+    Latest weekday whose daily bar can exist (before today, in UTC)
+
+    Today's session has not closed, so it has no bar yet.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    return _previous_trading_day(today - timedelta(days=1))
+
+def missing_benchmark_ranges(
+    start_date: date,
+    end_date: date,
+    coverage: Optional[Dict],
+    today: Optional[date] = None
+) -> List[Tuple[date, date]]:
+    """
+    Date ranges that still need downloading for one symbol
+
+    Compares the cached first/last bar dates against the requested window
+    on a weekday calendar, so a symbol that is already current needs no
+    request at all and one that is a day behind fetches only that day.
+    The window ends at the last completed session; later days have no
+    bars to fetch yet.
+    """
+    end_date = min(end_date, last_completed_session(today))
+    if start_date > end_date:
+        return []
+    if not coverage:
+        return [(start_date, end_date)]
+
+    ranges = []
+    if coverage["first_date"] > _next_trading_day(start_date):
+        ranges.append((start_date, coverage["first_date"] - timedelta(days=1)))
+    if coverage["last_date"] < _previous_trading_day(end_date):
+        ranges.append((coverage["last_date"] + timedelta(days=1), end_date))
+    return ranges
+
+async def refresh_benchmark(symbol: str, ranges: List[Tuple[date, date]]) -> int:
+    """Download and cache the missing ranges for one symbol"""
+    bar_count = 0
+    for range_start, range_end in ranges:
+        cached = await cache_benchmark_bars(symbol, range_start, range_end)
+        bar_count += cached["bars"]
+    return bar_count
+
 async def fetch_and_cache_benchmarks():
     """
     Background task to fetch and cache benchmark data for popular symbols
+
+    Only date ranges missing from the cache are downloaded, so repeat runs
+    cost one coverage query plus at most a request per stale symbol.
     """
     symbols = ["SPY", "QQQ", "DIA", "IWM", "VTI", "VOO", "AGG", "GLD"]
     end_date = datetime.now().date()
     start_date = end_date - timedelta(days=730)  # 2 years of data
 
-    print(f"Fetching benchmark data for {len(symbols)} symbols...")
-
-    tasks = [
-        fetch_benchmark_from_api(symbol, start_date, end_date)
+    coverage = await db.get_benchmark_coverage(symbols)
+    plan = {
+        symbol: missing_benchmark_ranges(start_date, end_date, coverage.get(symbol))
         for symbol in symbols
-    ]
+    }
+    stale = [symbol for symbol in symbols if plan[symbol]]
+
+    print(f"Fetching benchmark data for {len(stale)}/{len(symbols)} symbols...")
+
+    tasks = [refresh_benchmark(symbol, plan[symbol]) for symbol in stale]
 
     results = await asyncio.gather(*tasks, return_exceptions=True)
 
-    success_count = sum(1 for r in results if r and not isinstance(r, Exception))
-    print(f"Successfully cached {success_count}/{len(symbols)} benchmarks")
+    for symbol, result in zip(stale, results):
+        if isinstance(result, Exception):
+            print(f"API fetch error for {symbol}: {result}")
+
+    success_count = sum(1 for r in results if not isinstance(r, Exception))
+    bars_fetched = sum(r for r in results if not isinstance(r, Exception))
+    print(f"Successfully refreshed {success_count}/{len(stale)} benchmarks ({bars_fetched} bars)")
+
+    for symbol in stale:
+        benchmark_cache.invalidate(symbol)
 
     return {
         "symbols_updated": success_count,
+        "symbols_up_to_date": len(symbols) - len(stale),
         "total_symbols": len(symbols),
+        "bars_fetched": bars_fetched,
         "date_range": {
             "start": start_date.isoformat(),
             "end": end_date.isoformat()
         }
     }
 
-async def calculate_sharpe_ratio(user_id: str, risk_free_rate: float = 0.02) -> float:
+async def calculate_sharpe_ratio(user_id: str, risk_free_rate: float = equity_curve.RISK_FREE_RATE) -> float:
     """
-    Calculate Sharpe Ratio for user's trading performance
-    Sharpe Ratio = (Average Return - Risk Free Rate) / Standard Deviation
-    """
-    trades = await db.get_user_trades(user_id)
-
-    if len(trades) < 2:
-        return 0.0
-
-    # Calculate daily returns
-    returns = []
-    for i in range(1, len(trades)):
-        prev_value = trades[i-1]["value"]
-        curr_value = trades[i]["value"]
-        daily_return = (curr_value - prev_value) / prev_value if prev_value > 0 else 0
-        returns.append(daily_return)
-
-    if not returns:
-        return 0.0
+    Annualized Sharpe ratio of the user's daily equity curve
 
-    # Calculate average return and standard deviation
-    avg_return = sum(returns) / len(returns)
-    variance = sum((r - avg_return) ** 2 for r in returns) / len(returns)
-    std_dev = variance ** 0.5
-
-    # Calculate Sharpe Ratio
-    sharpe = (avg_return - risk_free_rate) / std_dev if std_dev > 0 else 0.0
-
-    return round(sharpe, 2)
+    See equity_curve.get_risk_metrics() for the full set of risk metrics.
+    """
+    metrics = await equity_curve.get_risk_metrics(user_id, risk_free_rate)
+    return metrics["sharpe_ratio"] or 0.0
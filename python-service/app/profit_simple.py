@@ -4,17 +4,137 @@ Clean pandas-based approach for comparative analysis
 Based on user's implementation pattern
 """
 
+import numpy as np
 import pandas as pd
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 from datetime import datetime, date
-from . import db
+from . import analytics_executor, benchmark_cache, db, lots, profit
+
+SIDE_DTYPE = pd.CategoricalDtype(["buy", "sell"])
+
+
+def build_trade_frame(trades_data) -> pd.DataFrame:
+    """
+    Build the analytics frame shared by every function in this module
+
+    Accepts the columns from db.fetch_user_trades_columns() or a list of
+    trade dicts. Sides become a categorical, and value / signed_value /
+    buy_value are computed with NumPy arrays instead of a per-row Python
+    lambda. Sells count positive, everything else negative.
+    """
+    trades = pd.DataFrame(trades_data)
+
+    side = trades['side']
+    if isinstance(side.dtype, pd.CategoricalDtype):
+        # Columnar fetch already lowercases sides
+        trades['side'] = side.cat.set_categories(SIDE_DTYPE.categories)
+    else:
+        trades['side'] = side.str.lower().astype(SIDE_DTYPE)
+    qty = trades['qty'].to_numpy(dtype=np.float64)
+    price = trades['price'].to_numpy(dtype=np.float64)
+    value = qty * price
+
+    codes = trades['side'].cat.codes.to_numpy()
+    is_buy = codes == 0
+    is_sell = codes == 1
+    sign = np.where(is_sell, 1.0, -1.0)
+
+    trades['value'] = value
+    trades['signed_value'] = value * sign
+    trades['buy_value'] = np.where(is_buy, value, 0.0)
+    trades['sell_value'] = np.where(is_sell, value, 0.0)
+
+    if not pd.api.types.is_datetime64_any_dtype(trades['executed_at']):
+        trades['executed_at'] = pd.to_datetime(trades['executed_at'])
+
+    return trades
+
+
+def user_returns(trades: pd.DataFrame) -> Dict:
+    """
+    PnL, invested value and traded date range for a trade frame
+    """
+    # PnL by symbol
+    pnl = trades.groupby('symbol', sort=False, observed=True)['signed_value'].sum().to_dict()
+    total_user_pnl = float(trades['signed_value'].sum())
+
+    # Compute user return percent vs invested
+    invested = float(trades['buy_value'].sum())
+
+    return {
+        "pnl": total_user_pnl,
+        "invested": invested,
+        "per_symbol_pnl": {k: float(v) for k, v in pnl.items()},
+        "start": trades['executed_at'].min().date(),
+        "end": trades['executed_at'].max().date()
+    }
+
+
+def _frame_task(columns: Dict, compute: Callable[[pd.DataFrame], Dict]) -> Dict:
+    """Executor task: build the frame from columns and run compute on it"""
+    return compute(build_trade_frame(columns))
+
+
+async def _analyze(
+    user_id: str,
+    compute: Callable[[pd.DataFrame], Dict],
+    trades: Optional[pd.DataFrame] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
+) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """
+    Run compute(frame) over a user's trades
+
+    A prebuilt frame is computed on directly. Otherwise the user's columns
+    are fetched and handed to the analytics executor, which runs large
+    inputs in the process pool. Returns (result, timing); result is None
+    when there are no trades and timing is None for prebuilt frames.
+    """
+    if trades is not None:
+        if trades.empty:
+            return None, None
+        return compute(trades), None
+
+    columns = await db.fetch_user_trades_columns(user_id, start_date, end_date)
+    if not len(columns['id']):
+        return None, None
+    return await analytics_executor.run(_frame_task, columns, compute)
+
+
+def _benchmark_comparison(
+    series: benchmark_cache.BenchmarkSeries,
+    user_return_pct: float,
+    start: date,
+    end: date
+) -> Dict:
+    """Benchmark return over the user's traded range and the difference"""
+    bench_range = benchmark_cache.series_price_range(series, start, end)
+
+    if not bench_range:
+        bench_return_pct = None
+    else:
+        first_close = bench_range['start_price']
+        last_close = bench_range['end_price']
+        bench_return_pct = ((last_close - first_close) / first_close) * 100
+
+    # Calculate difference
+    difference_pct = None
+    if bench_return_pct is not None:
+        difference_pct = user_return_pct - bench_return_pct
+
+    return {
+        "benchmark_symbol": series.symbol,
+        "benchmark_return_pct": round(bench_return_pct, 2) if bench_return_pct is not None else None,
+        "difference_pct": round(difference_pct, 2) if difference_pct is not None else None
+    }
 
 
 async def get_user_vs_benchmark(
     user_id: str,
     benchmark_symbol: str = "SPY",
     start_date: Optional[date] = None,
-    end_date: Optional[date] = None
+    end_date: Optional[date] = None,
+    trades: Optional[pd.DataFrame] = None
 ) -> Dict:
     """
     Compare user trading performance vs benchmark
@@ -25,68 +145,65 @@ async def get_user_vs_benchmark(
         benchmark_symbol: Benchmark ticker (SPY, QQQ, etc.)
         start_date: Optional start date filter
         end_date: Optional end date filter
+        trades: Optional prebuilt frame from build_trade_frame()
 
     Returns:
         Dict with user PnL, returns, and comparison vs benchmark
     """
-    # Fetch user trades
-    trades_list = await db.get_user_trades(user_id, start_date, end_date)
-
-    if not trades_list:
-        return {"error": "no_trades"}
+    result = await get_user_vs_benchmarks(user_id, [benchmark_symbol], start_date, end_date, trades)
+    if "error" in result:
+        return result
 
-    # Convert to pandas DataFrame
-    trades = pd.DataFrame(trades_list)
-
-    # Compute realized pnl per symbol (simplified)
-    trades['signed_value'] = trades.apply(
-        lambda r: r['qty'] * r['price'] * (1 if r['side'].lower() == 'sell' else -1),
-        axis=1
-    )
+    comparison = result.pop("benchmarks")[0]
+    return {
+        "user_pnl": result.pop("user_pnl"),
+        "user_return_pct": result.pop("user_return_pct"),
+        **comparison,
+        **result
+    }
 
-    # PnL by symbol
-    pnl = trades.groupby('symbol')['signed_value'].sum().to_dict()
-    total_user_pnl = float(trades['signed_value'].sum())
 
-    # Compute user return percent vs invested
-    buy_trades = trades[trades['side'].str.lower() == 'buy']
-    invested = float(buy_trades['value'].sum()) if not buy_trades.empty else 0
+async def get_user_vs_benchmarks(
+    user_id: str,
+    benchmark_symbols: List[str],
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    trades: Optional[pd.DataFrame] = None
+) -> Dict:
+    """
+    Compare user trading performance vs several benchmarks
 
-    user_return_pct = (total_user_pnl / invested * 100) if invested > 0 else 0.0
+    The user's returns are computed once and the benchmark series are
+    loaded together (one query for those not cached), so N benchmarks
+    cost one trade scan instead of N.
 
-    # Determine date range from trades if not provided
-    if trades['executed_at'].dtype == 'object':
-        trades['executed_at'] = pd.to_datetime(trades['executed_at'])
+    Returns:
+        Dict with user PnL and returns, and a "benchmarks" list with one
+        comparison per symbol
+    """
+    returns, timing = await _analyze(user_id, user_returns, trades, start_date, end_date)
 
-    actual_start = trades['executed_at'].min().date()
-    actual_end = trades['executed_at'].max().date()
+    if returns is None:
+        return {"error": "no_trades"}
 
-    # Benchmark return: pull from cached benchmarks
-    bench_df_list = await db.fetch_benchmark_range(benchmark_symbol, actual_start, actual_end)
+    total_user_pnl = returns['pnl']
+    invested = returns['invested']
+    user_return_pct = (total_user_pnl / invested * 100) if invested > 0 else 0.0
 
-    if not bench_df_list:
-        bench_return_pct = None
-    else:
-        bench_df = pd.DataFrame(bench_df_list)
-        if bench_df.empty or len(bench_df) < 2:
-            bench_return_pct = None
-        else:
-            first_close = float(bench_df.iloc[0]['close'])
-            last_close = float(bench_df.iloc[-1]['close'])
-            bench_return_pct = ((last_close - first_close) / first_close) * 100
+    actual_start = returns['start']
+    actual_end = returns['end']
 
-    # Calculate difference
-    difference_pct = None
-    if bench_return_pct is not None:
-        difference_pct = user_return_pct - bench_return_pct
+    # Benchmark returns: pull from the in-process benchmark series cache
+    series = await benchmark_cache.get_many(benchmark_symbols)
 
-    return {
+    result = {
         "user_pnl": round(total_user_pnl, 2),
         "user_return_pct": round(user_return_pct, 2),
-        "benchmark_symbol": benchmark_symbol,
-        "benchmark_return_pct": round(bench_return_pct, 2) if bench_return_pct is not None else None,
-        "difference_pct": round(difference_pct, 2) if difference_pct is not None else None,
-        "per_symbol_pnl": {k: round(v, 2) for k, v in pnl.items()},
+        "benchmarks": [
+            _benchmark_comparison(series[symbol], user_return_pct, actual_start, actual_end)
+            for symbol in benchmark_symbols
+        ],
+        "per_symbol_pnl": {k: round(v, 2) for k, v in returns['per_symbol_pnl'].items()},
         "timeframe": {
             "start": actual_start.isoformat(),
             "end": actual_end.isoformat(),
@@ -94,29 +211,30 @@ async def get_user_vs_benchmark(
         },
         "invested": round(invested, 2)
     }
+    if timing:
+        result["execution"] = timing
+    return result
 
 
 async def recompute_user_metrics(user_id: str) -> Dict:
     """
-    Schedule a job to recompute cached metrics
+    Recompute a user's metrics using the simplified calculation
     """
-    # Get metrics using simplified calculation
-    metrics = await get_user_vs_benchmark(user_id)
-
-    # Cache the results
-    await db.cache_user_metrics(user_id, metrics)
-
-    return metrics
+    return await get_user_vs_benchmark(user_id)
 
 
 async def get_portfolio_summary(user_id: str) -> Dict:
     """
     Get comprehensive portfolio summary
     Includes per-symbol breakdown and overall stats
+
+    Reads the stored per-symbol positions (app/lots.py), so realized PnL
+    comes from matched lots and open lots are marked at the last trade
+    price, in O(symbols).
     """
-    trades_list = await db.fetch_trades_for_user(user_id)
+    positions = [lots.Position.from_row(row) for row in await profit.get_user_positions(user_id)]
 
-    if not trades_list:
+    if not positions:
         return {
             "user_id": user_id,
             "total_trades": 0,
@@ -127,82 +245,76 @@ async def get_portfolio_summary(user_id: str) -> Dict:
             "return_pct": 0
         }
 
-    trades = pd.DataFrame(trades_list)
-
-    # Calculate signed values
-    trades['signed_value'] = trades.apply(
-        lambda r: r['qty'] * r['price'] * (1 if r['side'].lower() == 'sell' else -1),
-        axis=1
-    )
+    symbol_stats_list = []
+    for position in positions:
+        unrealized = position.unrealized_pnl()
+        pnl = position.realized_pnl + unrealized
+        average_cost = position.average_cost
+        symbol_stats_list.append({
+            "symbol": position.symbol,
+            "trades": position.trade_count,
+            "invested": round(position.buy_value, 2),
+            "quantity": position.quantity,
+            "average_cost": round(average_cost, 4) if average_cost is not None else None,
+            "last_price": position.last_price,
+            "realized_pnl": round(position.realized_pnl, 2),
+            "unrealized_pnl": round(unrealized, 2),
+            "pnl": round(pnl, 2),
+            "return_pct": round(pnl / position.buy_value * 100, 2) if position.buy_value > 0 else 0.0
+        })
+    # Sorted by PnL descending
+    symbol_stats_list.sort(key=lambda entry: entry["pnl"], reverse=True)
 
     # Overall stats
-    buy_value = trades[trades['side'].str.lower() == 'buy']['value'].sum()
-    sell_value = trades[trades['side'].str.lower() == 'sell']['value'].sum()
-    net_pnl = sell_value - buy_value
+    buy_value = sum(position.buy_value for position in positions)
+    sell_value = sum(position.sell_value for position in positions)
+    realized_pnl = sum(position.realized_pnl for position in positions)
+    unrealized_pnl = sum(position.unrealized_pnl() for position in positions)
+    net_pnl = realized_pnl + unrealized_pnl
     return_pct = (net_pnl / buy_value * 100) if buy_value > 0 else 0
 
-    # Per-symbol breakdown
-    symbol_stats = []
-    for symbol in trades['symbol'].unique():
-        symbol_trades = trades[trades['symbol'] == symbol]
-        symbol_pnl = symbol_trades['signed_value'].sum()
-        symbol_buys = symbol_trades[symbol_trades['side'].str.lower() == 'buy']
-        symbol_invested = symbol_buys['value'].sum() if not symbol_buys.empty else 0
-        symbol_return = (symbol_pnl / symbol_invested * 100) if symbol_invested > 0 else 0
-
-        symbol_stats.append({
-            "symbol": symbol,
-            "trades": len(symbol_trades),
-            "invested": round(symbol_invested, 2),
-            "pnl": round(symbol_pnl, 2),
-            "return_pct": round(symbol_return, 2)
-        })
-
-    # Sort by PnL descending
-    symbol_stats.sort(key=lambda x: x['pnl'], reverse=True)
-
     return {
         "user_id": user_id,
-        "total_trades": len(trades),
-        "symbols_traded": len(trades['symbol'].unique()),
+        "total_trades": sum(position.trade_count for position in positions),
+        "symbols_traded": len(positions),
+        "open_positions": sum(1 for position in positions if position.lots),
+        "cost_basis_method": lots.COST_BASIS_METHOD,
         "total_invested": round(buy_value, 2),
         "total_realized": round(sell_value, 2),
+        "realized_pnl": round(realized_pnl, 2),
+        "unrealized_pnl": round(unrealized_pnl, 2),
         "net_pnl": round(net_pnl, 2),
         "return_pct": round(return_pct, 2),
-        "top_performers": symbol_stats[:5],
-        "all_symbols": symbol_stats
+        "top_performers": symbol_stats_list[:5],
+        "all_symbols": symbol_stats_list
     }
 
 
 async def calculate_win_rate(user_id: str) -> Dict:
     """
     Calculate win rate and trading statistics
+
+    A closing trade wins when the lots it matched realized a profit;
+    counts and gross PnL are kept on the stored positions.
     """
-    trades_list = await db.fetch_trades_for_user(user_id)
+    positions = await profit.get_user_positions(user_id)
 
-    if not trades_list:
+    if not positions:
         return {"win_rate": 0, "total_trades": 0}
 
-    trades = pd.DataFrame(trades_list)
-    trades['signed_value'] = trades.apply(
-        lambda r: r['qty'] * r['price'] * (1 if r['side'].lower() == 'sell' else -1),
-        axis=1
-    )
-
-    # Group by symbol and calculate per-symbol PnL
-    symbol_pnls = trades.groupby('symbol')['signed_value'].sum()
-
-    winning_trades = (symbol_pnls > 0).sum()
-    losing_trades = (symbol_pnls < 0).sum()
-    total_symbols = len(symbol_pnls)
+    summary = lots.summarize_positions(positions)
+    winning_trades = summary["winning_closes"]
+    losing_trades = summary["losing_closes"]
+    closing_trades = winning_trades + losing_trades
 
-    win_rate = (winning_trades / total_symbols * 100) if total_symbols > 0 else 0
+    win_rate = (winning_trades / closing_trades * 100) if closing_trades > 0 else 0
 
     return {
         "win_rate": round(win_rate, 2),
-        "winning_trades": int(winning_trades),
-        "losing_trades": int(losing_trades),
-        "total_symbols_traded": int(total_symbols),
-        "average_win": round(symbol_pnls[symbol_pnls > 0].mean(), 2) if winning_trades > 0 else 0,
-        "average_loss": round(symbol_pnls[symbol_pnls < 0].mean(), 2) if losing_trades > 0 else 0
+        "winning_trades": winning_trades,
+        "losing_trades": losing_trades,
+        "total_symbols_traded": len(positions),
+        "realized_pnl": round(summary["realized_pnl"], 2),
+        "average_win": round(summary["gross_profit"] / winning_trades, 2) if winning_trades > 0 else 0,
+        "average_loss": round(summary["gross_loss"] / losing_trades, 2) if losing_trades > 0 else 0
     }
@@ -0,0 +1,383 @@
+"""
+Bulk historical compliance re-screening
+Re-runs the PDT, wash sale, position size and custom rule checks over every
+stored trade, user by user, as vectorized passes in the analytics process
+pool, writing audits in bulk. Runs are resumable:
+
+    python -m app.rescreen                 # start a new run
+    python -m app.rescreen --resume 12     # continue run 12
+"""
+
+import argparse
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from . import analytics_executor, db, profit, rule_engine, wash_sale
+from .compliance import ComplianceRules
+
+# Users screened per page; a page's audits and the resume cursor are
+# committed together
+RESCREEN_PAGE_USERS = int(os.getenv("RESCREEN_PAGE_USERS", "50"))
+
+# Users with at least this many trades are screened in the process pool
+RESCREEN_OFFLOAD_MIN_ROWS = int(os.getenv("RESCREEN_OFFLOAD_MIN_ROWS", "2000"))
+
+# Runs executing in this process, by run id
+_tasks: Dict[int, asyncio.Task] = {}
+
+
+async def current_params() -> Dict:
+    """Snapshot of the thresholds and custom rules a new run screens against"""
+    rule_set = await rule_engine.get_rule_set()
+    return {
+        "pdt_trade_threshold": ComplianceRules.PDT_TRADE_THRESHOLD,
+        "pdt_days": ComplianceRules.PDT_DAYS,
+        "pdt_min_equity": ComplianceRules.PDT_MIN_EQUITY,
+        "max_position_size_percent": ComplianceRules.MAX_POSITION_SIZE_PERCENT,
+        "wash_sale_days": ComplianceRules.WASH_SALE_DAYS,
+        "custom_rules": [rule.config for rule in rule_set.rules],
+    }
+
+
+def screen_user_trades(columns: Dict, params: Dict) -> Dict:
+    """
+    Run every re-screening check over one user's full trade history
+
+    Pure array code so it can run in the analytics process pool. Day
+    trades per symbol-day are min(buys, sells), summed over the business
+    days ending on each trade's date with a cumulative sum; wash sales use
+    wash_sale.screen_wash_sales; custom rules use RuleSet.evaluate_batch.
+    """
+    qty = np.asarray(columns["qty"], dtype=np.float64)
+    price = np.asarray(columns["price"], dtype=np.float64)
+    symbol = pd.Categorical(columns["symbol"])
+    side = pd.Categorical(columns["side"])
+    days = np.asarray(columns["executed_at"]).astype("datetime64[D]")
+    day_numbers = days.astype(np.int64)
+    n = len(qty)
+
+    side_categories = list(side.categories)
+    is_buy = side.codes == side_categories.index("buy") if "buy" in side_categories else np.zeros(n, bool)
+    is_sell = side.codes == side_categories.index("sell") if "sell" in side_categories else np.zeros(n, bool)
+
+    # Position size (value against the user's current account equity; a
+    # non-positive equity puts every trade over the limit)
+    position_value = qty * price
+    if params["portfolio_value"] > 0:
+        position_percent = position_value / params["portfolio_value"] * 100
+    else:
+        position_percent = np.full(n, np.inf)
+
+    # Pattern day trading
+    first_day = int(day_numbers.min())
+    span = int(day_numbers.max()) - first_day + 1
+    keys = symbol.codes.astype(np.int64) * span + (day_numbers - first_day)
+    unique_keys, key_index = np.unique(keys, return_inverse=True)
+    buys = np.bincount(key_index, weights=is_buy, minlength=len(unique_keys))
+    sells = np.bincount(key_index, weights=is_sell, minlength=len(unique_keys))
+    per_day = np.bincount(unique_keys % span, weights=np.minimum(buys, sells), minlength=span)
+    cumulative = np.concatenate(([0.0], np.cumsum(per_day)))
+
+    window_start = np.busday_offset(days, -(params["pdt_days"] - 1), roll="backward")
+    start_offset = np.clip(window_start.astype(np.int64) - first_day, 0, None)
+    end_offset = day_numbers - first_day
+    day_trades = (cumulative[end_offset + 1] - cumulative[start_offset]).astype(np.int64)
+
+    # Wash sales (every sell in the history)
+    wash = wash_sale.screen_wash_sales(
+        columns,
+        days.min().item(),
+        days.max().item(),
+        params["wash_sale_days"]
+    )
+
+    # Custom rules
+    rule_set = rule_engine.RuleSet(params["custom_rules"], "rescreen")
+    custom = rule_set.evaluate_batch(symbol, qty, price)
+
+    return {
+        "is_sell": is_sell,
+        "position_value": position_value,
+        "position_percent": position_percent,
+        "day_trades": day_trades,
+        "pdt_window_start": window_start,
+        "wash": wash,
+        "custom": custom,
+    }
+
+
+def build_audits(
+    user_id: str,
+    run_id: int,
+    columns: Dict,
+    screen: Dict,
+    params: Dict,
+    include_passes: bool
+) -> Tuple[List[Dict], int]:
+    """
+    Turn a screen_user_trades() result into audit rows
+
+    Returns (audits, flagged). Only flagged results are written unless
+    include_passes is set, which also writes a pass row per trade and check.
+    """
+    ids = columns["id"]
+    symbols = columns["symbol"]
+    days = np.asarray(columns["executed_at"]).astype("datetime64[D]")
+    audits = []
+    flagged = 0
+
+    def add(row: int, check_name: str, status: str, reason: str, metadata: Dict):
+        audits.append({
+            "user_id": user_id,
+            "trade_id": str(ids[row]),
+            "check_name": check_name,
+            "status": status,
+            "reason": reason,
+            "metadata": {**metadata, "rescreen_id": run_id}
+        })
+
+    # Position size
+    limit = params["max_position_size_percent"]
+    over_limit = screen["position_percent"] > limit
+    flagged += int(over_limit.sum())
+    for row in np.flatnonzero(over_limit) if not include_passes else range(len(ids)):
+        percent = float(screen["position_percent"][row])
+        if over_limit[row] and params["portfolio_value"] <= 0:
+            add(row, "position_size_limit", "flag",
+                f"Account equity ${params['portfolio_value']:,.2f} is not positive", {
+                    "position_value": float(screen["position_value"][row]),
+                    "portfolio_value": params["portfolio_value"],
+                    "limit_percent": limit
+                })
+        elif over_limit[row]:
+            add(row, "position_size_limit", "flag",
+                f"Position size {percent:.1f}% exceeds limit of {limit}%", {
+                    "position_value": float(screen["position_value"][row]),
+                    "portfolio_value": params["portfolio_value"],
+                    "position_percent": round(percent, 2),
+                    "limit_percent": limit
+                })
+        else:
+            add(row, "position_size_limit", "pass",
+                f"Position size {percent:.1f}% within limit", {
+                    "position_percent": round(percent, 2),
+                    "limit_percent": limit
+                })
+
+    # Pattern day trading
+    threshold = params["pdt_trade_threshold"]
+    pdt_flag = screen["day_trades"] >= threshold
+    flagged += int(pdt_flag.sum())
+    for row in np.flatnonzero(pdt_flag) if not include_passes else range(len(ids)):
+        count = int(screen["day_trades"][row])
+        if pdt_flag[row]:
+            add(row, "pattern_day_trading", "flag",
+                f"Pattern Day Trading detected: {count} day trades in {params['pdt_days']} business days. "
+                f"Minimum equity of ${params['pdt_min_equity']:,} required.", {
+                    "day_trades_count": count,
+                    "threshold": threshold,
+                    "period_days": params["pdt_days"],
+                    "window_start": str(screen["pdt_window_start"][row]),
+                    "window_end": str(days[row])
+                })
+        else:
+            add(row, "pattern_day_trading", "pass",
+                f"{count} day trades in {params['pdt_days']} business days (threshold: {threshold})", {
+                    "day_trades_count": count,
+                    "threshold": threshold
+                })
+
+    # Wash sale
+    wash = screen["wash"]
+    wash_rows = set(int(row) for row in wash["index"])
+    flagged += len(wash_rows)
+    for row, buys, first_buy, last_buy in zip(wash["index"], wash["buys"], wash["first_buy"], wash["last_buy"]):
+        add(row, "wash_sale", "flag",
+            f"Potential wash sale detected: {int(buys)} buy transaction(s) of {symbols[row]} "
+            f"within {params['wash_sale_days']} days of sale", {
+                "symbol": symbols[row],
+                "wash_sale_period_days": params["wash_sale_days"],
+                "related_buys_count": int(buys),
+                "first_buy_date": str(first_buy),
+                "last_buy_date": str(last_buy)
+            })
+    if include_passes:
+        for row in range(len(ids)):
+            if row in wash_rows:
+                continue
+            if screen["is_sell"][row]:
+                add(row, "wash_sale", "pass", f"No wash sale detected for {symbols[row]}", {"symbol": symbols[row]})
+            else:
+                add(row, "wash_sale", "pass", "Not applicable (not a sell transaction)", {})
+
+    # Custom rules
+    custom = screen["custom"]
+    rules = params["custom_rules"]
+    flagged += int(custom["flagged"].sum())
+    for rule_index, row, rule_flagged in zip(custom["rule"], custom["row"], custom["flagged"]):
+        if not rule_flagged and not include_passes:
+            continue
+        rule = rules[rule_index]
+        add(row, rule.get("name", "custom_check"), "flag" if rule_flagged else "pass",
+            rule.get("message", "Custom check failed") if rule_flagged else None, rule)
+
+    return audits, flagged
+
+
+async def _screen_user(
+    user_id: str,
+    run: Dict,
+    semaphore: asyncio.Semaphore
+) -> Tuple[List[Dict], int, int]:
+    async with semaphore:
+        columns = await db.fetch_user_trades_columns(user_id)
+        if not len(columns["id"]):
+            return [], 0, 0
+        # Historical equity is not stored; size is judged against the
+        # user's current snapshot
+        equity = await profit.load_user_equity(user_id)
+        params = {**run["params"], "portfolio_value": equity["equity"]}
+        screen, _ = await analytics_executor.run(
+            screen_user_trades,
+            columns,
+            params,
+            min_rows=RESCREEN_OFFLOAD_MIN_ROWS
+        )
+    audits, flagged = build_audits(
+        user_id, run["id"], columns, screen, params, run["include_passes"]
+    )
+    return audits, flagged, len(columns["id"])
+
+
+async def create_run(include_passes: bool = False) -> Dict:
+    """Record a new run screening against the current thresholds and rules"""
+    params = await current_params()
+    total_users = await db.count_trade_users()
+    return await db.create_rescreen(params, include_passes, total_users)
+
+
+async def run(
+    run_id: int,
+    concurrency: int = max(analytics_executor.ANALYTICS_PROCESSES, 1),
+    page_users: int = RESCREEN_PAGE_USERS
+) -> Dict:
+    """
+    Execute (or resume) a run until every user has been screened
+
+    Users are visited in user_id order starting after the run's cursor, a
+    page at a time, with up to `concurrency` users in flight. Only one
+    process can execute a given run at a time.
+    """
+    lock = await db.try_lock_rescreen(run_id)
+    if lock is None:
+        raise RuntimeError(f"Re-screening run {run_id} is already executing")
+
+    try:
+        state = await db.get_rescreen(run_id)
+        if state is None:
+            raise ValueError(f"Re-screening run {run_id} not found")
+        if state["status"] == "completed":
+            return state
+
+        cursor = str(state["cursor_user_id"]) if state["cursor_user_id"] else None
+        semaphore = asyncio.Semaphore(concurrency)
+
+        try:
+            while True:
+                user_ids = await db.get_trade_user_ids_after(cursor, page_users)
+                if not user_ids:
+                    break
+
+                results = await asyncio.gather(*[
+                    _screen_user(user_id, state, semaphore) for user_id in user_ids
+                ])
+                audits = [audit for user_audits, _, _ in results for audit in user_audits]
+                state = await db.save_rescreen_page(
+                    run_id,
+                    audits,
+                    user_ids[-1],
+                    len(user_ids),
+                    sum(trades for _, _, trades in results),
+                    sum(flagged for _, flagged, _ in results)
+                )
+                cursor = user_ids[-1]
+                print(
+                    f"Re-screen {run_id}: {state['users_done']}/{state['total_users']} users, "
+                    f"{state['trades_screened']} trades, {state['flagged']} flagged"
+                )
+        except asyncio.CancelledError:
+            await db.finish_rescreen(run_id, "paused")
+            raise
+        except Exception as e:
+            await db.finish_rescreen(run_id, "failed", str(e))
+            raise
+
+        return await db.finish_rescreen(run_id, "completed")
+    finally:
+        await db.unlock_rescreen(lock, run_id)
+
+
+def start_in_background(run_id: int) -> bool:
+    """Execute a run as a task of this process; False if already running here"""
+    task = _tasks.get(run_id)
+    if task is not None and not task.done():
+        return False
+
+    async def execute():
+        try:
+            await run(run_id)
+        except Exception as e:
+            print(f"Re-screening run {run_id} stopped: {e}")
+        finally:
+            _tasks.pop(run_id, None)
+
+    _tasks[run_id] = asyncio.create_task(execute())
+    return True
+
+
+async def stop():
+    """Pause runs executing in this process; they can be resumed later"""
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def progress(state: Dict) -> Dict:
+    """A run's state with its completion percentage"""
+    total = state.get("total_users") or 0
+    percent = round(state["users_done"] / total * 100, 2) if total else None
+    return {
+        **state,
+        "percent_complete": min(percent, 100.0) if percent is not None else None,
+        "executing_here": state["id"] in _tasks
+    }
+
+
+async def main(resume: Optional[int], include_passes: bool, concurrency: int):
+    await db.ensure_schema()
+    try:
+        if resume is None:
+            state = await create_run(include_passes)
+            print(f"Started re-screening run {state['id']} over {state['total_users']} users")
+            run_id = state["id"]
+        else:
+            run_id = resume
+        state = await run(run_id, concurrency)
+        print(f"Re-screening run {run_id} {state['status']}: {state['audits_written']} audits written")
+    finally:
+        analytics_executor.shutdown()
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-screen historical trades against current compliance rules")
+    parser.add_argument("--resume", type=int, help="Continue an existing run by id")
+    parser.add_argument("--include-passes", action="store_true", help="Also write pass audits (new runs only)")
+    parser.add_argument("--concurrency", type=int, default=max(analytics_executor.ANALYTICS_PROCESSES, 1),
+                        help="Users screened at once")
+    args = parser.parse_args()
+    asyncio.run(main(args.resume, args.include_passes, args.concurrency))
@@ -0,0 +1,180 @@
+"""
+Per-user response cache for read endpoints
+Keeps rendered response bodies in a bounded LRU keyed by user, endpoint
+and arguments. Each entry records the user's watermark (trades and equity
+marks) and is only served while the watermark is unchanged, so trades
+ingested or positions marked by any process invalidate it; ingest in this
+process also drops entries eagerly
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+from . import db
+from .singleflight import SingleFlight
+
+# Maximum cached responses across all users (least recently used evicted;
+# 0 disables caching, ETags are still sent)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+
+# Upper bound on an entry's age; covers inputs other than trades, such as
+# benchmark bars written by another process
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "300"))
+
+CacheKey = Tuple[str, str, Hashable]
+
+
+class CachedResponse:
+    """A rendered body with its ETag and the watermark it was computed at"""
+
+    __slots__ = ("watermark", "etag", "body", "stored_at")
+
+    def __init__(self, watermark: Optional[str], body: bytes):
+        self.watermark = watermark
+        self.etag = make_etag(body)
+        self.body = body
+        self.stored_at = time.monotonic()
+
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag over the response body"""
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches (weak comparison, as RFC 9110 requires)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class ResponseCache:
+    """
+    Bounded LRU of rendered responses, indexed by user for invalidation
+
+    Concurrent misses for the same key and watermark are coalesced, so a
+    burst of polls computes the response once (see stats["renders"]).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_SIZE,
+        ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[CacheKey, CachedResponse]" = OrderedDict()
+        self._by_user: Dict[str, Set[CacheKey]] = {}
+        self._flight = SingleFlight()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "renders": 0,
+            "not_modified": 0,
+            "invalidations": 0,
+            "evictions": 0
+        }
+
+    def _lookup(self, key: CacheKey, watermark: Optional[str]) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.watermark != watermark or time.monotonic() - entry.stored_at >= self.ttl_seconds:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: CacheKey, entry: CachedResponse):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._by_user.setdefault(key[0], set()).add(key)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._unindex(evicted)
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: CacheKey):
+        if self._entries.pop(key, None) is not None:
+            self._unindex(key)
+
+    def _unindex(self, key: CacheKey):
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+
+    async def fetch(
+        self,
+        user_id: str,
+        endpoint: str,
+        args: Hashable,
+        render: Callable[[], Awaitable[bytes]],
+        if_none_match: Optional[str] = None
+    ) -> Tuple[Optional[bytes], str]:
+        """
+        Get a response body from the cache, rendering it on a miss
+
+        Costs one user_metrics read (the watermark) when the entry is
+        current. Returns (body, etag); body is None when If-None-Match
+        already names the current ETag, i.e. the client may reuse its copy.
+        """
+        key = (user_id, endpoint, args)
+        watermark = await db.get_trade_watermark(user_id)
+
+        entry = self._lookup(key, watermark)
+        if entry is not None:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+
+            async def fill() -> CachedResponse:
+                # A coalesced caller finds the entry stored by the first one
+                cached = self._lookup(key, watermark)
+                if cached is not None:
+                    return cached
+                self.stats["renders"] += 1
+                cached = CachedResponse(watermark, await render())
+                self._store(key, cached)
+                return cached
+
+            entry = await self._flight.run((key, watermark), fill)
+
+        if etag_matches(if_none_match, entry.etag):
+            self.stats["not_modified"] += 1
+            return None, entry.etag
+        return entry.body, entry.etag
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Drop one user's cached responses, or all of them"""
+        if user_id is None:
+            self._entries.clear()
+            self._by_user.clear()
+        else:
+            for key in self._by_user.pop(user_id, ()):
+                self._entries.pop(key, None)
+        self.stats["invalidations"] += 1
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+_cache = ResponseCache()
+
+
+def get_cache() -> ResponseCache:
+    """Get the process-wide response cache"""
+    return _cache
+
+
+def invalidate(user_id: Optional[str] = None):
+    _cache.invalidate(user_id)
@@ -0,0 +1,239 @@
+"""
+Custom compliance rule engine
+Compiles JSON rules into a symbol-indexed dispatch table that is reloaded
+from the compliance_rules table (or a JSON file) without a restart
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from . import db
+
+# Load rules from this JSON file (a list of rule objects) instead of the database
+COMPLIANCE_RULES_FILE = os.getenv("COMPLIANCE_RULES_FILE")
+
+# How often get_rule_set() checks the rule source for changes
+RELOAD_CHECK_SECONDS = float(os.getenv("COMPLIANCE_RULES_RELOAD_SECONDS", "30"))
+
+# check_type -> metric of (qty, price); a rule flags a trade when the metric
+# exceeds its threshold. Metrics work on floats and NumPy arrays alike, so
+# single trades and batches are judged by the same code.
+METRICS: Dict[str, Callable[[Any, Any], Any]] = {
+    "max_value": lambda qty, price: qty * price,
+    "max_quantity": lambda qty, price: qty,
+}
+
+# Used when no rules file is configured and the compliance_rules table is empty
+DEFAULT_RULES = [
+    {
+        "name": "crypto_size_limit",
+        "check_type": "max_value",
+        "threshold": 50000,
+        "symbols": ["BTC", "ETH", "DOGE"],
+        "message": "Crypto trade exceeds $50k limit"
+    },
+    {
+        "name": "penny_stock_quantity_limit",
+        "check_type": "max_quantity",
+        "threshold": 100000,
+        "symbols": [],  # Apply to all
+        "message": "Excessive quantity for single trade"
+    }
+]
+
+
+class CompiledRule:
+    """One validated rule with its metric resolved"""
+
+    __slots__ = ("index", "name", "check_type", "metric", "threshold", "symbols", "message", "config")
+
+    def __init__(self, index: int, config: Dict):
+        check_type = config.get("check_type")
+        if check_type not in METRICS:
+            raise ValueError(f"unknown check_type {check_type!r}")
+
+        self.index = index
+        self.name = config.get("name", "custom_check")
+        self.check_type = check_type
+        self.metric = METRICS[check_type]
+        self.threshold = float(config.get("threshold", 0))
+        # None means the rule applies to every symbol
+        self.symbols = frozenset(config.get("symbols") or ()) or None
+        self.message = config.get("message", "Custom check failed")
+        self.config = config
+
+    def evaluate(self, qty: float, price: float) -> Tuple[str, str, Optional[str]]:
+        if self.metric(qty, price) > self.threshold:
+            return (self.name, "flag", self.message)
+        return (self.name, "pass", None)
+
+
+class RuleSet:
+    """
+    Compiled rules with a dispatch table keyed by symbol
+
+    rules_for(symbol) returns the rules scoped to that symbol plus every
+    wildcard rule, in definition order, with a single dict lookup; rules
+    scoped to other symbols are never visited. Invalid rules are skipped
+    at compile time and listed in `skipped`.
+    """
+
+    def __init__(self, rules: List[Dict], source: str, fingerprint: Any = None):
+        self.source = source
+        self.fingerprint = fingerprint
+        self.loaded_at = time.time()
+        self.rules: List[CompiledRule] = []
+        self.skipped: List[Dict] = []
+
+        for config in rules:
+            try:
+                self.rules.append(CompiledRule(len(self.rules), config))
+            except (TypeError, ValueError) as e:
+                self.skipped.append({"name": config.get("name"), "error": str(e)})
+
+        self.wildcard = [rule for rule in self.rules if rule.symbols is None]
+        scoped: Dict[str, List[CompiledRule]] = {}
+        for rule in self.rules:
+            for symbol in rule.symbols or ():
+                scoped.setdefault(symbol, []).append(rule)
+        self._dispatch = {
+            symbol: sorted(rules + self.wildcard, key=lambda rule: rule.index)
+            for symbol, rules in scoped.items()
+        }
+
+    def rules_for(self, symbol: str) -> List[CompiledRule]:
+        return self._dispatch.get(symbol, self.wildcard)
+
+    def evaluate(self, trade: Dict) -> List[Tuple[CompiledRule, Tuple[str, str, Optional[str]]]]:
+        """Evaluate one trade against the rules in scope for its symbol"""
+        qty = float(trade["qty"])
+        price = float(trade["price"])
+        return [(rule, rule.evaluate(qty, price)) for rule in self.rules_for(trade["symbol"])]
+
+    def evaluate_batch(self, symbols, qty: np.ndarray, price: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Evaluate an array of trades against every rule
+
+        Trades are grouped by symbol once; each rule then judges all of its
+        in-scope trades with one array comparison. Returns parallel arrays
+        with one entry per (trade, in-scope rule): the rule index into
+        self.rules, the trade's row and whether it was flagged.
+        """
+        symbol = pd.Categorical(symbols)
+        qty = np.asarray(qty, dtype=np.float64)
+        price = np.asarray(price, dtype=np.float64)
+        n = len(qty)
+
+        # Rows of each symbol: order[bounds[k]:bounds[k + 1]] for category k
+        codes = symbol.codes
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(symbol.categories) + 1))
+        category_of = {category: k for k, category in enumerate(symbol.categories)}
+
+        metrics = {check_type: fn(qty, price) for check_type, fn in METRICS.items()}
+        all_rows = np.arange(n)
+
+        rule_parts, row_parts, flag_parts = [], [], []
+        for rule in self.rules:
+            if rule.symbols is None:
+                rows = all_rows
+            else:
+                groups = [
+                    order[bounds[k]:bounds[k + 1]]
+                    for k in (category_of.get(s) for s in rule.symbols) if k is not None
+                ]
+                if not groups:
+                    continue
+                rows = np.sort(np.concatenate(groups))
+            if not len(rows):
+                continue
+
+            rule_parts.append(np.full(len(rows), rule.index))
+            row_parts.append(rows)
+            flag_parts.append(metrics[rule.check_type][rows] > rule.threshold)
+
+        if not rule_parts:
+            return {
+                "rule": np.empty(0, dtype=np.int64),
+                "row": np.empty(0, dtype=np.int64),
+                "flagged": np.empty(0, dtype=bool),
+            }
+        return {
+            "rule": np.concatenate(rule_parts),
+            "row": np.concatenate(row_parts),
+            "flagged": np.concatenate(flag_parts),
+        }
+
+    def summary(self) -> Dict:
+        return {
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+            "rules": len(self.rules),
+            "wildcard_rules": len(self.wildcard),
+            "symbols_indexed": len(self._dispatch),
+            "skipped": self.skipped,
+        }
+
+
+_rule_set: Optional[RuleSet] = None
+_checked_at = 0.0
+_lock: Optional[asyncio.Lock] = None
+
+
+async def _source_fingerprint() -> Any:
+    """Cheap change marker for the configured rule source"""
+    if COMPLIANCE_RULES_FILE:
+        return os.path.getmtime(COMPLIANCE_RULES_FILE)
+    return await db.get_compliance_rules_version()
+
+
+async def _load() -> RuleSet:
+    fingerprint = await _source_fingerprint()
+    if COMPLIANCE_RULES_FILE:
+        with open(COMPLIANCE_RULES_FILE) as f:
+            return RuleSet(json.load(f), f"file:{COMPLIANCE_RULES_FILE}", fingerprint)
+
+    rules = await db.get_compliance_rules()
+    if not rules:
+        return RuleSet(DEFAULT_RULES, "defaults", fingerprint)
+    return RuleSet(rules, "database", fingerprint)
+
+
+async def reload_rules() -> RuleSet:
+    """Recompile the rules from their source now"""
+    global _rule_set, _checked_at, _lock
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:
+        _rule_set = await _load()
+        _checked_at = time.monotonic()
+        print(f"Loaded {len(_rule_set.rules)} compliance rules from {_rule_set.source}")
+        return _rule_set
+
+
+async def get_rule_set() -> RuleSet:
+    """
+    Get the compiled rules, recompiling if the source changed
+
+    The source is checked at most every RELOAD_CHECK_SECONDS. If loading
+    fails the previous rules stay active (or the defaults on first load).
+    """
+    global _rule_set, _checked_at
+    if _rule_set is not None and time.monotonic() - _checked_at < RELOAD_CHECK_SECONDS:
+        return _rule_set
+
+    try:
+        if _rule_set is None or await _source_fingerprint() != _rule_set.fingerprint:
+            return await reload_rules()
+        _checked_at = time.monotonic()
+    except Exception as e:
+        print(f"Failed to reload compliance rules: {e}")
+        _checked_at = time.monotonic()
+        if _rule_set is None:
+            _rule_set = RuleSet(DEFAULT_RULES, "defaults")
+    return _rule_set
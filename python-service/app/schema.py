@@ -0,0 +1,280 @@
+"""
+Database schema bootstrap
+DDL for tables and indexes used by the analytics service, applied on startup
+"""
+
+# Statements are idempotent and executed in order by db.ensure_schema()
+SCHEMA_STATEMENTS = [
+    # Trades (written by both services; users table is owned by Node.js,
+    # so no foreign key is declared here)
+    """
+    CREATE TABLE IF NOT EXISTS trades (
+        id UUID PRIMARY KEY,
+        user_id UUID NOT NULL,
+        symbol TEXT NOT NULL,
+        side TEXT CHECK (LOWER(side) IN ('buy', 'sell')),
+        qty NUMERIC NOT NULL,
+        price NUMERIC NOT NULL,
+        executed_at TIMESTAMPTZ NOT NULL,
+        external_id TEXT,
+        raw JSONB,
+        created_at TIMESTAMPTZ DEFAULT now()
+    )
+    """,
+    # Date-range scans per user (get_user_trades, fetch_user_trades_columns)
+    """
+    CREATE INDEX IF NOT EXISTS idx_trades_user_executed_at
+        ON trades (user_id, executed_at)
+    """,
+    # Per-symbol lookups (get_recent_trades)
+    """
+    CREATE INDEX IF NOT EXISTS idx_trades_user_symbol_executed_at
+        ON trades (user_id, symbol, executed_at)
+    """,
+
+    # Compliance audit results
+    """
+    CREATE TABLE IF NOT EXISTS compliance_audit (
+        id UUID PRIMARY KEY,
+        user_id UUID,
+        trade_id UUID,
+        check_name TEXT NOT NULL,
+        status TEXT CHECK (status IN ('pass', 'fail', 'flag')),
+        reason TEXT,
+        metadata JSONB,
+        created_at TIMESTAMPTZ DEFAULT now()
+    )
+    """,
+    # Latest-first history per user (get_compliance_audits)
+    """
+    CREATE INDEX IF NOT EXISTS idx_compliance_audit_user_created_at
+        ON compliance_audit (user_id, created_at DESC)
+    """,
+
+    # Custom compliance rules (app/rule_engine.py); picked up without a restart
+    """
+    CREATE TABLE IF NOT EXISTS compliance_rules (
+        id BIGSERIAL PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        check_type TEXT NOT NULL,
+        threshold NUMERIC NOT NULL DEFAULT 0,
+        symbols TEXT[] NOT NULL DEFAULT '{}',
+        message TEXT,
+        enabled BOOLEAN NOT NULL DEFAULT true,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    """,
+    # Keep updated_at current on every edit; rule_engine's reload check
+    # fingerprints the table on COUNT(*) and MAX(updated_at)
+    """
+    CREATE OR REPLACE FUNCTION compliance_rules_touch() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at = now();
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgname = 'compliance_rules_touch'
+              AND tgrelid = 'compliance_rules'::regclass
+        ) THEN
+            CREATE TRIGGER compliance_rules_touch
+                BEFORE UPDATE ON compliance_rules
+                FOR EACH ROW EXECUTE FUNCTION compliance_rules_touch();
+        END IF;
+    END
+    $$
+    """,
+
+    # Cached benchmark bars; UNIQUE (symbol, date) backs both the upsert
+    # conflict target and range lookups
+    """
+    CREATE TABLE IF NOT EXISTS benchmarks (
+        id UUID PRIMARY KEY,
+        symbol TEXT NOT NULL,
+        date DATE NOT NULL,
+        open NUMERIC,
+        high NUMERIC,
+        low NUMERIC,
+        close NUMERIC,
+        volume NUMERIC,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        UNIQUE (symbol, date)
+    )
+    """,
+
+    # Per-user trade aggregates, updated incrementally on ingest
+    """
+    CREATE TABLE IF NOT EXISTS user_metrics (
+        user_id UUID PRIMARY KEY,
+        total_trades BIGINT NOT NULL DEFAULT 0,
+        buy_count BIGINT NOT NULL DEFAULT 0,
+        sell_count BIGINT NOT NULL DEFAULT 0,
+        buy_value NUMERIC NOT NULL DEFAULT 0,
+        sell_value NUMERIC NOT NULL DEFAULT 0,
+        first_trade_at TIMESTAMPTZ,
+        last_trade_at TIMESTAMPTZ,
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    """,
+
+    # Set on ingest; the leaderboard re-ranks only users with this set
+    """
+    ALTER TABLE user_metrics
+        ADD COLUMN IF NOT EXISTS leaderboard_stale BOOLEAN NOT NULL DEFAULT true
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_user_metrics_leaderboard_stale
+        ON user_metrics (user_id) WHERE leaderboard_stale
+    """,
+
+    # Open lots and running PnL per user, symbol and cost basis method
+    # (app/lots.py), updated incrementally on ingest
+    """
+    CREATE TABLE IF NOT EXISTS user_positions (
+        user_id UUID NOT NULL,
+        symbol TEXT NOT NULL,
+        cost_method TEXT NOT NULL CHECK (cost_method IN ('fifo', 'lifo', 'average')),
+        quantity NUMERIC NOT NULL DEFAULT 0,
+        cost_basis NUMERIC NOT NULL DEFAULT 0,
+        lots JSONB NOT NULL DEFAULT '[]',
+        realized_pnl NUMERIC NOT NULL DEFAULT 0,
+        winning_closes BIGINT NOT NULL DEFAULT 0,
+        losing_closes BIGINT NOT NULL DEFAULT 0,
+        gross_profit NUMERIC NOT NULL DEFAULT 0,
+        gross_loss NUMERIC NOT NULL DEFAULT 0,
+        trade_count BIGINT NOT NULL DEFAULT 0,
+        buy_value NUMERIC NOT NULL DEFAULT 0,
+        sell_value NUMERIC NOT NULL DEFAULT 0,
+        last_price NUMERIC,
+        last_trade_at TIMESTAMPTZ,
+        updated_at TIMESTAMPTZ DEFAULT now(),
+        PRIMARY KEY (user_id, cost_method, symbol)
+    )
+    """,
+
+    # Per-user totals of user_positions marked to market, refreshed with
+    # every position update and when cached prices change; the size and
+    # leverage checks read one row
+    """
+    CREATE TABLE IF NOT EXISTS user_equity (
+        user_id UUID NOT NULL,
+        cost_method TEXT NOT NULL,
+        realized_pnl NUMERIC NOT NULL DEFAULT 0,
+        cost_basis NUMERIC NOT NULL DEFAULT 0,
+        long_value NUMERIC NOT NULL DEFAULT 0,
+        short_value NUMERIC NOT NULL DEFAULT 0,
+        open_positions INTEGER NOT NULL DEFAULT 0,
+        positions_updated_at TIMESTAMPTZ,
+        marked_at TIMESTAMPTZ DEFAULT now(),
+        PRIMARY KEY (user_id, cost_method)
+    )
+    """,
+    # Users holding a symbol, for marking to market after a price refresh
+    """
+    CREATE INDEX IF NOT EXISTS idx_user_positions_open_symbol
+        ON user_positions (symbol) WHERE quantity <> 0
+    """,
+
+    # Buy/sell counts per user, day and symbol for the PDT check; a
+    # symbol-day holds LEAST(buy_count, sell_count) day trades
+    """
+    CREATE TABLE IF NOT EXISTS user_trade_days (
+        user_id UUID NOT NULL,
+        trade_date DATE NOT NULL,
+        symbol TEXT NOT NULL,
+        buy_count INTEGER NOT NULL DEFAULT 0,
+        sell_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, trade_date, symbol)
+    )
+    """,
+
+    # Durable post-ingest work queue (app/jobs.py)
+    """
+    CREATE TABLE IF NOT EXISTS analytics_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        user_id UUID NOT NULL,
+        payload JSONB NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'pending'
+            CHECK (status IN ('pending', 'running', 'failed')),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+        locked_until TIMESTAMPTZ,
+        last_error TEXT,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    """,
+    # At most one pending job per (kind, user): new work is merged into it
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_analytics_jobs_pending
+        ON analytics_jobs (kind, user_id) WHERE status = 'pending'
+    """,
+    # Claim scans (pending due jobs and expired running jobs)
+    """
+    CREATE INDEX IF NOT EXISTS idx_analytics_jobs_claim
+        ON analytics_jobs (run_after) WHERE status IN ('pending', 'running')
+    """,
+
+    # Bulk compliance re-screening runs (app/rescreen.py); the cursor makes
+    # a run resumable
+    """
+    CREATE TABLE IF NOT EXISTS compliance_rescreens (
+        id BIGSERIAL PRIMARY KEY,
+        status TEXT NOT NULL DEFAULT 'running'
+            CHECK (status IN ('running', 'paused', 'completed', 'failed')),
+        params JSONB NOT NULL,
+        include_passes BOOLEAN NOT NULL DEFAULT false,
+        cursor_user_id UUID,
+        total_users BIGINT,
+        users_done BIGINT NOT NULL DEFAULT 0,
+        trades_screened BIGINT NOT NULL DEFAULT 0,
+        audits_written BIGINT NOT NULL DEFAULT 0,
+        flagged BIGINT NOT NULL DEFAULT 0,
+        last_error TEXT,
+        started_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now(),
+        finished_at TIMESTAMPTZ
+    )
+    """,
+
+    # Cohort leaderboard (app/leaderboard.py): each user's return over the
+    # trailing window; rank and percentile are read off the return index
+    """
+    CREATE TABLE IF NOT EXISTS leaderboard (
+        user_id UUID PRIMARY KEY,
+        trade_count BIGINT NOT NULL,
+        buy_value NUMERIC NOT NULL,
+        sell_value NUMERIC NOT NULL,
+        profit NUMERIC NOT NULL,
+        return_percent NUMERIC NOT NULL,
+        last_trade_at TIMESTAMPTZ,
+        refreshed_at TIMESTAMPTZ DEFAULT now()
+    )
+    """,
+    # Top-K scans and "how many users rank above" counts
+    """
+    CREATE INDEX IF NOT EXISTS idx_leaderboard_return
+        ON leaderboard (return_percent DESC, user_id)
+    """,
+    # Single row describing the snapshot; a NULL window_start forces the
+    # next refresh to be a full one
+    """
+    CREATE TABLE IF NOT EXISTS leaderboard_state (
+        id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+        window_start DATE,
+        benchmark TEXT NOT NULL,
+        benchmark_return_percent NUMERIC,
+        users BIGINT NOT NULL DEFAULT 0,
+        full_refreshed_at TIMESTAMPTZ,
+        refreshed_at TIMESTAMPTZ
+    )
+    """,
+]
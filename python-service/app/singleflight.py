@@ -0,0 +1,74 @@
+"""
+Per-key single-flight coalescing
+Collapses bursts of identical work for the same key (e.g. a user's
+metrics recompute) into at most one running call plus one trailing call
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Keyed single-flight with one trailing run
+
+    - No run in flight: the caller executes immediately.
+    - A run in flight: the caller schedules one trailing run, which starts
+      when the current run finishes and so sees all state written before it.
+    - A trailing run already scheduled: the caller joins it.
+
+    A burst of N requests for one key therefore executes at most twice.
+    """
+
+    def __init__(self):
+        self._running: Dict[Hashable, asyncio.Event] = {}
+        self._trailing: Dict[Hashable, asyncio.Task] = {}
+        self.stats = {"requested": 0, "executed": 0, "coalesced": 0}
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.stats["requested"] += 1
+
+        trailing = self._trailing.get(key)
+        if trailing is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(trailing)
+
+        running = self._running.get(key)
+        if running is None:
+            return await self._execute(key, fn)
+
+        # Schedule the trailing run as its own task: the caller that created
+        # it awaits it like every joiner, so a cancelled caller cancels only
+        # its own wait, never the run the others are waiting on
+        trailing = asyncio.create_task(self._run_trailing(key, fn, running))
+        # Avoid "exception was never retrieved" when every caller went away
+        trailing.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._trailing[key] = trailing
+        return await asyncio.shield(trailing)
+
+    async def _run_trailing(
+        self,
+        key: Hashable,
+        fn: Callable[[], Awaitable[Any]],
+        running: asyncio.Event
+    ) -> Any:
+        try:
+            await running.wait()
+        finally:
+            del self._trailing[key]
+        # _execute registers as running before its first await, so callers
+        # arriving from here on queue behind this run
+        return await self._execute(key, fn)
+
+    async def _execute(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        done = asyncio.Event()
+        self._running[key] = done
+        self.stats["executed"] += 1
+        try:
+            return await fn()
+        finally:
+            del self._running[key]
+            done.set()
+
+    def in_flight(self) -> int:
+        return len(self._running)
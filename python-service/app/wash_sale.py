@@ -0,0 +1,153 @@
+"""
+Wash sale detection engine
+Sorted per-(user, symbol) buy dates answered with bisect for streaming
+checks, plus a vectorized screen over a full year of trades
+"""
+
+import bisect
+from datetime import date, datetime
+from typing import Dict, Hashable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Days before and after a sale in which a repurchase is a wash sale
+WASH_SALE_DAYS = 30
+
+
+def _day(value) -> int:
+    """Day number for a trade timestamp or date (days are compared, not times)"""
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.toordinal()
+
+
+class BuySeries:
+    """Buys of one symbol for one user, sorted by execution day"""
+
+    __slots__ = ("days", "buys")
+
+    def __init__(self):
+        self.days: List[int] = []
+        self.buys: List[Dict] = []
+
+    def add(self, trade: Dict):
+        day = _day(trade["executed_at"])
+        # Insert after equal days so same-day buys keep arrival order
+        index = bisect.bisect_right(self.days, day)
+        self.days.insert(index, day)
+        self.buys.insert(index, trade)
+
+    def between(self, first_day: int, last_day: int) -> List[Dict]:
+        """Buys executed from first_day through last_day (inclusive)"""
+        lo = bisect.bisect_left(self.days, first_day)
+        hi = bisect.bisect_right(self.days, last_day)
+        return self.buys[lo:hi]
+
+
+class WashSaleIndex:
+    """
+    Buy dates per (user, symbol)
+
+    Feed trades with add(); each sell is then answered by related_buys()
+    with two bisects over that symbol's buys, independent of how many
+    other trades the user has. Buys dated after a sale are only seen once
+    they have been added.
+    """
+
+    def __init__(self, window_days: int = WASH_SALE_DAYS):
+        self.window_days = window_days
+        self._series: Dict[Tuple[str, Hashable], BuySeries] = {}
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def add(self, trade: Dict):
+        """Record a trade; only buys are indexed"""
+        if trade["side"].lower() != "buy":
+            return
+
+        key = (str(trade["user_id"]), trade["symbol"])
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = BuySeries()
+        series.add(trade)
+
+    def related_buys(self, sell: Dict) -> List[Dict]:
+        """Buys of the sold symbol within window_days of the sale"""
+        series = self._series.get((str(sell["user_id"]), sell["symbol"]))
+        if series is None:
+            return []
+
+        day = _day(sell["executed_at"])
+        return [
+            t for t in series.between(day - self.window_days, day + self.window_days)
+            if t.get("id") != sell.get("id")
+        ]
+
+
+def screen_wash_sales(
+    columns: Dict,
+    start_date: date,
+    end_date: date,
+    window_days: int = WASH_SALE_DAYS
+) -> Dict:
+    """
+    Vectorized wash sale screen over one user's trades
+
+    columns are as returned by db.fetch_user_trades_columns() and should
+    cover window_days either side of [start_date, end_date] so buys near
+    the edges are seen. Every sell executed in the range is matched
+    against same-symbol buys with one np.searchsorted over (symbol, day)
+    keys. Returns, for each sell with at least one related buy, its row
+    index into columns, the related buy count and the first and last
+    related buy day (as numpy datetime64[D]), plus the number of sells
+    screened.
+    """
+    symbol = pd.Categorical(columns["symbol"])
+    side = pd.Categorical(columns["side"])
+    days = np.asarray(columns["executed_at"]).astype("datetime64[D]").astype(np.int64)
+
+    empty = {
+        "index": np.empty(0, dtype=np.int64),
+        "buys": np.empty(0, dtype=np.int64),
+        "first_buy": np.empty(0, dtype="datetime64[D]"),
+        "last_buy": np.empty(0, dtype="datetime64[D]"),
+        "sells_screened": 0,
+    }
+    if not len(days):
+        return empty
+
+    categories = list(side.categories)
+    side_codes = side.codes
+    is_buy = side_codes == categories.index("buy") if "buy" in categories else np.zeros(len(days), bool)
+    is_sell = side_codes == categories.index("sell") if "sell" in categories else np.zeros(len(days), bool)
+
+    first_day = np.datetime64(start_date, "D").astype(np.int64)
+    last_day = np.datetime64(end_date, "D").astype(np.int64)
+    sells = np.flatnonzero(is_sell & (days >= first_day) & (days <= last_day))
+    if not len(sells) or not is_buy.any():
+        return {**empty, "sells_screened": len(sells)}
+
+    # One sortable key per trade: symbol-major, then day offset, spaced so
+    # a window never crosses into a neighbouring symbol
+    base = days.min() - window_days
+    span = int(days.max() - base) + window_days + 1
+    keys = symbol.codes.astype(np.int64) * span + (days - base)
+
+    buy_keys = np.sort(keys[is_buy])
+    sell_keys = keys[sells]
+    lo = np.searchsorted(buy_keys, sell_keys - window_days, side="left")
+    hi = np.searchsorted(buy_keys, sell_keys + window_days, side="right")
+    counts = hi - lo
+
+    flagged = counts > 0
+    lo, hi = lo[flagged], hi[flagged]
+    buy_days = buy_keys % span + base
+    return {
+        "index": sells[flagged],
+        "buys": counts[flagged],
+        "first_buy": buy_days[lo].astype("datetime64[D]"),
+        "last_buy": buy_days[hi - 1].astype("datetime64[D]"),
+        "sells_screened": len(sells),
+    }
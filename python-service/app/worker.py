@@ -0,0 +1,43 @@
+"""
+Standalone analytics job worker
+Runs the job queue workers without the HTTP tier:
+
+    python -m app.worker --concurrency 8
+
+Set JOB_WORKERS=0 on the API processes when running workers separately.
+"""
+
+import argparse
+import asyncio
+import signal
+from . import audit_writer, compliance, db, jobs
+
+
+async def main(concurrency: int):
+    await db.ensure_schema()
+    await compliance.restore_trade_days()
+    await audit_writer.start()
+
+    pool = jobs.JobWorkerPool(concurrency)
+    await pool.start()
+    print(f"Analytics worker started with {concurrency} workers")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    print("Analytics worker stopping...")
+    await pool.stop()
+    try:
+        await audit_writer.stop()
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KAIRO analytics job worker")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of concurrent workers")
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency))
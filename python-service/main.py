@@ -1,9 +1,13 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
 from uuid import UUID
 import datetime
-from app import compliance, profit, db
+import json
+from app import analytics_executor, audit_writer, compliance, profit, db, equity_curve, jobs, leaderboard, market_data, rescreen, response_cache, rule_engine
 from app import compliance_simple, profit_simple  # Simplified clean implementations
 
 app = FastAPI(
@@ -31,12 +35,40 @@ class TradeIn(BaseModel):
     external_id: str = None
     raw: dict = {}
 
+# Upper bound on rows accepted by POST /trades/batch
+MAX_BATCH_SIZE = 10000
+
 class BenchmarkRequest(BaseModel):
     user_id: UUID
     benchmark: str = "SPY"
     start_date: datetime.date = None
     end_date: datetime.date = None
 
+@app.on_event("startup")
+async def startup():
+    try:
+        await db.ensure_schema()
+        await compliance.restore_trade_days()
+    except Exception as e:
+        # Keep serving so /health can report the database as disconnected
+        print(f"Schema bootstrap failed: {e}")
+    await audit_writer.start()
+    await jobs.start_workers()
+    await leaderboard.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Finish in-flight jobs and flush buffered audit rows before the pool closes
+    await rescreen.stop()
+    await leaderboard.stop()
+    await jobs.stop_workers()
+    try:
+        await audit_writer.stop()
+    finally:
+        await market_data.close_client()
+        analytics_executor.shutdown()
+        await db.close_pool()
+
 @app.get("/")
 async def root():
     return {
@@ -45,8 +77,10 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "trades": "/trades",
+            "trades_batch": "/trades/batch",
             "comparative": "/users/{user_id}/comparative",
             "compliance": "/users/{user_id}/compliance",
+            "leaderboard": "/leaderboard",
             "webhooks": "/webhooks/stripe"
         }
     }
@@ -58,39 +92,162 @@ async def health_check():
     return {
         "status": "healthy" if db_healthy else "unhealthy",
         "database": "connected" if db_healthy else "disconnected",
+        "audit_writer": audit_writer.get_writer().stats,
+        "job_workers": jobs.get_stats(),
+        "metrics_recompute": profit.recompute_flight.stats,
+        "analytics_executor": analytics_executor.get_stats(),
+        "equity_curves": equity_curve.get_stats(),
+        "leaderboard": leaderboard.get_stats(),
+        "response_cache": response_cache.get_cache().get_stats(),
         "timestamp": datetime.datetime.utcnow()
     }
 
+async def cached_json(
+    request: Request,
+    user_id: str,
+    endpoint: str,
+    args: Hashable,
+    compute: Callable[[], Awaitable[Dict]]
+) -> Response:
+    """
+    Serve a per-user read endpoint through the response cache
+
+    Responses carry an ETag; a request whose If-None-Match matches it gets
+    an empty 304. Entries follow the user's trades and equity marks; other
+    inputs, such as benchmark bars written by another process, can be up to
+    RESPONSE_CACHE_TTL_SECONDS stale.
+    """
+    async def render() -> bytes:
+        return JSONResponse(content=jsonable_encoder(await compute())).body
+
+    body, etag = await response_cache.get_cache().fetch(
+        user_id, endpoint, args, render, request.headers.get("if-none-match")
+    )
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if body is None:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.post("/trades", status_code=201)
-async def ingest_trade(trade: TradeIn, background_tasks: BackgroundTasks):
+async def ingest_trade(trade: TradeIn):
     """
-    Ingest a new trade and run compliance checks + profit recalculation
+    Ingest a new trade and queue its compliance checks
+
+    User metrics are updated and the compliance job is enqueued in the
+    same transaction as the insert, so no work is lost on restart.
     """
     try:
         # Create trade in database
-        t = await db.create_trade(trade.dict())
-
-        # Run compliance checks asynchronously
-        background_tasks.add_task(compliance.run_checks_for_trade, t)
-
-        # Recalculate user metrics asynchronously
-        background_tasks.add_task(profit.recompute_user_metrics, str(trade.user_id))
+        t = await db.create_trade(trade.dict(), jobs=["compliance"])
+        response_cache.invalidate(str(trade.user_id))
 
         return {
             "id": t["id"],
             "status": "accepted",
-            "message": "Trade ingested successfully. Compliance checks and metrics update in progress."
+            "message": "Trade ingested successfully. Compliance checks in progress."
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to ingest trade: {str(e)}")
 
+def parse_batch_body(body: bytes, content_type: str) -> List:
+    """
+    Parse a batch ingestion body as a JSON array or NDJSON
+
+    NDJSON lines that are not valid JSON are returned as ValueError
+    instances so they can be reported per row instead of failing the batch.
+    """
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        try:
+            text = body.decode("utf-8")
+        except UnicodeDecodeError as e:
+            raise ValueError(f"Invalid NDJSON body: not UTF-8 ({e.reason})")
+        items = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                items.append(ValueError(f"Invalid JSON: {e.msg}"))
+        return items
+
+    try:
+        items = json.loads(body)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON body: {e.msg}")
+    if not isinstance(items, list):
+        raise ValueError("Batch body must be a JSON array of trades")
+    return items
+
+@app.post("/trades/batch")
+async def ingest_trades_batch(request: Request):
+    """
+    Ingest a batch of trades (JSON array or NDJSON) in one transaction
+
+    User metrics are updated and one compliance job per affected user is
+    enqueued in the same transaction.
+    """
+    try:
+        items = parse_batch_body(await request.body(), request.headers.get("content-type", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {len(items)} trades exceeds limit of {MAX_BATCH_SIZE}"
+        )
+
+    results: List[Dict] = [None] * len(items)
+    valid_indexes = []
+    valid_trades = []
+    for index, item in enumerate(items):
+        if isinstance(item, ValueError):
+            results[index] = {"index": index, "status": "rejected", "error": str(item)}
+            continue
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("Trade must be a JSON object")
+            valid_trades.append(TradeIn(**item).dict())
+            valid_indexes.append(index)
+        except ValidationError as e:
+            error = "; ".join(
+                f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()
+            )
+            results[index] = {"index": index, "status": "rejected", "error": error}
+        except ValueError as e:
+            results[index] = {"index": index, "status": "rejected", "error": str(e)}
+
+    try:
+        created = await db.create_trades_bulk(valid_trades, jobs=["compliance"])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to ingest trades: {str(e)}")
+
+    users_affected = set()
+    for index, t in zip(valid_indexes, created):
+        results[index] = {"index": index, "id": t["id"], "status": "accepted"}
+        users_affected.add(str(t["user_id"]))
+    for user_id in users_affected:
+        response_cache.invalidate(user_id)
+
+    return {
+        "accepted": len(created),
+        "rejected": len(items) - len(created),
+        "users_affected": len(users_affected),
+        "results": results
+    }
+
 @app.get("/users/{user_id}/comparative")
 async def get_comparative(
     user_id: UUID,
+    request: Request,
     benchmark: str = "SPY",
     start_date: datetime.date = None,
     end_date: datetime.date = None,
-    simple: bool = False
+    simple: bool = False,
+    time_weighted: bool = False,
+    series_points: int = 0,
+    benchmarks: Optional[str] = None
 ):
     """
     Get comparative profit analysis for a user against a benchmark
@@ -98,9 +255,46 @@ async def get_comparative(
     Args:
         simple: Use pandas-based calculation (faster, cleaner) if True
                 Use comprehensive API-integrated version if False (default)
+        time_weighted: Compare daily time-weighted returns instead of window PnL
+        series_points: With time_weighted, include up to this many points of the
+                       cumulative return series
+        benchmarks: Comma-separated symbols (e.g. SPY,QQQ) to compare against in
+                    one pass; overrides benchmark and returns a "benchmarks" list
     """
-    try:
-        if simple:
+    async def compute() -> Dict:
+        if benchmarks is not None:
+            symbols = profit.parse_benchmarks(benchmarks)
+            if time_weighted:
+                result = await profit.get_user_vs_benchmarks_time_weighted(
+                    str(user_id),
+                    symbols,
+                    start_date,
+                    end_date,
+                    series_points
+                )
+            elif simple:
+                result = await profit_simple.get_user_vs_benchmarks(
+                    str(user_id),
+                    symbols,
+                    start_date,
+                    end_date
+                )
+            else:
+                result = await profit.get_user_vs_benchmarks(
+                    str(user_id),
+                    symbols,
+                    start_date,
+                    end_date
+                )
+        elif time_weighted:
+            result = await profit.get_user_vs_benchmark_time_weighted(
+                str(user_id),
+                benchmark,
+                start_date,
+                end_date,
+                series_points
+            )
+        elif simple:
             # Use clean pandas-based implementation
             result = await profit_simple.get_user_vs_benchmark(
                 str(user_id),
@@ -117,6 +311,12 @@ async def get_comparative(
                 end_date
             )
         return result
+
+    # Defaulted dates follow the current UTC day
+    args = (benchmark, start_date, end_date, simple, time_weighted, series_points,
+            benchmarks, datetime.datetime.now(datetime.timezone.utc).date())
+    try:
+        return await cached_json(request, str(user_id), "comparative", args, compute)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -137,40 +337,197 @@ async def get_compliance_status(user_id: UUID, limit: int = 100):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get compliance data: {str(e)}")
 
+@app.get("/users/{user_id}/compliance/wash-sales")
+async def get_wash_sale_report(user_id: UUID, year: int):
+    """
+    Screen all of a user's sells in a tax year for potential wash sales
+    """
+    try:
+        return await compliance.screen_wash_sales_for_year(str(user_id), year)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to screen wash sales: {str(e)}")
+
+@app.get("/compliance/rules")
+async def get_compliance_rules():
+    """
+    Summarize the active custom compliance rules
+    """
+    rule_set = await rule_engine.get_rule_set()
+    return rule_set.summary()
+
+@app.post("/compliance/rules/reload")
+async def reload_compliance_rules():
+    """
+    Recompile custom compliance rules from their source (admin only - should add auth)
+
+    Other processes pick up changes within COMPLIANCE_RULES_RELOAD_SECONDS.
+    """
+    try:
+        rule_set = await rule_engine.reload_rules()
+        return rule_set.summary()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to reload compliance rules: {str(e)}")
+
+@app.post("/compliance/rescreen", status_code=202)
+async def start_compliance_rescreen(include_passes: bool = False):
+    """
+    Re-screen all historical trades against the current rules (admin only - should add auth)
+
+    Runs in the background; poll GET /compliance/rescreen/{run_id} for progress.
+    """
+    try:
+        state = await rescreen.create_run(include_passes)
+        rescreen.start_in_background(state["id"])
+        return rescreen.progress(state)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to start re-screening: {str(e)}")
+
+@app.get("/compliance/rescreen/{run_id}")
+async def get_compliance_rescreen(run_id: int):
+    """
+    Get progress of a re-screening run
+    """
+    state = await db.get_rescreen(run_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Re-screening run not found")
+    return rescreen.progress(state)
+
+@app.post("/compliance/rescreen/{run_id}/resume", status_code=202)
+async def resume_compliance_rescreen(run_id: int):
+    """
+    Resume a paused or failed re-screening run from its cursor (admin only - should add auth)
+    """
+    state = await db.get_rescreen(run_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Re-screening run not found")
+    if state["status"] == "completed":
+        raise HTTPException(status_code=409, detail="Re-screening run already completed")
+    rescreen.start_in_background(run_id)
+    return rescreen.progress(state)
+
 @app.get("/users/{user_id}/metrics")
-async def get_user_metrics(user_id: UUID):
+async def get_user_metrics(user_id: UUID, request: Request):
     """
-    Get comprehensive user trading metrics
+    Get comprehensive user trading metrics from the user_metrics store
     """
     try:
-        metrics = await profit.get_user_metrics(str(user_id))
-        return metrics
+        return await cached_json(
+            request, str(user_id), "metrics", (),
+            lambda: profit.get_user_metrics(str(user_id))
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get user metrics: {str(e)}")
 
+@app.post("/users/{user_id}/metrics/recompute")
+async def recompute_user_metrics(user_id: UUID):
+    """
+    Rebuild a user's stored metrics from history (admin only - should add auth)
+
+    Concurrent requests for the same user are coalesced.
+    """
+    try:
+        metrics = await profit.request_recompute_user_metrics(str(user_id))
+        response_cache.invalidate(str(user_id))
+        return {
+            "metrics": metrics,
+            "recompute_stats": profit.recompute_flight.stats
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to recompute user metrics: {str(e)}")
+
+@app.get("/users/{user_id}/equity")
+async def get_user_equity(user_id: UUID):
+    """
+    Get a user's account equity, exposure and leverage from the materialized snapshot
+    """
+    try:
+        return await profit.get_user_equity(str(user_id))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get user equity: {str(e)}")
+
+@app.get("/users/{user_id}/risk")
+async def get_risk_metrics(
+    user_id: UUID,
+    risk_free_rate: float = equity_curve.RISK_FREE_RATE,
+    include_curve: bool = False
+):
+    """
+    Get Sharpe, Sortino, volatility, max drawdown and Calmar from the user's daily equity curve
+
+    Args:
+        include_curve: Also return the daily equity values
+    """
+    try:
+        return await equity_curve.get_risk_metrics(str(user_id), risk_free_rate, include_curve)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to calculate risk metrics: {str(e)}")
+
 @app.get("/users/{user_id}/portfolio")
-async def get_portfolio(user_id: UUID):
+async def get_portfolio(user_id: UUID, request: Request):
     """
     Get comprehensive portfolio summary with per-symbol breakdown
     Uses clean pandas-based calculation
     """
     try:
-        result = await profit_simple.get_portfolio_summary(str(user_id))
-        return result
+        return await cached_json(
+            request, str(user_id), "portfolio", (),
+            lambda: profit_simple.get_portfolio_summary(str(user_id))
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get portfolio: {str(e)}")
 
 @app.get("/users/{user_id}/win-rate")
-async def get_win_rate(user_id: UUID):
+async def get_win_rate(user_id: UUID, request: Request):
     """
     Calculate win rate and trading statistics
     """
     try:
-        result = await profit_simple.calculate_win_rate(str(user_id))
-        return result
+        return await cached_json(
+            request, str(user_id), "win_rate", (),
+            lambda: profit_simple.calculate_win_rate(str(user_id))
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to calculate win rate: {str(e)}")
 
+@app.get("/leaderboard")
+async def get_leaderboard(limit: int = 100):
+    """
+    Top users by return over the trailing window, with rank and percentile
+    """
+    try:
+        result = await leaderboard.get_top(limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get leaderboard: {str(e)}")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Leaderboard has not been computed yet")
+    return result
+
+@app.get("/leaderboard/users/{user_id}")
+async def get_leaderboard_user(user_id: UUID):
+    """
+    A user's rank and percentile on the leaderboard
+    """
+    try:
+        result = await leaderboard.get_user_rank(str(user_id))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get leaderboard rank: {str(e)}")
+    if result is None:
+        raise HTTPException(status_code=404, detail="User is not ranked on the leaderboard")
+    return result
+
+@app.post("/leaderboard/refresh", status_code=202)
+async def refresh_leaderboard(background_tasks: BackgroundTasks, full: bool = False):
+    """
+    Trigger a leaderboard refresh (admin only - should add auth)
+    """
+    background_tasks.add_task(leaderboard.refresh, full)
+    return {
+        "status": "accepted",
+        "message": f"{'Full' if full else 'Incremental'} leaderboard refresh scheduled"
+    }
+
 @app.post("/benchmarks/update")
 async def update_benchmarks(background_tasks: BackgroundTasks):
     """
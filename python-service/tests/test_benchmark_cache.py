@@ -0,0 +1,58 @@
+"""In-process benchmark series cache (app/benchmark_cache.py)"""
+
+import asyncio
+from datetime import date
+
+import pytest
+
+from app import benchmark_cache
+
+ROWS = [{"date": date(2025, 1, 2), "close": 100}, {"date": date(2025, 1, 3), "close": 110}]
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    benchmark_cache.invalidate()
+    yield
+    benchmark_cache.invalidate()
+
+
+def test_range_lookup():
+    series = benchmark_cache._store("SPY", ROWS, benchmark_cache._generation("SPY"))
+    result = benchmark_cache.series_price_range(series, date(2025, 1, 1), date(2025, 1, 31))
+    assert (result["start_price"], result["end_price"], result["points"]) == (100.0, 110.0, 2)
+    assert benchmark_cache.series_price_range(series, date(2025, 1, 3), date(2025, 1, 3)) is None
+
+
+def test_load_racing_invalidate_is_not_cached(monkeypatch):
+    loads = []
+
+    async def get_benchmark_series(symbol):
+        loads.append(symbol)
+        if len(loads) == 1:
+            # Bars are rewritten while the first load is in flight
+            benchmark_cache.invalidate(symbol)
+        return ROWS
+
+    monkeypatch.setattr(benchmark_cache.db, "get_benchmark_series", get_benchmark_series)
+
+    async def scenario():
+        await benchmark_cache.get_series("SPY")
+        await benchmark_cache.get_series("SPY")
+        await benchmark_cache.get_series("SPY")
+
+    asyncio.run(scenario())
+    # The first result was served but not cached; the second load sticks
+    assert loads == ["SPY", "SPY"]
+
+
+def test_get_many_skips_symbols_invalidated_mid_load(monkeypatch):
+    async def get_benchmark_series_many(symbols):
+        benchmark_cache.invalidate("QQQ")
+        return {symbol: ROWS for symbol in symbols}
+
+    monkeypatch.setattr(benchmark_cache.db, "get_benchmark_series_many", get_benchmark_series_many)
+    found = asyncio.run(benchmark_cache.get_many(["SPY", "QQQ"]))
+    assert set(found) == {"SPY", "QQQ"}
+    assert benchmark_cache._fresh("SPY") is not None
+    assert benchmark_cache._fresh("QQQ") is None
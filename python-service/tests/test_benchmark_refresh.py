@@ -0,0 +1,56 @@
+"""Gap-aware benchmark refresh planning (app/profit.py)"""
+
+from datetime import date
+
+from app.profit import last_completed_session, missing_benchmark_ranges
+
+# A Friday
+TODAY = date(2026, 10, 16)
+
+
+def coverage(first, last):
+    return {"first_date": first, "last_date": last}
+
+
+def test_uncached_symbol_fetches_window_up_to_last_session():
+    assert missing_benchmark_ranges(date(2026, 1, 5), TODAY, None, TODAY) == [
+        (date(2026, 1, 5), date(2026, 10, 15))
+    ]
+
+
+def test_current_symbol_needs_nothing_during_the_session():
+    # Today's bar does not exist yet; yesterday's is cached
+    assert missing_benchmark_ranges(
+        date(2025, 10, 16), TODAY, coverage(date(2025, 10, 16), date(2026, 10, 15)), TODAY
+    ) == []
+
+
+def test_symbol_a_day_behind_fetches_one_day():
+    assert missing_benchmark_ranges(
+        date(2025, 10, 16), TODAY, coverage(date(2025, 10, 16), date(2026, 10, 14)), TODAY
+    ) == [(date(2026, 10, 15), date(2026, 10, 15))]
+
+
+def test_missing_history_before_cached_range():
+    assert missing_benchmark_ranges(
+        date(2025, 10, 1), TODAY, coverage(date(2025, 10, 16), date(2026, 10, 15)), TODAY
+    ) == [(date(2025, 10, 1), date(2025, 10, 15))]
+
+
+def test_weekend_edges_are_not_gaps():
+    # Window starts on a Saturday and the cache starts the following Monday;
+    # on Monday the last completed session is the Friday before
+    monday = date(2026, 10, 19)
+    assert missing_benchmark_ranges(
+        date(2025, 10, 18), monday, coverage(date(2025, 10, 20), date(2026, 10, 16)), monday
+    ) == []
+
+
+def test_window_entirely_after_last_session():
+    assert missing_benchmark_ranges(TODAY, TODAY, None, TODAY) == []
+
+
+def test_last_completed_session_skips_weekends():
+    assert last_completed_session(date(2026, 10, 19)) == date(2026, 10, 16)
+    assert last_completed_session(date(2026, 10, 18)) == date(2026, 10, 16)
+    assert last_completed_session(TODAY) == date(2026, 10, 15)
@@ -0,0 +1,50 @@
+"""Running risk statistics (app/equity_curve.py)"""
+
+import numpy as np
+import pytest
+
+from app.equity_curve import TRADING_DAYS, RiskAccumulator
+
+EQUITY = np.array([101.0, 99.0, 104.0, 102.0, 108.0, 95.0, 97.0])
+
+
+def test_metrics_match_a_full_pass():
+    metrics = RiskAccumulator(100.0, risk_free_rate=0.0).extended(EQUITY).metrics()
+
+    returns = EQUITY / np.concatenate(([100.0], EQUITY[:-1])) - 1
+    std = returns.std(ddof=1)
+    downside = np.sqrt(np.mean(np.minimum(returns, 0) ** 2))
+    assert metrics["total_return"] == pytest.approx(EQUITY[-1] / 100 - 1)
+    assert metrics["volatility"] == pytest.approx(std * np.sqrt(TRADING_DAYS))
+    assert metrics["sharpe_ratio"] == pytest.approx(returns.mean() / std * np.sqrt(TRADING_DAYS))
+    assert metrics["sortino_ratio"] == pytest.approx(returns.mean() / downside * np.sqrt(TRADING_DAYS))
+    assert metrics["max_drawdown"] == pytest.approx(95 / 108 - 1)
+
+
+def test_extending_in_steps_matches_one_pass():
+    whole = RiskAccumulator(100.0).extended(EQUITY).metrics()
+    stepped = RiskAccumulator(100.0)
+    for split in np.array_split(EQUITY, 3):
+        stepped = stepped.extended(split)
+    assert stepped.metrics() == pytest.approx(whole)
+
+
+def test_extended_leaves_original_unchanged():
+    base = RiskAccumulator(100.0).extended(EQUITY[:3])
+    before = base.metrics()
+    base.extended(EQUITY[3:])
+    assert base.metrics() == before
+
+
+def test_returns_after_non_positive_equity_are_skipped():
+    acc = RiskAccumulator(100.0).extended(np.array([0.0, 50.0, 55.0]))
+    # 100 -> 0 and 50 -> 55 count; 0 -> 50 is undefined
+    assert acc.count == 2
+    assert acc.max_drawdown == pytest.approx(-1.0)
+
+
+def test_empty_curve_has_undefined_ratios():
+    metrics = RiskAccumulator(100.0).metrics()
+    assert metrics["total_return"] == 0
+    assert metrics["sharpe_ratio"] is None
+    assert metrics["cagr"] is None
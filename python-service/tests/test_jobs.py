@@ -0,0 +1,73 @@
+"""Job worker claim handling (app/jobs.py)"""
+
+import asyncio
+
+import pytest
+
+from app import jobs
+
+JOB = {"id": 7, "kind": "slow", "user_id": "u1", "payload": {}, "attempts": 1, "max_attempts": 5}
+
+
+@pytest.fixture
+def stub_db(monkeypatch):
+    calls = {"extended": 0, "completed": [], "failed": [], "lease_held": True}
+
+    async def extend_job_lease(job, visibility_timeout):
+        calls["extended"] += 1
+        return calls["lease_held"]
+
+    async def complete_job(job, audits=None):
+        if not calls["lease_held"]:
+            return False
+        calls["completed"].append((job["id"], audits))
+        return True
+
+    async def fail_job(job, error, delay):
+        calls["failed"].append((job["id"], error))
+
+    monkeypatch.setattr(jobs.db, "extend_job_lease", extend_job_lease)
+    monkeypatch.setattr(jobs.db, "complete_job", complete_job)
+    monkeypatch.setattr(jobs.db, "fail_job", fail_job)
+    return calls
+
+
+@pytest.fixture
+def slow_handler(monkeypatch):
+    async def handler(user_id, payload):
+        await asyncio.sleep(0.1)
+        return [{"check_name": "wash_sale", "status": "pass"}]
+    monkeypatch.setitem(jobs.HANDLERS, "slow", handler)
+
+
+def test_long_job_extends_its_claim_and_completes(stub_db, slow_handler):
+    pool = jobs.JobWorkerPool(1, visibility_timeout=0.06)
+    asyncio.run(pool._execute(JOB))
+    assert stub_db["extended"] >= 2
+    assert stub_db["completed"] == [(7, [{"check_name": "wash_sale", "status": "pass"}])]
+    assert pool.stats["completed"] == 1
+
+
+def test_reclaimed_job_discards_its_result(stub_db, slow_handler):
+    stub_db["lease_held"] = False
+    pool = jobs.JobWorkerPool(1, visibility_timeout=0.06)
+    asyncio.run(pool._execute(JOB))
+    assert stub_db["completed"] == []
+    assert pool.stats == {"completed": 0, "retried": 0, "failed": 0, "lost": 1}
+
+
+def test_failed_job_is_retried(stub_db, monkeypatch):
+    async def handler(user_id, payload):
+        raise RuntimeError("boom")
+    monkeypatch.setitem(jobs.HANDLERS, "slow", handler)
+
+    pool = jobs.JobWorkerPool(1)
+    asyncio.run(pool._execute(JOB))
+    assert stub_db["failed"] == [(7, "boom")]
+    assert pool.stats["retried"] == 1
+
+
+def test_retry_delay_backs_off_and_caps():
+    assert jobs.retry_delay(1) == jobs.RETRY_BASE_SECONDS
+    assert jobs.retry_delay(2) == jobs.RETRY_BASE_SECONDS * 2
+    assert jobs.retry_delay(20) == jobs.RETRY_MAX_SECONDS
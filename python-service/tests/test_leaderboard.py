@@ -0,0 +1,85 @@
+"""Leaderboard ranking (app/leaderboard.py)"""
+
+import asyncio
+from datetime import date, datetime
+
+import pytest
+
+from app import leaderboard
+
+STATE = {
+    "benchmark": "SPY",
+    "benchmark_return_percent": 10.0,
+    "window_start": date(2025, 10, 16),
+    "users": 5,
+    "refreshed_at": datetime(2026, 10, 16, 12, 0),
+    "full_refreshed_at": datetime(2026, 10, 16, 0, 0),
+}
+
+
+def _row(user_id: int, return_percent: float) -> dict:
+    return {
+        "user_id": user_id,
+        "return_percent": return_percent,
+        "profit": return_percent * 100,
+        "trade_count": 3,
+        "last_trade_at": None,
+    }
+
+
+@pytest.fixture
+def board(monkeypatch):
+    rows = []
+
+    async def get_state():
+        return STATE
+
+    async def get_top(limit):
+        return rows[:limit]
+
+    monkeypatch.setattr(leaderboard.db, "get_leaderboard_state", get_state)
+    monkeypatch.setattr(leaderboard.db, "get_leaderboard_top", get_top)
+    return rows
+
+
+def test_ties_share_a_rank_and_the_next_rank_skips(board):
+    board.extend([_row(1, 30.0), _row(2, 20.0), _row(3, 20.0), _row(4, 5.0), _row(5, 5.0)])
+
+    leaders = asyncio.run(leaderboard.get_top(5))["leaders"]
+
+    assert [leader["rank"] for leader in leaders] == [1, 2, 2, 4, 4]
+    assert [leader["percentile"] for leader in leaders] == [100.0, 75.0, 75.0, 25.0, 25.0]
+    assert leaders[0]["excess_return_percent"] == 20.0
+
+
+def test_tie_rank_comes_from_the_first_tied_row(board):
+    board.extend([_row(1, 8.0), _row(2, 8.0), _row(3, 8.0)])
+
+    leaders = asyncio.run(leaderboard.get_top(3))["leaders"]
+
+    assert [leader["rank"] for leader in leaders] == [1, 1, 1]
+
+
+def test_get_top_is_none_before_the_first_refresh(monkeypatch):
+    async def no_state():
+        return None
+
+    monkeypatch.setattr(leaderboard.db, "get_leaderboard_state", no_state)
+    assert asyncio.run(leaderboard.get_top(10)) is None
+
+
+@pytest.mark.parametrize("limit", [0, leaderboard.MAX_LEADERS + 1])
+def test_get_top_rejects_out_of_range_limits(limit):
+    with pytest.raises(ValueError):
+        asyncio.run(leaderboard.get_top(limit))
+
+
+@pytest.mark.parametrize("rank, users, expected", [
+    (1, 1, 100.0),
+    (1, 5, 100.0),
+    (5, 5, 0.0),
+    (2, 3, 50.0),
+    (2, 4, 66.67),
+])
+def test_percentile(rank, users, expected):
+    assert leaderboard._percentile(rank, users) == expected
@@ -0,0 +1,97 @@
+"""Position lot matching (app/lots.py)"""
+
+import pytest
+
+from app.lots import Position, build_positions
+
+
+def position(method, trades):
+    p = Position("AAPL", method)
+    realized = [p.apply(side, qty, price) for side, qty, price in trades]
+    return p, realized
+
+
+def test_fifo_closes_oldest_lot_first():
+    p, realized = position("fifo", [("buy", 10, 100), ("buy", 10, 110), ("sell", 15, 120)])
+    assert realized[-1] == pytest.approx(10 * 20 + 5 * 10)
+    assert p.lots == [[5.0, 110.0]]
+    assert p.quantity == pytest.approx(5)
+
+
+def test_lifo_closes_newest_lot_first():
+    p, realized = position("lifo", [("buy", 10, 100), ("buy", 10, 110), ("sell", 15, 120)])
+    assert realized[-1] == pytest.approx(10 * 10 + 5 * 20)
+    assert p.lots == [[5.0, 100.0]]
+
+
+def test_average_pools_lots_at_weighted_price():
+    p, realized = position("average", [("buy", 10, 100), ("buy", 10, 110), ("sell", 15, 120)])
+    assert realized[-1] == pytest.approx(15 * 15)
+    assert p.lots == [[5.0, pytest.approx(105.0)]]
+    assert p.average_cost == pytest.approx(105.0)
+
+
+@pytest.mark.parametrize("method", ["fifo", "lifo", "average"])
+def test_short_cover_realizes_gain_when_bought_back_below_entry(method):
+    p, realized = position(method, [("sell", 10, 50), ("buy", 4, 40)])
+    assert realized == [0.0, pytest.approx(4 * 10)]
+    assert p.quantity == pytest.approx(-6)
+    assert p.cost_basis == pytest.approx(-6 * 50)
+    assert p.winning_closes == 1
+
+
+@pytest.mark.parametrize("method", ["fifo", "lifo", "average"])
+def test_short_cover_realizes_loss_when_bought_back_above_entry(method):
+    p, realized = position(method, [("sell", 10, 50), ("buy", 10, 55)])
+    assert realized[-1] == pytest.approx(-50)
+    assert p.lots == []
+    assert p.losing_closes == 1
+    assert p.gross_loss == pytest.approx(-50)
+
+
+@pytest.mark.parametrize("method", ["fifo", "lifo", "average"])
+def test_sell_through_long_flips_to_short(method):
+    p, realized = position(method, [("buy", 10, 100), ("sell", 15, 90)])
+    assert realized[-1] == pytest.approx(-100)
+    assert p.lots == [[-5.0, 90.0]]
+    assert p.unrealized_pnl(80) == pytest.approx(50)
+
+
+@pytest.mark.parametrize("method", ["fifo", "lifo", "average"])
+def test_buy_through_short_flips_to_long(method):
+    p, realized = position(method, [("sell", 10, 100), ("buy", 12, 95)])
+    assert realized[-1] == pytest.approx(50)
+    assert p.lots == [[2.0, 95.0]]
+    assert p.unrealized_pnl() == pytest.approx(0)
+
+
+def test_fifo_short_cover_spans_lots():
+    p, realized = position("fifo", [("sell", 5, 60), ("sell", 5, 50), ("buy", 7, 40)])
+    assert realized[-1] == pytest.approx(5 * 20 + 2 * 10)
+    assert p.lots == [[-3.0, 50.0]]
+
+
+def test_record_round_trip():
+    p, _ = position("fifo", [("buy", 10, 100), ("sell", 4, 110)])
+    record = p.to_record()
+    restored = Position.from_row(record)
+    assert restored.lots == p.lots
+    assert restored.realized_pnl == pytest.approx(40)
+    assert restored.apply("sell", 6, 120) == pytest.approx(120)
+
+
+def test_unknown_method_rejected():
+    with pytest.raises(ValueError):
+        Position("AAPL", "hifo")
+
+
+def test_build_positions_groups_by_symbol():
+    trades = [
+        {"symbol": "AAPL", "side": "buy", "qty": 1, "price": 10, "executed_at": None},
+        {"symbol": "MSFT", "side": "buy", "qty": 2, "price": 20, "executed_at": None},
+        {"symbol": "AAPL", "side": "sell", "qty": 1, "price": 12, "executed_at": None},
+    ]
+    positions = build_positions(trades, "fifo")
+    assert positions["AAPL"].realized_pnl == pytest.approx(2)
+    assert positions["AAPL"].quantity == pytest.approx(0)
+    assert positions["MSFT"].quantity == pytest.approx(2)
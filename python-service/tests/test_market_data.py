@@ -0,0 +1,146 @@
+"""Market data client paging and retries (app/market_data.py)"""
+
+import asyncio
+from datetime import date
+
+import httpx
+import pytest
+
+from app import market_data
+
+START, END = date(2025, 1, 1), date(2025, 3, 31)
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    """
+    Route the shared client to an in-process handler
+
+    Set stand_in.handler to a function of httpx.Request returning a
+    response; requests and backoff sleeps are recorded.
+    """
+    class StandIn:
+        handler = None
+        requests = []
+        sleeps = []
+
+    def install():
+        client = httpx.AsyncClient(
+            base_url=market_data.ALPACA_BASE_URL,
+            transport=httpx.MockTransport(lambda request: (
+                StandIn.requests.append(request) or StandIn.handler(request)
+            ))
+        )
+        monkeypatch.setattr(market_data, "_client", client)
+
+    async def sleep(seconds):
+        StandIn.sleeps.append(seconds)
+
+    monkeypatch.setattr(market_data.asyncio, "sleep", sleep)
+    StandIn.install = staticmethod(install)
+    StandIn.requests = []
+    StandIn.sleeps = []
+    return StandIn
+
+
+def run(stand_in, coro_fn):
+    async def scenario():
+        stand_in.install()
+        try:
+            return await coro_fn()
+        finally:
+            await market_data.close_client()
+    return asyncio.run(scenario())
+
+
+def bar(day):
+    return {"t": f"2025-01-{day:02d}T05:00:00Z", "c": 100 + day}
+
+
+def test_follows_next_page_token_across_pages(stand_in):
+    pages = {
+        None: {"bars": [bar(2), bar(3)], "next_page_token": "p2"},
+        "p2": {"bars": [bar(6)], "next_page_token": "p3"},
+        "p3": {"bars": [bar(7)], "next_page_token": None},
+    }
+    stand_in.handler = lambda request: httpx.Response(
+        200, json=pages[request.url.params.get("page_token")]
+    )
+
+    bars = run(stand_in, lambda: market_data.fetch_bars("SPY", START, END))
+
+    assert [b["c"] for b in bars] == [102, 103, 106, 107]
+    assert [r.url.params.get("page_token") for r in stand_in.requests] == [None, "p2", "p3"]
+    assert all(r.url.path.endswith("/stocks/SPY/bars") for r in stand_in.requests)
+    assert stand_in.requests[0].url.params["start"] == "2025-01-01"
+
+
+def test_retries_429_and_5xx_honouring_retry_after(stand_in):
+    responses = iter([
+        httpx.Response(429, headers={"Retry-After": "3"}),
+        httpx.Response(503),
+        httpx.Response(200, json={"bars": [bar(2)]}),
+    ])
+    stand_in.handler = lambda request: next(responses)
+
+    bars = run(stand_in, lambda: market_data.fetch_bars("SPY", START, END))
+
+    assert len(bars) == 1
+    assert len(stand_in.requests) == 3
+    assert stand_in.sleeps[0] == 3
+    assert 0 <= stand_in.sleeps[1] <= market_data.BACKOFF_BASE_SECONDS * 2
+
+
+def test_retry_after_is_capped(stand_in):
+    responses = iter([
+        httpx.Response(429, headers={"Retry-After": "3600"}),
+        httpx.Response(200, json={"bars": []}),
+    ])
+    stand_in.handler = lambda request: next(responses)
+
+    run(stand_in, lambda: market_data.fetch_bars("SPY", START, END))
+    assert stand_in.sleeps == [market_data.BACKOFF_MAX_SECONDS]
+
+
+def test_gives_up_after_max_attempts(stand_in):
+    stand_in.handler = lambda request: httpx.Response(500)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        run(stand_in, lambda: market_data.fetch_bars("SPY", START, END))
+    assert len(stand_in.requests) == market_data.MAX_RETRIES + 1
+    assert len(stand_in.sleeps) == market_data.MAX_RETRIES
+
+
+def test_transport_errors_are_retried_then_raised(stand_in):
+    def handler(request):
+        raise httpx.ConnectError("refused", request=request)
+    stand_in.handler = handler
+
+    with pytest.raises(httpx.ConnectError):
+        run(stand_in, lambda: market_data.fetch_bars("SPY", START, END))
+    assert len(stand_in.requests) == market_data.MAX_RETRIES + 1
+
+
+def test_client_errors_are_not_retried(stand_in):
+    stand_in.handler = lambda request: httpx.Response(403)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        run(stand_in, lambda: market_data.fetch_bars("SPY", START, END))
+    assert len(stand_in.requests) == 1
+
+
+def test_shared_client_is_reused_and_closed_on_shutdown():
+    import main
+
+    async def scenario():
+        client = market_data.get_client()
+        assert market_data.get_client() is client
+        await main.shutdown()
+        assert client.is_closed
+        assert market_data._client is None
+
+        replacement = market_data.get_client()
+        assert replacement is not client
+        await market_data.close_client()
+
+    asyncio.run(scenario())
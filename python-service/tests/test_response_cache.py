@@ -0,0 +1,132 @@
+"""Per-user response cache and ETags (app/response_cache.py)"""
+
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from app import response_cache
+from app.response_cache import ResponseCache, etag_matches, make_etag
+
+USER_ID = "123e4567-e89b-12d3-a456-426614174000"
+ETAG = make_etag(b"{}")
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False),
+    ("", False),
+    (ETAG, True),
+    ("W/" + ETAG, True),
+    ('"other", ' + ETAG, True),
+    ('"other", W/"another"', False),
+    ("*", True),
+])
+def test_etag_matches(header, expected):
+    assert etag_matches(header, ETAG) is expected
+
+
+@pytest.fixture
+def watermark(monkeypatch):
+    """Current watermark returned for every user; tests move it along"""
+    current = {"value": "3@2026-10-16T12:00:00+00:00/"}
+
+    async def get_trade_watermark(user_id):
+        return current["value"]
+
+    monkeypatch.setattr(response_cache.db, "get_trade_watermark", get_trade_watermark)
+    return current
+
+
+def _renderer(bodies):
+    async def render():
+        return bodies.pop(0)
+    return render
+
+
+def test_hit_is_served_without_rendering(watermark):
+    cache = ResponseCache()
+    render = _renderer([b"first", b"second"])
+
+    async def scenario():
+        return [await cache.fetch(USER_ID, "metrics", (), render) for _ in range(2)]
+
+    (first, etag), (second, second_etag) = asyncio.run(scenario())
+    assert first == second == b"first"
+    assert etag == second_etag == make_etag(b"first")
+    assert cache.stats["misses"] == 1
+    assert cache.stats["hits"] == 1
+    assert cache.stats["renders"] == 1
+
+
+def test_watermark_change_renders_again(watermark):
+    cache = ResponseCache()
+    render = _renderer([b"before", b"after"])
+
+    async def scenario():
+        before = await cache.fetch(USER_ID, "metrics", (), render)
+        # e.g. a mark to market in another process
+        watermark["value"] = "3@2026-10-16T12:00:00+00:00/2026-10-16T12:05:00+00:00"
+        after = await cache.fetch(USER_ID, "metrics", (), render)
+        return before, after
+
+    (before, _), (after, _) = asyncio.run(scenario())
+    assert (before, after) == (b"before", b"after")
+    assert cache.stats["renders"] == 2
+
+
+def test_matching_if_none_match_returns_no_body(watermark):
+    cache = ResponseCache()
+    render = _renderer([b"body"])
+
+    async def scenario():
+        _, etag = await cache.fetch(USER_ID, "metrics", (), render)
+        return await cache.fetch(USER_ID, "metrics", (), render, if_none_match="W/" + etag)
+
+    body, etag = asyncio.run(scenario())
+    assert body is None
+    assert etag == make_etag(b"body")
+    assert cache.stats["not_modified"] == 1
+
+
+def test_expired_entry_renders_again(watermark):
+    cache = ResponseCache(ttl_seconds=0)
+    render = _renderer([b"first", b"second"])
+
+    async def scenario():
+        return [(await cache.fetch(USER_ID, "metrics", (), render))[0] for _ in range(2)]
+
+    assert asyncio.run(scenario()) == [b"first", b"second"]
+
+
+def test_invalidate_drops_only_that_user(watermark):
+    cache = ResponseCache()
+    other = "00000000-0000-0000-0000-000000000001"
+
+    async def scenario():
+        await cache.fetch(USER_ID, "metrics", (), _renderer([b"a"]))
+        await cache.fetch(other, "metrics", (), _renderer([b"b"]))
+        cache.invalidate(USER_ID)
+
+    asyncio.run(scenario())
+    assert cache.get_stats()["entries"] == 1
+
+
+def test_endpoint_answers_304_to_a_weak_if_none_match(watermark, monkeypatch):
+    monkeypatch.setattr(response_cache, "_cache", ResponseCache())
+
+    async def get_user_metrics(user_id):
+        return {"user_id": user_id, "total_trades": 3}
+
+    monkeypatch.setattr(main.profit, "get_user_metrics", get_user_metrics)
+    client = TestClient(main.app)
+
+    first = client.get(f"/users/{USER_ID}/metrics")
+    assert first.status_code == 200
+    assert first.json() == {"user_id": USER_ID, "total_trades": 3}
+    etag = first.headers["etag"]
+
+    second = client.get(f"/users/{USER_ID}/metrics", headers={"If-None-Match": "W/" + etag})
+    assert second.status_code == 304
+    assert second.headers["etag"] == etag
+    assert second.content == b""
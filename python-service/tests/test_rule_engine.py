@@ -0,0 +1,59 @@
+"""Custom compliance rule evaluation (app/rule_engine.py)"""
+
+import numpy as np
+
+from app.rule_engine import RuleSet
+
+RULES = [
+    {"name": "crypto_value", "check_type": "max_value", "threshold": 1000, "symbols": ["BTC", "ETH"]},
+    {"name": "any_quantity", "check_type": "max_quantity", "threshold": 50, "symbols": []},
+    {"name": "tsla_value", "check_type": "max_value", "threshold": 500, "symbols": ["TSLA"]},
+    {"name": "broken", "check_type": "max_delta", "threshold": 1},
+]
+
+TRADES = [
+    {"symbol": "BTC", "qty": 1, "price": 2000},
+    {"symbol": "AAPL", "qty": 60, "price": 1},
+    {"symbol": "ETH", "qty": 2, "price": 100},
+    {"symbol": "TSLA", "qty": 10, "price": 10},
+]
+
+
+def test_invalid_rules_are_skipped():
+    rules = RuleSet(RULES, "test")
+    assert [rule.name for rule in rules.rules] == ["crypto_value", "any_quantity", "tsla_value"]
+    assert rules.skipped[0]["name"] == "broken"
+
+
+def test_dispatch_includes_wildcards_in_definition_order():
+    rules = RuleSet(RULES, "test")
+    assert [rule.name for rule in rules.rules_for("BTC")] == ["crypto_value", "any_quantity"]
+    assert [rule.name for rule in rules.rules_for("AAPL")] == ["any_quantity"]
+
+
+def test_batch_matches_single_trade_evaluation():
+    rules = RuleSet(RULES, "test")
+    result = rules.evaluate_batch(
+        [t["symbol"] for t in TRADES],
+        np.array([t["qty"] for t in TRADES]),
+        np.array([t["price"] for t in TRADES]),
+    )
+    batch = {
+        (int(row), rules.rules[rule].name): bool(flagged)
+        for rule, row, flagged in zip(result["rule"], result["row"], result["flagged"])
+    }
+    single = {
+        (row, rule.name): outcome[1] == "flag"
+        for row, trade in enumerate(TRADES)
+        for rule, outcome in rules.evaluate(trade)
+    }
+    assert batch == single
+    assert batch[(0, "crypto_value")] is True
+    assert batch[(1, "any_quantity")] is True
+    assert batch[(3, "tsla_value")] is False
+
+
+def test_batch_without_in_scope_rules_is_empty():
+    rules = RuleSet([RULES[2]], "test")
+    result = rules.evaluate_batch(["AAPL"], np.array([1.0]), np.array([1.0]))
+    assert len(result["rule"]) == len(result["row"]) == len(result["flagged"]) == 0
@@ -0,0 +1,141 @@
+"""Per-key single-flight coalescing (app/singleflight.py)"""
+
+import asyncio
+
+import pytest
+
+from app.singleflight import SingleFlight
+
+
+class Work:
+    """A coroutine function that blocks until released and counts its runs"""
+
+    def __init__(self):
+        self.runs = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.runs += 1
+        run = self.runs
+        await self.release.wait()
+        return run
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_burst_executes_at_most_twice():
+    async def scenario():
+        flight, work = SingleFlight(), Work()
+        first = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        burst = [asyncio.create_task(flight.run("u1", work)) for _ in range(10)]
+        await settle()
+        work.release.set()
+        return flight, work, await first, await asyncio.gather(*burst)
+
+    flight, work, first, burst = asyncio.run(scenario())
+    assert work.runs == 2
+    assert first == 1
+    # Every caller that arrived during the first run gets the trailing result
+    assert burst == [2] * 10
+    assert flight.stats == {"requested": 11, "executed": 2, "coalesced": 9}
+    assert flight.in_flight() == 0
+
+
+def test_keys_are_independent():
+    async def scenario():
+        flight, work = SingleFlight(), Work()
+        tasks = [asyncio.create_task(flight.run(key, work)) for key in ("u1", "u2")]
+        await settle()
+        work.release.set()
+        return await asyncio.gather(*tasks), work.runs
+
+    results, runs = asyncio.run(scenario())
+    assert runs == 2
+    assert sorted(results) == [1, 2]
+
+
+def test_cancelling_trailing_leader_does_not_cancel_joiners():
+    async def scenario():
+        flight, work = SingleFlight(), Work()
+        first = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        leader = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        joiner = asyncio.create_task(flight.run("u1", work))
+        await settle()
+
+        # The client that scheduled the trailing run disconnects
+        leader.cancel()
+        await settle()
+        work.release.set()
+
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await first, await joiner, work.runs
+
+    first, joiner, runs = asyncio.run(scenario())
+    assert (first, joiner, runs) == (1, 2, 2)
+
+
+def test_cancelling_joiner_does_not_cancel_trailing_run():
+    async def scenario():
+        flight, work = SingleFlight(), Work()
+        first = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        leader = asyncio.create_task(flight.run("u1", work))
+        joiner = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        joiner.cancel()
+        work.release.set()
+        return await first, await leader
+
+    assert asyncio.run(scenario()) == (1, 2)
+
+
+def test_trailing_error_reaches_every_caller():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def work():
+            calls.append(None)
+            await release.wait()
+            if len(calls) == 2:
+                raise RuntimeError("failed")
+            return "ok"
+
+        first = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        trailing = [asyncio.create_task(flight.run("u1", work)) for _ in range(3)]
+        await settle()
+        release.set()
+        return await first, await asyncio.gather(*trailing, return_exceptions=True)
+
+    first, trailing = asyncio.run(scenario())
+    assert first == "ok"
+    assert all(isinstance(result, RuntimeError) for result in trailing)
+
+
+def test_new_caller_after_trailing_run_starts_queues_again():
+    async def scenario():
+        flight, work = SingleFlight(), Work()
+        first = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        second = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        # Finish the first run only; the trailing run starts and blocks
+        work.release.set()
+        assert await first == 1
+        work.release = asyncio.Event()
+        await settle()
+        third = asyncio.create_task(flight.run("u1", work))
+        await settle()
+        work.release.set()
+        return await second, await third, work.runs
+
+    assert asyncio.run(scenario()) == (2, 3, 3)
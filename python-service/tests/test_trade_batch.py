@@ -0,0 +1,96 @@
+"""Batch trade ingestion body parsing and limits (main.py)"""
+
+import json
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import parse_batch_body
+
+USER_ID = "123e4567-e89b-12d3-a456-426614174000"
+
+
+def trade(**overrides):
+    return {
+        "user_id": USER_ID,
+        "symbol": "AAPL",
+        "side": "buy",
+        "qty": 10,
+        "price": 150.5,
+        "executed_at": "2025-10-23T10:30:00Z",
+        **overrides
+    }
+
+
+def test_json_array_body():
+    items = parse_batch_body(json.dumps([trade(), trade(side="sell")]).encode(), "application/json")
+    assert [item["side"] for item in items] == ["buy", "sell"]
+
+
+def test_json_body_must_be_an_array():
+    with pytest.raises(ValueError, match="JSON array"):
+        parse_batch_body(json.dumps(trade()).encode(), "application/json")
+
+
+def test_invalid_json_body():
+    with pytest.raises(ValueError, match="Invalid JSON body"):
+        parse_batch_body(b"[{", "application/json")
+
+
+def test_ndjson_reports_bad_lines_per_row():
+    body = "\n".join([json.dumps(trade()), "", "{not json", json.dumps(trade(qty=1))]).encode()
+    items = parse_batch_body(body, "application/x-ndjson")
+    assert len(items) == 3
+    assert items[0]["qty"] == 10
+    assert isinstance(items[1], ValueError)
+    assert items[2]["qty"] == 1
+
+
+def test_ndjson_rejects_non_utf8():
+    with pytest.raises(ValueError, match="not UTF-8"):
+        parse_batch_body(b'{"symbol": "\xff"}\n', "application/x-ndjson")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    created = []
+
+    async def create_trades_bulk(trades, jobs=None):
+        rows = [{"id": str(uuid4()), **t} for t in trades]
+        created.extend(rows)
+        return rows
+
+    monkeypatch.setattr(main.db, "create_trades_bulk", create_trades_bulk)
+    test_client = TestClient(main.app)
+    test_client.created = created
+    return test_client
+
+
+def test_batch_accepts_valid_rows_and_rejects_the_rest(client):
+    body = "\n".join([json.dumps(trade()), "{oops", json.dumps(trade(qty="many"))])
+    response = client.post(
+        "/trades/batch", content=body, headers={"content-type": "application/x-ndjson"}
+    )
+    assert response.status_code == 200
+    payload = response.json()
+    assert payload["accepted"] == 1
+    assert payload["rejected"] == 2
+    assert [r["status"] for r in payload["results"]] == ["accepted", "rejected", "rejected"]
+    assert len(client.created) == 1
+
+
+def test_batch_over_limit_is_413(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_BATCH_SIZE", 2)
+    response = client.post("/trades/batch", json=[trade(), trade(), trade()])
+    assert response.status_code == 413
+    assert client.created == []
+
+
+def test_batch_with_non_utf8_ndjson_is_400(client):
+    response = client.post(
+        "/trades/batch", content=b"\xff\xfe\n", headers={"content-type": "application/x-ndjson"}
+    )
+    assert response.status_code == 400
+    assert "UTF-8" in response.json()["detail"]
@@ -0,0 +1,104 @@
+"""Wash sale windows (app/wash_sale.py)"""
+
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from app.wash_sale import WASH_SALE_DAYS, WashSaleIndex, screen_wash_sales
+
+SALE_DAY = date(2024, 6, 14)
+
+
+def columns(trades):
+    """Columns shaped like db.fetch_user_trades_columns() from (symbol, side, day) tuples"""
+    return {
+        "symbol": np.array([symbol for symbol, _, _ in trades], dtype=object),
+        "side": np.array([side for _, side, _ in trades], dtype=object),
+        "executed_at": np.array([np.datetime64(day, "D") for _, _, day in trades]),
+    }
+
+
+def screen(trades, start=SALE_DAY, end=SALE_DAY):
+    return screen_wash_sales(columns(trades), start, end)
+
+
+def test_buy_on_window_edges_is_related():
+    result = screen([
+        ("AAPL", "buy", SALE_DAY - timedelta(days=WASH_SALE_DAYS)),
+        ("AAPL", "sell", SALE_DAY),
+        ("AAPL", "buy", SALE_DAY + timedelta(days=WASH_SALE_DAYS)),
+    ])
+    assert list(result["index"]) == [1]
+    assert list(result["buys"]) == [2]
+    assert result["first_buy"][0] == np.datetime64(SALE_DAY - timedelta(days=WASH_SALE_DAYS))
+    assert result["last_buy"][0] == np.datetime64(SALE_DAY + timedelta(days=WASH_SALE_DAYS))
+
+
+def test_buy_one_day_outside_window_is_ignored():
+    result = screen([
+        ("AAPL", "buy", SALE_DAY - timedelta(days=WASH_SALE_DAYS + 1)),
+        ("AAPL", "sell", SALE_DAY),
+        ("AAPL", "buy", SALE_DAY + timedelta(days=WASH_SALE_DAYS + 1)),
+    ])
+    assert len(result["index"]) == 0
+    assert result["sells_screened"] == 1
+
+
+def test_buy_of_other_symbol_is_ignored():
+    result = screen([
+        ("MSFT", "buy", SALE_DAY),
+        ("AAPL", "sell", SALE_DAY),
+        ("NVDA", "buy", SALE_DAY + timedelta(days=1)),
+    ])
+    assert len(result["index"]) == 0
+
+
+def test_only_sells_in_range_are_screened():
+    result = screen(
+        [
+            ("AAPL", "buy", SALE_DAY),
+            ("AAPL", "sell", SALE_DAY - timedelta(days=1)),
+            ("AAPL", "sell", SALE_DAY),
+            ("AAPL", "sell", SALE_DAY + timedelta(days=1)),
+        ],
+        start=SALE_DAY,
+        end=SALE_DAY,
+    )
+    assert result["sells_screened"] == 1
+    assert list(result["index"]) == [2]
+
+
+def test_no_trades_or_no_buys():
+    assert screen([])["sells_screened"] == 0
+    result = screen([("AAPL", "sell", SALE_DAY)])
+    assert result["sells_screened"] == 1
+    assert len(result["index"]) == 0
+
+
+def trade(trade_id, side, day, symbol="AAPL", user_id="u1"):
+    return {
+        "id": trade_id,
+        "user_id": user_id,
+        "symbol": symbol,
+        "side": side,
+        "executed_at": datetime.combine(day, datetime.min.time()),
+    }
+
+
+def test_index_window_is_inclusive_and_per_user_symbol():
+    index = WashSaleIndex()
+    buys = [
+        trade(1, "buy", SALE_DAY - timedelta(days=WASH_SALE_DAYS + 1)),
+        trade(2, "buy", SALE_DAY - timedelta(days=WASH_SALE_DAYS)),
+        trade(3, "buy", SALE_DAY + timedelta(days=WASH_SALE_DAYS)),
+        trade(4, "buy", SALE_DAY + timedelta(days=WASH_SALE_DAYS + 1)),
+        trade(5, "buy", SALE_DAY, symbol="MSFT"),
+        trade(6, "buy", SALE_DAY, user_id="u2"),
+    ]
+    for t in buys:
+        index.add(t)
+
+    sale = trade(7, "sell", SALE_DAY)
+    index.add(sale)
+    assert [t["id"] for t in index.related_buys(sale)] == [2, 3]
+    assert index.related_buys(trade(8, "sell", SALE_DAY, symbol="TSLA")) == []